@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class AccountsConfig(AppConfig):
     name = 'accounts'
+
+    def ready(self):
+        # connect the receivers which invalidate cached auth tokens
+        import accounts.authentication  # noqa: F401
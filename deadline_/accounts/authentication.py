@@ -0,0 +1,182 @@
+"""
+Token authentication which caches what a token resolves to.
+
+DRF's TokenAuthentication queries the token (joined to its user) on every authenticated request.
+Here a token is resolved once and a snapshot of its user and the user's role is cached for
+    AUTH_TOKEN_CACHE_SECONDS, after which every request gets a fresh User instance built from the snapshot.
+The cache is per-process. A token, user or role change drops the affected entries of the process
+    it happened in (see the receivers below), while the other processes pick it up once their entry expires.
+Revoking a token (logging out or rotating it) must not wait for that, so every entry also holds the token's
+    revocation version from the shared cache (see response_cache.get_versions), which a token change bumps.
+    An entry whose version is no longer the current one is dropped, in every process sharing the cache
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.translation import ugettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from accounts.models import User, Role
+from metrics import REGISTRY
+from request_metrics import record_cache_lookup
+from response_cache import get_versions, bump_versions_on_commit
+
+AUTH_TOKEN_CACHE_LOOKUPS = REGISTRY.counter('auth_token_cache_lookups_total',
+                                            'Authenticated requests, by whether their token was cached',
+                                            labels=('result', ))
+
+USER_FIELD_NAMES = [field.attname for field in User._meta.concrete_fields]
+USER_ID_INDEX = USER_FIELD_NAMES.index('id')
+ROLE_FIELD_NAMES = [field.attname for field in Role._meta.concrete_fields]
+TOKEN_FIELD_NAMES = [field.attname for field in Token._meta.concrete_fields]
+
+
+def token_revocation_namespace(key: str) -> str:
+    return f'auth-token:{key}'
+
+
+class AuthTokenCache:
+    """
+    A bounded cache which maps a token's key to the field values of the token, its user and the user's role.
+    Only field values are kept, so a view modifying request.user never modifies the cache
+    """
+    def __init__(self, max_size=settings.AUTH_TOKEN_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()  # token key -> (expiry, revocation version, token values, user values, role values)
+        self._keys_by_user_id = {}
+        self._generation = 0  # bumped on every invalidation, see store()
+        self._lock = threading.Lock()
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    @staticmethod
+    def get_revocation_version(key) -> str:
+        return get_versions([token_revocation_namespace(key)])[0]
+
+    def get(self, key) -> (User, Token):
+        """ The user and token cached for the key, None if it is not cached, has expired or has been revoked """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expiry, revocation_version, token_values, user_values, role_values = entry
+        if expiry < time.monotonic() or revocation_version != self.get_revocation_version(key):
+            self.invalidate(key)
+            return None
+
+        user = User.from_db(DEFAULT_DB_ALIAS, USER_FIELD_NAMES, user_values)
+        user.role = Role.from_db(DEFAULT_DB_ALIAS, ROLE_FIELD_NAMES, role_values)
+        token = Token.from_db(DEFAULT_DB_ALIAS, TOKEN_FIELD_NAMES, token_values)
+        token.user = user
+        return user, token
+
+    def store(self, token: Token, generation: int, revocation_version: str):
+        """
+        Caches a token whose user and role were fetched along with it.
+        A token fetched before the last invalidation is not cached, as it may have been fetched before the change.
+        The generation and revocation version must be read before fetching the token, for the same reason
+        """
+        if settings.AUTH_TOKEN_CACHE_SECONDS <= 0:
+            return
+        user = token.user
+        entry = (time.monotonic() + settings.AUTH_TOKEN_CACHE_SECONDS,
+                 revocation_version,
+                 tuple(getattr(token, name) for name in TOKEN_FIELD_NAMES),
+                 tuple(getattr(user, name) for name in USER_FIELD_NAMES),
+                 tuple(getattr(user.role, name) for name in ROLE_FIELD_NAMES))
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[token.key] = entry
+            self._entries.move_to_end(token.key)
+            self._keys_by_user_id.setdefault(user.id, set()).add(token.key)
+            while len(self._entries) > self.max_size:
+                self._pop(next(iter(self._entries)))  # drop the oldest token
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self._pop(key)
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            self._generation += 1
+            for key in self._keys_by_user_id.pop(user_id, ()):
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._keys_by_user_id.clear()
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        user_id = entry[3][USER_ID_INDEX]
+        user_keys = self._keys_by_user_id.get(user_id)
+        if user_keys is not None:
+            user_keys.discard(key)
+            if not user_keys:
+                del self._keys_by_user_id[user_id]
+
+
+AUTH_TOKEN_CACHE = AuthTokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication which resolves a token with at most one query (joining its user and role)
+        and then serves it from the AUTH_TOKEN_CACHE
+    """
+    def authenticate_credentials(self, key):
+        cached = AUTH_TOKEN_CACHE.get(key)
+        if cached is not None:
+            AUTH_TOKEN_CACHE_LOOKUPS.labels(result='hit').inc()
+            record_cache_lookup(is_hit=True)
+            return cached
+        AUTH_TOKEN_CACHE_LOOKUPS.labels(result='miss').inc()
+        record_cache_lookup(is_hit=False)
+
+        generation = AUTH_TOKEN_CACHE.generation
+        revocation_version = AUTH_TOKEN_CACHE.get_revocation_version(key)
+        try:
+            token = Token.objects.select_related('user__role').get(key=key)
+        except Token.DoesNotExist:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+
+        AUTH_TOKEN_CACHE.store(token, generation, revocation_version)
+        return token.user, token
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def token_changed(sender, instance, *args, **kwargs):
+    """ Logging out or rotating the token deletes the old one, which the other processes must stop accepting too """
+    AUTH_TOKEN_CACHE.invalidate(instance.key)
+    bump_versions_on_commit(token_revocation_namespace(instance.key))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, *args, **kwargs):
+    AUTH_TOKEN_CACHE.invalidate_user(instance.id)
+
+
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+def role_changed(sender, instance, *args, **kwargs):
+    """ Roles barely ever change, so it is simpler to drop every cached token """
+    AUTH_TOKEN_CACHE.clear()
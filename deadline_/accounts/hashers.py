@@ -0,0 +1,113 @@
+"""
+Password hashing.
+
+A password is stored as `algorithm$parameters$salt$hash` (e.g pbkdf2_sha256$iterations=100000$abc$def),
+    so every user keeps the algorithm and cost his password was hashed with.
+Changing ACCOUNTS_PASSWORD_HASHER or its parameters in the settings affects new passwords right away,
+    while existing ones get re-hashed the next time their owner logs in (see check_password).
+Passwords from before this format are a bare SHA-512 hex digest, salted with the User.salt column
+"""
+import base64
+import hashlib
+import hmac
+import uuid
+
+from django.conf import settings
+
+
+class PasswordHasher:
+    """
+    Hashes passwords with one algorithm, whose cost is set by its parameters
+    """
+    ALGORITHM = None
+    DEFAULT_PARAMETERS = {}
+
+    def __init__(self, **parameters):
+        self.parameters = {name: int(parameters.get(name, default))
+                           for name, default in self.DEFAULT_PARAMETERS.items()}
+
+    def encode(self, password: str, salt: str) -> str:
+        parameters = ','.join(f'{name}={value}' for name, value in sorted(self.parameters.items()))
+        return f'{self.ALGORITHM}${parameters}${salt}${self.hash(password, salt, **self.parameters)}'
+
+    def verify(self, password: str, encoded: str) -> bool:
+        _, parameters, salt, expected_hash = encoded.split('$', 3)
+        return hmac.compare_digest(self.hash(password, salt, **self.decode_parameters(parameters)), expected_hash)
+
+    def needs_rehash(self, encoded: str) -> bool:
+        """ Whether the password was hashed with a different algorithm or cost than this hasher's """
+        algorithm, parameters, _, _ = encoded.split('$', 3)
+        return algorithm != self.ALGORITHM or self.decode_parameters(parameters) != self.parameters
+
+    @staticmethod
+    def decode_parameters(parameters: str) -> {str: int}:
+        return {name: int(value) for name, value in (parameter.split('=') for parameter in parameters.split(','))}
+
+    def hash(self, password: str, salt: str, **parameters) -> str:
+        raise NotImplementedError()
+
+
+class PBKDF2SHA256Hasher(PasswordHasher):
+    ALGORITHM = 'pbkdf2_sha256'
+    DEFAULT_PARAMETERS = {'iterations': 100000}
+
+    def hash(self, password: str, salt: str, iterations: int) -> str:
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt.encode('utf-8'), iterations)
+        return base64.b64encode(digest).decode('ascii')
+
+
+class ScryptHasher(PasswordHasher):
+    """ A memory-hard hasher, each hash takes 128 * n * r bytes of memory """
+    ALGORITHM = 'scrypt'
+    DEFAULT_PARAMETERS = {'n': 2 ** 14, 'r': 8, 'p': 1}
+
+    def hash(self, password: str, salt: str, n: int, r: int, p: int) -> str:
+        digest = hashlib.scrypt(password.encode('utf-8'), salt=salt.encode('utf-8'), n=n, r=r, p=p,
+                                maxmem=256 * n * r, dklen=64)
+        return base64.b64encode(digest).decode('ascii')
+
+
+class LegacySHA512Hasher:
+    """ Verifies the passwords stored before hashers were introduced, salted with the User.salt column """
+    @staticmethod
+    def verify(password: str, encoded: str, salt: str) -> bool:
+        return hmac.compare_digest(hashlib.sha512((password + salt).encode('utf-8')).hexdigest(), encoded)
+
+
+HASHERS = {hasher.ALGORITHM: hasher for hasher in (PBKDF2SHA256Hasher, ScryptHasher)}
+
+
+def get_hasher(algorithm: str=None) -> PasswordHasher:
+    """ The hasher of the given algorithm, configured with the cost from the settings """
+    algorithm = algorithm or settings.ACCOUNTS_PASSWORD_HASHER
+    return HASHERS[algorithm](**settings.ACCOUNTS_PASSWORD_HASHER_PARAMETERS.get(algorithm, {}))
+
+
+def make_password(password: str, salt: str=None) -> str:
+    return get_hasher().encode(password, salt or uuid.uuid4().hex)
+
+
+def is_legacy_password(encoded: str) -> bool:
+    return '$' not in encoded
+
+
+def check_password(password: str, encoded: str, legacy_salt: str='') -> (bool, bool):
+    """
+    Checks the password against its stored (encoded) version in constant time
+    :return: a boolean indicating if it matches and one indicating if it should be re-hashed with the current hasher
+    """
+    if is_legacy_password(encoded):
+        return LegacySHA512Hasher.verify(password, encoded, legacy_salt), True
+
+    algorithm = encoded.split('$', 1)[0]
+    if algorithm not in HASHERS:
+        return False, False
+    return get_hasher(algorithm).verify(password, encoded), get_hasher().needs_rehash(encoded)
+
+
+def run_dummy_check():
+    """
+    Hashes a password with the current hasher and throws it away,
+        so that a login for an unknown e-mail takes as long as one with a wrong password
+    """
+    get_hasher().encode('', uuid.uuid4().hex)
@@ -1,4 +1,3 @@
-import hashlib
 import jwt
 from datetime import datetime, timedelta
 
@@ -17,7 +16,3 @@ def generate_notification_token(user):
     notification_token = jwt.encode({'exp': expiry_date, 'username': user.username}, NOTIFICATION_SECRET_KEY).decode("utf-8")
 
     return notification_token
-
-
-def hash_password(password, salt):
-    return hashlib.sha512((password + salt).encode('utf-8')).hexdigest()
\ No newline at end of file
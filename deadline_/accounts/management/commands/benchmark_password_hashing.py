@@ -0,0 +1,91 @@
+import os
+import statistics
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from accounts.hashers import HASHERS, PBKDF2SHA256Hasher, ScryptHasher
+
+CALIBRATION_SAMPLES = 3  # every cost is timed this many times and the median is taken
+# the parameter which sets the cost of each algorithm, how it grows while calibrating and its smallest value
+COST_PARAMETERS = {
+    PBKDF2SHA256Hasher.ALGORITHM: ('iterations', 1000),
+    ScryptHasher.ALGORITHM: ('n', 2 ** 10),
+}
+
+
+def time_hash(algorithm: str, parameters: dict) -> float:
+    hasher = HASHERS[algorithm](**parameters)
+    start = time.perf_counter()
+    hasher.encode('correct horse battery staple', uuid.uuid4().hex)
+    return time.perf_counter() - start
+
+
+def hash_until(algorithm: str, parameters: dict, duration_seconds: float) -> [float]:
+    """ Hashes passwords back to back for duration_seconds, like a login worker under full load """
+    latencies = []
+    deadline = time.perf_counter() + duration_seconds
+    while time.perf_counter() < deadline:
+        latencies.append(time_hash(algorithm, parameters))
+    return latencies
+
+
+class Command(BaseCommand):
+    help = 'Picks the password hashing cost which hits a target login latency on this machine ' \
+           'and measures the login throughput it allows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--algorithm', choices=sorted(HASHERS), default=settings.ACCOUNTS_PASSWORD_HASHER)
+        parser.add_argument('--target-ms', type=float, default=250,
+                            help='How long hashing a single password should take, in milliseconds')
+        parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                            help='How many processes hash in parallel while measuring the throughput, '
+                                 'e.g the number of web workers')
+        parser.add_argument('--duration', type=float, default=10, help='How long to measure the throughput for')
+
+    def handle(self, *args, **options):
+        algorithm, target_seconds = options['algorithm'], options['target_ms'] / 1000
+        parameters = self.calibrate(algorithm, target_seconds)
+        self.stdout.write(f'{algorithm} with {parameters} takes {self.median_time(algorithm, parameters) * 1000:.0f}ms '
+                          f'per password')
+
+        with ProcessPoolExecutor(max_workers=options['processes']) as executor:
+            workers = [executor.submit(hash_until, algorithm, parameters, options['duration'])
+                       for _ in range(options['processes'])]
+            latencies = sorted(latency for worker in workers for latency in worker.result())
+        self.stdout.write(f'Under full load on {options["processes"]} processes: '
+                          f'{len(latencies) / options["duration"]:.1f} logins/second, '
+                          f'p50 {statistics.median(latencies) * 1000:.0f}ms, '
+                          f'p99 {latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1000:.0f}ms')
+        self.stdout.write(f'To use it, set in the settings\n'
+                          f'ACCOUNTS_PASSWORD_HASHER = {algorithm!r}\n'
+                          f'ACCOUNTS_PASSWORD_HASHER_PARAMETERS[{algorithm!r}] = {parameters!r}')
+
+    def calibrate(self, algorithm: str, target_seconds: float) -> dict:
+        """
+        Doubles the cost until hashing takes at least target_seconds and picks the cost closest to the target.
+        PBKDF2's time grows linearly with its iterations, so they are then scaled to hit the target
+        """
+        cost_name, cost = COST_PARAMETERS[algorithm]
+        parameters = dict(settings.ACCOUNTS_PASSWORD_HASHER_PARAMETERS.get(algorithm, {}))
+        previous_cost, previous_seconds = cost, 0
+        while True:
+            parameters[cost_name] = cost
+            seconds = self.median_time(algorithm, parameters)
+            if seconds >= target_seconds:
+                break
+            previous_cost, previous_seconds = cost, seconds
+            cost *= 2
+
+        if algorithm == PBKDF2SHA256Hasher.ALGORITHM:
+            parameters[cost_name] = max(int(cost * target_seconds / seconds) // 1000 * 1000, 1000)
+        elif target_seconds - previous_seconds < seconds - target_seconds:
+            parameters[cost_name] = previous_cost
+        return parameters
+
+    @staticmethod
+    def median_time(algorithm: str, parameters: dict) -> float:
+        return statistics.median(time_hash(algorithm, parameters) for _ in range(CALIBRATION_SAMPLES))
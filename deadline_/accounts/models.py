@@ -1,10 +1,9 @@
 import hashlib, uuid
 
-import jwt
 from django.conf import settings
 from django.db import models
 from django.db.models import Count
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
 from django.dispatch import receiver
 
@@ -12,7 +11,9 @@ from rest_framework.authtoken.models import Token
 
 from accounts.constants import NOTIFICATION_SECRET_KEY
 from accounts.errors import UserAlreadyFollowedError, UserNotFollowedError
-from accounts.helpers import hash_password, generate_notification_token
+from accounts import hashers
+from accounts.helpers import generate_notification_token
+from token_cache import TOKEN_EXPIRY_CACHE, tokens_match
 from django.db import models
 from django.dispatch import receiver
 
@@ -39,11 +40,25 @@ class User(AbstractBaseUser):
         if not self.salt:
             # Store a random salt and hash the password!
             self.salt = uuid.uuid4().hex
-            self.password = hash_password(password=self.password, salt=self.salt)
+            self.password = hashers.make_password(self.password, salt=self.salt)
 
     def __str__(self):
         return self.username
 
+    def set_password(self, raw_password):
+        self.password = hashers.make_password(raw_password, salt=self.salt)
+
+    def check_password(self, raw_password) -> bool:
+        """
+        Checks the password in constant time.
+        A correct password which was hashed with an outdated algorithm or cost gets re-hashed with the current one
+        """
+        is_correct, needs_rehash = hashers.check_password(raw_password, self.password, legacy_salt=self.salt)
+        if is_correct and needs_rehash:
+            self.set_password(raw_password)
+            self.save(update_fields=['password'])
+        return is_correct
+
     def fetch_count_of_solved_challenges_for_subcategory(self, sub_category):
         """
         Given a SubCategory object,
@@ -57,23 +72,21 @@ class User(AbstractBaseUser):
                 )
 
     def notification_token_is_expired(self) -> bool:
-        """ Checks whether the current token is expired """
+        """ Checks whether the current token is expired, decoding it only the first time it is checked """
         if self.notification_token is None:
             return True
-        try:
-            jwt.decode(self.notification_token, NOTIFICATION_SECRET_KEY)
-            return False
-        except jwt.ExpiredSignatureError:
-            return True
+        return TOKEN_EXPIRY_CACHE.is_expired(self.notification_token, NOTIFICATION_SECRET_KEY)
 
     def refresh_notification_token(self, force=False):
         if not force and not self.notification_token_is_expired():
             raise Exception("Will not reset the notification token when it is not expired without being forced!")
+        TOKEN_EXPIRY_CACHE.invalidate(self.notification_token, NOTIFICATION_SECRET_KEY)
         self.notification_token = generate_notification_token(self)
-        self.save()
+        # this may be the cached request.user (see accounts.authentication), so do not overwrite the other fields
+        self.save(update_fields=['notification_token'])
 
     def notification_token_is_valid(self, token):
-        return token == self.notification_token and not self.notification_token_is_expired()
+        return tokens_match(token, self.notification_token) and not self.notification_token_is_expired()
 
     def fetch_newsfeed(self, start_offset=0, end_limit=None):
         """
@@ -130,24 +143,24 @@ class User(AbstractBaseUser):
 
     def fetch_subcategory_proficiency(self, subcategory_id) -> 'UserSubcategoryProficiency':
         """
-        Queries the DB and returns the UserSubcategoryProgress model associated with the given subcategory
+        Queries the DB and returns the UserSubcategoryProgress model associated with the given subcategory.
+        A subcategory created after the user gets its proficiency backfilled,
+            so if that has not reached him yet, it is created here
         """
-        from challenges.models import UserSubcategoryProficiency
-        usp: UserSubcategoryProficiency = UserSubcategoryProficiency.objects.filter(subcategory_id=subcategory_id).first()
+        from challenges.models import UserSubcategoryProficiency, SubCategory
+        usp: UserSubcategoryProficiency = UserSubcategoryProficiency.objects\
+            .filter(subcategory_id=subcategory_id, user_id=self.id).first()
         if usp is None:
-            raise Exception(f'Could not find a UserSubcategoryProficiency object for user {self} with subcategory_id {subcategory_id}')
+            if not SubCategory.objects.filter(id=subcategory_id).exists():
+                raise Exception(f'Could not find a UserSubcategoryProficiency object for user {self} with subcategory_id {subcategory_id}')
+            usp = UserSubcategoryProficiency.objects.fetch_or_create(user_id=self.id, subcategory_id=subcategory_id)
         return usp
 
     def fetch_proficiency_by_subcategory(self, subcategory_id) -> 'Proficiency':
         """
         Queries the DB and returns a Proficiency object associated with the given user and subcategory
         """
-        from challenges.models import UserSubcategoryProficiency
-        usp: UserSubcategoryProficiency = UserSubcategoryProficiency.objects\
-            .filter(subcategory_id=subcategory_id, user_id=self.id).first()
-        if usp is None:
-            raise Exception(f'Cound not find a UserSubcategoryProficiency object for user {self} with subcategory_id {subcategory_id}')
-        return usp.proficiency
+        return self.fetch_subcategory_proficiency(subcategory_id).proficiency
 
     def get_vote_for_submission(self, submission_id):
         from challenges.models import SubmissionVote
@@ -157,24 +170,26 @@ class User(AbstractBaseUser):
             return None
 
 
+# This code is triggered before a user is saved to the database
+@receiver(pre_save, sender=User)
+def user_pre_save(sender, instance, *args, **kwargs):
+    """
+        Give a new user his notification token before he is inserted, so he does not need a second save
+    """
+    if instance._state.adding and instance.notification_token is None:
+        instance.notification_token = generate_notification_token(instance)
+
+
 # This code is triggered whenever a new user has been created and saved to the database
 @receiver(post_save, sender=User)
 def user_post_save(sender, instance, created, *args, **kwargs):
     """
-        Create the UserSubcategoryProgress models for each subcategory
+        Create the UserSubcategoryProficiency models for each subcategory
             and the Token object
     """
-    from challenges.models import SubCategory, UserSubcategoryProficiency, Proficiency
+    from challenges.models import UserSubcategoryProficiency
     if not created:
         return
 
-    instance.notification_token = generate_notification_token(instance)
     Token.objects.create(user=instance)
-    starter_proficiency = Proficiency.objects.filter(needed_percentage=0).first()
-
-    # create a UserSubcategoryProgress for each subcategory and a UserSubcategoryProficiency
-    for subcat in SubCategory.objects.all():
-        UserSubcategoryProficiency.objects.create(user=instance, subcategory=subcat, proficiency=starter_proficiency,
-                                                  user_score=0)
-
-    instance.save()
+    UserSubcategoryProficiency.objects.provision_for_user(instance)
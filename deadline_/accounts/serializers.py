@@ -18,8 +18,7 @@ class UserSerializer(serializers.ModelSerializer):
     def to_representation(self, instance):
         data_returned = dict(super().to_representation(instance))
         del data_returned['password']
-        role_id = data_returned['role']
         del data_returned['role']
-        role = Role.objects.get(id=role_id)
-        data_returned['role'] = {'id': role_id, 'name': role.name}
+        # the role is usually fetched along with the user (see accounts.authentication), so this rarely queries
+        data_returned['role'] = {'id': instance.role_id, 'name': instance.role.name}
         return OrderedDict(data_returned)
\ No newline at end of file
@@ -1,13 +1,17 @@
 from datetime import timedelta, datetime
 from unittest.mock import patch, MagicMock
 
+import hashlib
+
 import jwt
+from django.conf import settings
 from django.http import HttpResponse
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.utils.six import BytesIO
 from rest_framework.test import APITestCase
 from rest_framework.parsers import JSONParser
 
+from accounts.authentication import AUTH_TOKEN_CACHE, CachedTokenAuthentication, token_revocation_namespace
 from accounts.constants import NOTIFICATION_SECRET_KEY
 from accounts.errors import UserAlreadyFollowedError, UserNotFollowedError
 from accounts.helpers import generate_notification_token
@@ -19,6 +23,7 @@ from challenges.models import (Challenge, Submission, Language, SubmissionVote,
 from social.constants import NW_ITEM_TEXT_POST
 from social.models.newsfeed_item import NewsfeedItem
 from social.models.notification import Notification
+from response_cache import bump_versions
 
 
 class UserModelNewsfeedTest(TestCase):
@@ -490,6 +495,21 @@ class UserModelTest(TestCase):
         self.assertEqual(len(mock_gen.mock_calls), 2)  # called once on registration
         self.assertEqual(us.notification_token, 'token :)')
 
+    @patch('accounts.models.generate_notification_token')
+    @patch('accounts.models.User.notification_token_is_expired')
+    def test_refresh_notification_token_does_not_overwrite_other_fields(self, mock_is_exp, mock_gen):
+        """ The user may be a cached snapshot, whose score has since changed in the DB """
+        mock_is_exp.return_value = True
+        mock_gen.return_value = 'token :)'
+        us = User.objects.create(username='SomeGuy', email='me@abv.bg', password='123', score=123, role=self.base_role)
+        User.objects.filter(id=us.id).update(score=500)
+
+        us.refresh_notification_token()
+
+        us.refresh_from_db()
+        self.assertEqual(us.score, 500)
+        self.assertEqual(us.notification_token, 'token :)')
+
     @patch('accounts.models.generate_notification_token')
     @patch('accounts.models.User.notification_token_is_expired')
     def test_refresh_notification_token_should_not_reset_if_not_expired(self, mock_is_exp, mock_gen):
@@ -608,6 +628,62 @@ class LoginViewTest(APITestCase):
         self.assertIn('error', response.data)
         self.assertIn('Invalid credentials', ''.join(response.data['error']))
 
+    def test_logging_in_invalid_password(self):
+        User.objects.create(email='that_part@abv.bg', password='123', role=self.base_role)
+        response: HttpResponse = self.client.post('/accounts/login/', data={'email': 'that_part@abv.bg',
+                                                                            'password': '1234'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_logging_in_rehashes_legacy_password(self):
+        user = User.objects.create(email='that_part@abv.bg', password='123', role=self.base_role)
+        legacy_hash = hashlib.sha512(('123' + user.salt).encode('utf-8')).hexdigest()
+        User.objects.filter(id=user.id).update(password=legacy_hash)
+
+        response: HttpResponse = self.client.post('/accounts/login/', data={'email': 'that_part@abv.bg',
+                                                                            'password': '123'})
+
+        self.assertEqual(response.status_code, 202)
+        user.refresh_from_db()
+        self.assertTrue(user.password.startswith('pbkdf2_sha256$'))
+        self.assertTrue(user.check_password('123'))
+
+
+class UserPasswordTests(TestCase):
+    def setUp(self):
+        self.base_role = Role.objects.create(name='Base')
+        self.user = User.objects.create(email='that_part@abv.bg', password='123', role=self.base_role)
+
+    def test_stores_algorithm_and_parameters_with_password(self):
+        algorithm, parameters, salt, password_hash = self.user.password.split('$')
+
+        self.assertEqual(algorithm, 'pbkdf2_sha256')
+        self.assertEqual(parameters, 'iterations=1')
+        self.assertNotIn('123', password_hash)
+
+    def test_check_password(self):
+        self.assertTrue(self.user.check_password('123'))
+        self.assertFalse(self.user.check_password('1234'))
+
+    def test_rehashes_password_on_changed_cost(self):
+        with override_settings(ACCOUNTS_PASSWORD_HASHER_PARAMETERS={'pbkdf2_sha256': {'iterations': 2}}):
+            self.assertTrue(self.user.check_password('123'))
+        self.user.refresh_from_db()
+        self.assertIn('$iterations=2$', self.user.password)
+
+    def test_rehashes_password_on_changed_algorithm(self):
+        with override_settings(ACCOUNTS_PASSWORD_HASHER='scrypt'):
+            self.assertTrue(self.user.check_password('123'))
+            self.user.refresh_from_db()
+            self.assertTrue(self.user.password.startswith('scrypt$'))
+            self.assertTrue(self.user.check_password('123'))
+
+    def test_wrong_password_is_not_rehashed(self):
+        password = self.user.password
+        with override_settings(ACCOUNTS_PASSWORD_HASHER='scrypt'):
+            self.assertFalse(self.user.check_password('1234'))
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.password, password)
+
 
 class LeaderboardViewTest(APITestCase):
     def setUp(self):
@@ -684,6 +760,107 @@ class UserDetailsViewTest(APITestCase):
         self.assertEqual(response.status_code, 401)
 
 
+@override_settings(AUTH_TOKEN_CACHE_SECONDS=30, CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'auth-token-cache-tests'}})
+class CachedTokenAuthenticationTests(APITestCase):
+    def setUp(self):
+        AUTH_TOKEN_CACHE.clear()
+        self.base_role = Role.objects.create(name='User')
+        self.user = User.objects.create(username='SomeGuy', email='me@abv.bg', password='123', score=123, role=self.base_role)
+        self.key = self.user.auth_token.key
+        self.auth = CachedTokenAuthentication()
+
+    def tearDown(self):
+        AUTH_TOKEN_CACHE.clear()
+
+    def test_token_is_queried_once(self):
+        with self.assertNumQueries(1):
+            user, token = self.auth.authenticate_credentials(self.key)
+        with self.assertNumQueries(0):
+            cached_user, cached_token = self.auth.authenticate_credentials(self.key)
+            serialized_user = UserSerializer(cached_user).data
+
+        self.assertEqual(cached_user, self.user)
+        self.assertEqual(cached_user.score, 123)
+        self.assertEqual(cached_token.key, self.key)
+        self.assertEqual(serialized_user['role'], {'id': self.base_role.id, 'name': 'User'})
+
+    def test_every_request_gets_its_own_user(self):
+        self.auth.authenticate_credentials(self.key)
+        user, _ = self.auth.authenticate_credentials(self.key)
+        user.score = 1
+
+        self.assertEqual(self.auth.authenticate_credentials(self.key)[0].score, 123)
+
+    def test_is_not_cached_when_disabled(self):
+        self.auth.authenticate_credentials(self.key)
+        with override_settings(AUTH_TOKEN_CACHE_SECONDS=0), self.assertNumQueries(1):
+            AUTH_TOKEN_CACHE.clear()
+            self.auth.authenticate_credentials(self.key)
+        self.assertIsNone(AUTH_TOKEN_CACHE.get(self.key))
+
+    def test_user_update_invalidates_token(self):
+        self.auth.authenticate_credentials(self.key)
+        self.user.score = 200
+        self.user.save()
+
+        with self.assertNumQueries(1):
+            user, _ = self.auth.authenticate_credentials(self.key)
+        self.assertEqual(user.score, 200)
+
+    def test_role_update_invalidates_token(self):
+        self.auth.authenticate_credentials(self.key)
+        self.base_role.name = 'Admin'
+        self.base_role.save()
+
+        user, _ = self.auth.authenticate_credentials(self.key)
+        self.assertEqual(user.role.name, 'Admin')
+
+    def test_logout_rotates_token(self):
+        self.auth.authenticate_credentials(self.key)
+
+        response = self.client.post('/accounts/logout/', HTTP_AUTHORIZATION=f'Token {self.key}')
+
+        self.assertEqual(response.status_code, 204)
+        self.assertIsNone(AUTH_TOKEN_CACHE.get(self.key))
+        self.assertEqual(self.client.get(f'/accounts/user/{self.user.id}',
+                                         HTTP_AUTHORIZATION=f'Token {self.key}').status_code, 401)
+        new_key = User.objects.get(id=self.user.id).auth_token.key
+        self.assertNotEqual(new_key, self.key)
+        self.assertEqual(self.client.get(f'/accounts/user/{self.user.id}',
+                                         HTTP_AUTHORIZATION=f'Token {new_key}').status_code, 200)
+
+    def test_revocation_in_another_process_invalidates_token(self):
+        self.auth.authenticate_credentials(self.key)
+
+        bump_versions(token_revocation_namespace(self.key))  # what a logout handled by another process does
+
+        self.assertIsNone(AUTH_TOKEN_CACHE.get(self.key))
+        with self.assertNumQueries(1):
+            self.auth.authenticate_credentials(self.key)
+
+    def test_token_fetched_before_an_invalidation_is_not_cached(self):
+        generation = AUTH_TOKEN_CACHE.generation
+        revocation_version = AUTH_TOKEN_CACHE.get_revocation_version(self.key)
+        AUTH_TOKEN_CACHE.invalidate_user(self.user.id)
+
+        AUTH_TOKEN_CACHE.store(self.user.auth_token, generation, revocation_version)
+
+        self.assertIsNone(AUTH_TOKEN_CACHE.get(self.key))
+
+    def test_cache_is_bounded(self):
+        other_user = User.objects.create(username='Other', email='other@abv.bg', password='123', role=self.base_role)
+        AUTH_TOKEN_CACHE.max_size = 1
+        try:
+            self.auth.authenticate_credentials(self.key)
+            self.auth.authenticate_credentials(other_user.auth_token.key)
+        finally:
+            AUTH_TOKEN_CACHE.max_size = settings.AUTH_TOKEN_CACHE_SIZE
+
+        self.assertIsNone(AUTH_TOKEN_CACHE.get(self.key))
+        self.assertIsNotNone(AUTH_TOKEN_CACHE.get(other_user.auth_token.key))
+
+
 class HelpersTest(TestCase):
 
     @patch('accounts.helpers.NOTIFICATION_TOKEN_EXPIRY_MINUTES', 20)
@@ -6,14 +6,17 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.generics import RetrieveAPIView
 from rest_framework.request import Request
+from rest_framework.authtoken.models import Token
 from rest_framework import status
 
 from accounts.serializers import UserSerializer
 from accounts.models import User, Role
-from accounts.helpers import hash_password
+from accounts.hashers import run_dummy_check
 from constants import BASE_USER_ROLE_NAME
+from request_metrics import query_budget
 
 
+@query_budget(5)
 class UserDetailView(RetrieveAPIView):
     permission_classes = (IsAuthenticated, )
     serializer_class = UserSerializer
@@ -46,6 +49,7 @@ def register(request: Request):
     return Response(data=serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+@query_budget(5)
 @api_view(['POST'])
 @permission_classes([])
 def login(request: Request):
@@ -61,12 +65,12 @@ def login(request: Request):
 
     user = User.objects.filter(email=given_email).first()
     if user is None:
+        run_dummy_check()  # so that the response time does not give away which e-mails are registered
         error = 'Invalid credentials!'
         return Response(data={'error': error}, status=status.HTTP_400_BAD_REQUEST)
 
     # Try to validate the password
-    hashed_password = hash_password(given_password, user.salt)
-    if hashed_password != user.password:
+    if not user.check_password(given_password):
         error = 'Invalid credentials!'
 
     if error:
@@ -77,6 +81,15 @@ def login(request: Request):
     return Response(data=response_data, status=status.HTTP_202_ACCEPTED)
 
 
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def logout(request: Request):
+    """ Invalidates the user's token by rotating it, the next login returns the new one """
+    Token.objects.filter(user_id=request.user.id).delete()
+    Token.objects.create(user_id=request.user.id)
+    return Response(status=status.HTTP_204_NO_CONTENT)
+
+
 @ensure_csrf_cookie
 @permission_classes([])
 @api_view(['GET'])
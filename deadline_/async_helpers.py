@@ -0,0 +1,88 @@
+"""
+Helpers for running Django code from the asyncio websocket servers
+"""
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from metrics import REGISTRY
+
+logger = logging.getLogger('websockets')
+
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=settings.WS_DB_THREAD_POOL_SIZE, thread_name_prefix='ws-db')
+
+DB_CALL_SECONDS = REGISTRY.histogram('ws_db_call_seconds', 'Time spent in DB calls made from the websocket server',
+                                     labels=('function', ))
+QUEUE_DEPTH = REGISTRY.gauge('ws_queue_depth', 'The number of messages waiting in a router queue', labels=('queue', ))
+HANDLER_SECONDS = REGISTRY.histogram('ws_handler_seconds', 'Time spent handling a routed message',
+                                     labels=('queue', ))
+
+
+def _call_with_connection(func, *args, **kwargs):
+    """
+    Runs the function in a DB executor thread.
+    Every thread keeps its own Django connection, we only make sure it is not stale or broken beforehand
+    """
+    close_old_connections()
+    with DB_CALL_SECONDS.labels(function=getattr(func, '__name__', 'unknown')).time():
+        return func(*args, **kwargs)
+
+
+async def run_in_db_thread(func, *args, **kwargs):
+    """
+    Runs the given blocking (ORM) function in the bounded DB thread pool, so that it does not block the event loop
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(DB_EXECUTOR, functools.partial(_call_with_connection, func, *args, **kwargs))
+
+
+class _MeteredQueue(asyncio.Queue):
+    """ An asyncio.Queue which keeps the depth gauge of its sharded queue up to date """
+    def __init__(self, depth_gauge, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.depth_gauge = depth_gauge
+
+    def _put(self, item):
+        super()._put(item)
+        self.depth_gauge.inc()
+
+    def _get(self):
+        self.depth_gauge.dec()
+        return super()._get()
+
+
+class ShardedQueue:
+    """
+    A router queue split into shards, each drained by its own worker coroutine.
+    Messages with the same shard key (e.g the same user or dialog) always land in the same shard,
+        so they are handled in order, while a slow message only holds up its own shard
+    """
+    def __init__(self, name: str, shard_count: int=settings.WS_WORKERS_PER_MESSAGE_TYPE):
+        self.name = name
+        depth_gauge = QUEUE_DEPTH.labels(queue=name)
+        self.shards = [_MeteredQueue(depth_gauge) for _ in range(shard_count)]
+        self._handler_seconds = HANDLER_SECONDS.labels(queue=name)
+
+    def get_shard(self, shard_key) -> asyncio.Queue:
+        return self.shards[hash(shard_key) % len(self.shards)]
+
+    async def put(self, packet, shard_key):
+        await self.get_shard(shard_key).put(packet)
+
+    def start_workers(self, handle_packet):
+        """ Starts a worker per shard, which awaits handle_packet(packet) for every packet of its shard """
+        for shard in self.shards:
+            asyncio.ensure_future(self._work(shard, handle_packet))
+
+    async def _work(self, shard: asyncio.Queue, handle_packet):
+        while True:
+            packet = await shard.get()
+            try:
+                with self._handler_seconds.time():
+                    await handle_packet(packet)
+            except Exception as e:
+                logger.error(f'Could not handle a message from {self.name} due to {e}')
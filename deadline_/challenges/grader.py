@@ -38,6 +38,7 @@ GRADER_TEST_RESULT_DESCRIPTION_KEY = 'description'
 GRADER_TEST_RESULT_TRACEBACK_KEY = 'traceback'
 GRADER_TEST_RESULT_ERROR_MESSAGE_KEY = 'error_message'
 GRADER_COMPILE_FAILURE = 'COMPILATION FAILED'
+GRADER_COMPILE_TIME_KEY = 'compile_elapsed_seconds'
 
 RUSTLANG_TIMEOUT_SECONDS = 5
 RUSTLANG_COMPILE_ARGS = ['rustc']
@@ -133,6 +134,7 @@ class BaseGrader:
         self.temp_file_abs_path = os.path.join(SITE_ROOT, self.temp_file_name)
         self.read_input = None
         self.test_cases = []
+        self.compile_elapsed_seconds = None
 
     def grade_solution(self):
         """
@@ -163,6 +165,8 @@ class BaseGrader:
         elapsed_seconds = get_seconds_duration(grade_start_time, grade_end_time)
 
         overall_dict['elapsed_seconds'] = elapsed_seconds
+        if self.compile_elapsed_seconds is not None:
+            overall_dict[GRADER_COMPILE_TIME_KEY] = self.compile_elapsed_seconds
         return json.dumps(overall_dict)
 
     def find_tests(self) -> [os.DirEntry]:
@@ -292,7 +296,9 @@ class CompilableLangGrader(BaseGrader):
         print(f'# Found tests at {sorted_input_files} {sorted_output_files}')
         self.read_tests(sorted_input_files, sorted_output_files)
         print('# Compiling')
+        compile_start_time = datetime.now()
         self.compile()
+        self.compile_elapsed_seconds = get_seconds_duration(compile_start_time, datetime.now())
 
         if self.compiled:
             result = self.grade_all_tests()
@@ -300,7 +306,8 @@ class CompilableLangGrader(BaseGrader):
         else:
             print('# COULD NOT COMPILE')
             print(self.compile_error_message)
-            return json.dumps({GRADER_COMPILE_FAILURE: self.compile_error_message})
+            return json.dumps({GRADER_COMPILE_FAILURE: self.compile_error_message,
+                               GRADER_COMPILE_TIME_KEY: self.compile_elapsed_seconds})
 
     def compile(self):
         """
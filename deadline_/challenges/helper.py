@@ -67,7 +67,7 @@ def update_user_score(user: User, submission: Submission) -> bool:
         user_subcat_progress.save()
 
         user.score += score_improvement
-        user.save()
+        user.save(update_fields=['score'])
 
         # try to update the user's proficiency
         updated_proficiency = user_subcat_progress.try_update_proficiency()
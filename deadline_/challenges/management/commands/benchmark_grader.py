@@ -0,0 +1,223 @@
+"""
+Benchmarks the grader against the reference solutions in the repository's solutions/ folder
+    and the tests of their challenges in challenge_tests/.
+
+Every case is graded --runs times, either
+    - locally (--sandbox none): grader.py runs as a local process, in a temporary folder laid out like the container
+    - in the Docker sandbox (--sandbox docker): through run_grader, the way run_grader_task grades submissions
+and it reports the submission throughput, the per-test latency, the compile time and (locally) the peak memory.
+
+The results can be saved with --output and compared with a previous run (e.g of another commit) with --compare,
+    which flags every case which has become slower than --threshold percent
+"""
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from constants import (SITE_ROOT, TESTS_FOLDER_NAME, CHALLENGES_APP_FOLDER_NAME, GRADER_FILE_NAME, PYTHONLANG_NAME,
+                       CPPLANG_NAME, RUSTLANG_NAME, GRADER_COMPILE_FAILURE, GRADER_COMPILE_TIME_KEY,
+                       GRADER_TEST_RESULTS_RESULTS_KEY, GRADER_TEST_RESULT_SUCCESS_KEY, GRADER_TEST_RESULT_TIME_KEY)
+from challenges.tasks import LANGUAGE_GRADERS, run_grader
+from challenges.timing import GradingTimer
+
+SOLUTIONS_FOLDER = os.path.join(os.path.dirname(SITE_ROOT), 'solutions')
+LOCAL_SANDBOX, DOCKER_SANDBOX = 'none', 'docker'
+
+
+class BenchmarkCase:
+    def __init__(self, name: str, solution_path: str, language: str, test_folder_name: str):
+        self.name = name
+        self.solution_path = solution_path  # relative to the solutions folder
+        self.language = language
+        self.test_folder_name = test_folder_name  # relative to the challenge tests folder
+
+    @property
+    def test_case_count(self) -> int:
+        return len([file_name for file_name in os.listdir(os.path.join(SITE_ROOT, TESTS_FOLDER_NAME, self.test_folder_name))
+                    if file_name.startswith('input')])
+
+    def read_code(self) -> str:
+        with open(os.path.join(SOLUTIONS_FOLDER, self.solution_path)) as code_file:
+            return code_file.read()
+
+
+BENCHMARK_CASES = [
+    BenchmarkCase('lawnmower', 'lawnmower/lawn.py', PYTHONLANG_NAME, 'lawnmower_tests'),
+    BenchmarkCase('lawnmower_naive', 'lawnmower/lawn_naive.py', PYTHONLANG_NAME, 'lawnmower_tests'),
+    BenchmarkCase('lava_world_python', 'lava_world/python/lava_world.py', PYTHONLANG_NAME, 'lava_world_tests'),
+    BenchmarkCase('lava_world_cpp', 'lava_world/c++/lava_world.cpp', CPPLANG_NAME, 'lava_world_tests'),
+    BenchmarkCase('array_sum_python', 'array_sum/python/array_sum.py', PYTHONLANG_NAME, 'array_sum_tests'),
+    BenchmarkCase('array_sum_rust', 'array_sum/rust/main.rs', RUSTLANG_NAME, 'array_sum_tests'),
+    BenchmarkCase('array_amplitude', 'array_amplitude/python/array_amplitude.py', PYTHONLANG_NAME,
+                  'array_amplitude_tests'),
+    BenchmarkCase('basic_numbers', 'basic_numbers/python/basic_numbers.py', PYTHONLANG_NAME, 'basic_numbers_tests'),
+]
+
+
+def grade_locally(case: BenchmarkCase) -> (dict, float, int):
+    """
+    Runs grader.py the way the container does: from a folder with the solution as sol.{extension},
+        grader.py itself and the challenge's tests in a challenge_tests folder
+    :return: the grader's results, how long grading took and the peak memory of the grader or a solution, in KB
+    """
+    grader_class = LANGUAGE_GRADERS[case.language]
+    with tempfile.TemporaryDirectory() as sandbox_folder:
+        shutil.copy(os.path.join(SITE_ROOT, CHALLENGES_APP_FOLDER_NAME, GRADER_FILE_NAME), sandbox_folder)
+        shutil.copy(os.path.join(SOLUTIONS_FOLDER, case.solution_path),
+                    os.path.join(sandbox_folder, 'sol' + grader_class.FILE_EXTENSION))
+        shutil.copytree(os.path.join(SITE_ROOT, TESTS_FOLDER_NAME, case.test_folder_name),
+                        os.path.join(sandbox_folder, TESTS_FOLDER_NAME))
+
+        with tempfile.TemporaryFile() as error_file:
+            start = time.perf_counter()
+            grader_process = subprocess.Popen(
+                [sys.executable, GRADER_FILE_NAME, 'sol', str(case.test_case_count), case.language],
+                cwd=sandbox_folder, stdout=subprocess.PIPE, stderr=error_file)
+            output = grader_process.stdout.read().decode()
+            grader_process.stdout.close()
+            # wait4 gives the resource usage of the grader along with the solutions it ran
+            _, status, resource_usage = os.wait4(grader_process.pid, 0)
+            elapsed_seconds = time.perf_counter() - start
+            grader_process.returncode = os.WEXITSTATUS(status)
+
+            if grader_process.returncode != 0:
+                error_file.seek(0)
+                raise CommandError(f'The grader failed on {case.name}:\n{error_file.read().decode()}')
+
+    return json.loads(output.strip().split('\n')[-1]), elapsed_seconds, resource_usage.ru_maxrss
+
+
+def grade_in_docker(case: BenchmarkCase) -> (dict, float, int):
+    """ Grades the case just like a submission is, the peak memory is not measured """
+    start = time.perf_counter()
+    results = run_grader(case.test_case_count, case.test_folder_name, case.read_code(), case.language,
+                         timer=GradingTimer())
+    return results, time.perf_counter() - start, None
+
+
+def percentile(sorted_values: list, percent: float):
+    return sorted_values[max(int(round(len(sorted_values) * percent / 100)) - 1, 0)]
+
+
+def summarize(case: BenchmarkCase, runs: [(dict, float, int)]) -> dict:
+    submission_seconds = [elapsed_seconds for _, elapsed_seconds, _ in runs]
+    test_seconds = sorted(test_result[GRADER_TEST_RESULT_TIME_KEY]
+                          for results, _, _ in runs for test_result in results.get(GRADER_TEST_RESULTS_RESULTS_KEY, []))
+    compile_seconds = [results[GRADER_COMPILE_TIME_KEY] for results, _, _ in runs if GRADER_COMPILE_TIME_KEY in results]
+    peak_memory = [max_rss for _, _, max_rss in runs if max_rss is not None]
+    last_results = runs[-1][0]
+    return {
+        'language': case.language,
+        'runs': len(runs),
+        'compiled': GRADER_COMPILE_FAILURE not in last_results,
+        'passed_tests': sum(test_result[GRADER_TEST_RESULT_SUCCESS_KEY]
+                            for test_result in last_results.get(GRADER_TEST_RESULTS_RESULTS_KEY, [])),
+        'test_count': case.test_case_count,
+        'submission_median_seconds': statistics.median(submission_seconds),
+        'submission_max_seconds': max(submission_seconds),
+        'submissions_per_second': len(runs) / sum(submission_seconds),
+        'tests_per_second': len(test_seconds) / sum(submission_seconds),
+        'test_p50_seconds': percentile(test_seconds, 50) if test_seconds else None,
+        'test_p95_seconds': percentile(test_seconds, 95) if test_seconds else None,
+        'test_max_seconds': test_seconds[-1] if test_seconds else None,
+        'grading_median_seconds': statistics.median(results.get(GRADER_TEST_RESULT_TIME_KEY, 0)
+                                                    for results, _, _ in runs),
+        'compile_median_seconds': statistics.median(compile_seconds) if compile_seconds else None,
+        'peak_memory_kb': max(peak_memory) if peak_memory else None,
+    }
+
+
+def format_ms(seconds) -> str:
+    return '-' if seconds is None else f'{seconds * 1000:.1f}ms'
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=SITE_ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the grader against the reference solutions and their challenge tests'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sandbox', choices=(LOCAL_SANDBOX, DOCKER_SANDBOX), default=LOCAL_SANDBOX,
+                            help='Run grader.py as a local process or in the Docker container, like submissions are')
+        parser.add_argument('--runs', type=int, default=5, help='How many times to grade every case')
+        parser.add_argument('--warmup', type=int, default=1, help='Runs of every case which are not measured')
+        parser.add_argument('--case', action='append', choices=[case.name for case in BENCHMARK_CASES],
+                            help='Only benchmark the given cases, can be repeated')
+        parser.add_argument('--output', help='Save the results as JSON to this file')
+        parser.add_argument('--compare', help='Compare the results with ones saved by --output, e.g on another commit')
+        parser.add_argument('--threshold', type=float, default=10,
+                            help='By how many percent a case may become slower before it is flagged')
+
+    def handle(self, *args, **options):
+        grade = grade_locally if options['sandbox'] == LOCAL_SANDBOX else grade_in_docker
+        cases = [case for case in BENCHMARK_CASES if not options['case'] or case.name in options['case']]
+
+        summaries = {}
+        for case in cases:
+            try:
+                for _ in range(options['warmup']):
+                    grade(case)
+                runs = [grade(case) for _ in range(options['runs'])]
+            except Exception as e:
+                self.stderr.write(f'{case.name}: could not be graded due to {e}')
+                continue
+            summaries[case.name] = summarize(case, runs)
+            self.print_summary(case.name, summaries[case.name])
+
+        report = {'commit': get_commit(), 'sandbox': options['sandbox'], 'python': sys.version.split()[0],
+                  'cases': summaries}
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump(report, output_file, indent=2, sort_keys=True)
+            self.stdout.write(f'Saved the results to {options["output"]}')
+        if options['compare']:
+            with open(options['compare']) as previous_file:
+                self.compare(json.load(previous_file), report, options['threshold'])
+
+    def print_summary(self, name: str, summary: dict):
+        memory = '-' if summary['peak_memory_kb'] is None else f'{summary["peak_memory_kb"] / 1024:.1f}MB'
+        self.stdout.write(
+            f'{name} ({summary["language"]}): {summary["passed_tests"]}/{summary["test_count"]} tests passed, '
+            f'{summary["submissions_per_second"]:.2f} submissions/s, {summary["tests_per_second"]:.1f} tests/s, '
+            f'submission median {format_ms(summary["submission_median_seconds"])} '
+            f'max {format_ms(summary["submission_max_seconds"])}, '
+            f'test p50 {format_ms(summary["test_p50_seconds"])} p95 {format_ms(summary["test_p95_seconds"])} '
+            f'max {format_ms(summary["test_max_seconds"])}, '
+            f'compile {format_ms(summary["compile_median_seconds"])}, peak memory {memory}')
+
+    def compare(self, previous: dict, current: dict, threshold_percent: float):
+        if previous['sandbox'] != current['sandbox']:
+            self.stderr.write(f'The previous results were measured with the {previous["sandbox"]} sandbox, '
+                              f'they are not comparable')
+            return
+
+        self.stdout.write(f'Compared to {previous["commit"]}:')
+        regressions = 0
+        for name, summary in current['cases'].items():
+            previous_summary = previous['cases'].get(name)
+            if previous_summary is None:
+                continue
+            for key in ('submission_median_seconds', 'test_p95_seconds'):
+                if previous_summary.get(key) is None or summary[key] is None:
+                    continue
+                change_percent = (summary[key] - previous_summary[key]) / previous_summary[key] * 100
+                is_regression = change_percent > threshold_percent
+                regressions += is_regression
+                self.stdout.write(f'{"REGRESSION " if is_regression else ""}{name} {key}: '
+                                  f'{format_ms(previous_summary[key])} -> {format_ms(summary[key])} '
+                                  f'({change_percent:+.1f}%)')
+        if regressions:
+            raise CommandError(f'{regressions} measurements became more than {threshold_percent}% slower')
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2018-01-06 12:00
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('challenges', '0046_auto_20171221_2130'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submission',
+            name='timings',
+            field=django.contrib.postgres.fields.jsonb.JSONField(default=dict),
+        ),
+    ]
@@ -1,15 +1,22 @@
-from django.db import models
+import logging
+
+from django.db import models, transaction, IntegrityError
+from django.contrib.postgres.fields import JSONField
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
 from challenges.validators import PossibleFloatDigitValidator
 from accounts.models import User
+from constants import PROFICIENCY_BACKFILL_CHUNK_SIZE
+from response_cache import CACHE_VERSIONS, bump_versions_on_commit, model_version
 from sql_queries import (
     SUBMISSION_SELECT_TOP_SUBMISSIONS_FOR_CHALLENGE,
     SUBMISSION_SELECT_LAST_10_SUBMISSIONS_GROUPED_BY_CHALLENGE_BY_AUTHOR,
     SUBMISSION_SELECT_TOP_SUBMISSION_FOR_CHALLENGE_BY_USER)
 
+logger = logging.getLogger('challenges')
+
 
 class Language(models.Model):
     name = models.CharField(unique=True, max_length=30)
@@ -82,6 +89,7 @@ class Submission(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     timed_out = models.BooleanField(default=False)  # showing if the majority of the tests have timed out
     elapsed_seconds = models.FloatField(default=0)
+    timings = JSONField(default=dict)  # how long each grading stage took, see challenges.timing
 
     def get_absolute_url(self):
         return '/challenges/{}/submissions/{}'.format(self.challenge_id, self.id)
@@ -255,6 +263,11 @@ class Proficiency(models.Model):
         next_prof = Proficiency.objects.filter(needed_percentage__gt=self.needed_percentage).order_by('needed_percentage').first()
         return next_prof
 
+    @staticmethod
+    def fetch_starter_proficiency() -> 'Proficiency':
+        """ The proficiency every user starts a subcategory with """
+        return Proficiency.objects.filter(needed_percentage=0).first()
+
 
 class UserSolvedChallenges(models.Model):
     """ Holds challenges that a given user has fully solved """
@@ -262,6 +275,56 @@ class UserSolvedChallenges(models.Model):
     challenge = models.ForeignKey(Challenge, on_delete=models.CASCADE)
 
 
+class UserSubcategoryProficiencyManager(models.Manager):
+    def provision_for_user(self, user: User):
+        """
+        Creates the user's starter proficiency in every subcategory, in a single query
+        """
+        starter_proficiency = Proficiency.fetch_starter_proficiency()
+        self.bulk_create([self.model(user=user, subcategory_id=subcategory_id, proficiency=starter_proficiency,
+                                     user_score=0)
+                          for subcategory_id in SubCategory.objects.values_list('id', flat=True)])
+
+    def backfill_for_subcategory(self, subcategory_id: int, chunk_size=PROFICIENCY_BACKFILL_CHUNK_SIZE) -> int:
+        """
+        Creates the starter proficiency in the subcategory for every user who does not have one yet.
+        Users are provisioned chunk_size at a time, so that no query or transaction grows with the user count
+        :return: the number of created proficiencies
+        """
+        starter_proficiency = Proficiency.fetch_starter_proficiency()
+        created_count, last_user_id = 0, 0
+        while True:
+            user_ids = list(User.objects.filter(id__gt=last_user_id).order_by('id')
+                                        .values_list('id', flat=True)[:chunk_size])
+            if not user_ids:
+                return created_count
+
+            try:
+                created_count += self._provision_users(subcategory_id, user_ids, starter_proficiency)
+            except IntegrityError:
+                # one of them got his proficiency lazily in the meantime (see User.fetch_subcategory_proficiency)
+                created_count += self._provision_users(subcategory_id, user_ids, starter_proficiency)
+            last_user_id = user_ids[-1]
+
+    def _provision_users(self, subcategory_id: int, user_ids: [int], proficiency: 'Proficiency') -> int:
+        provisioned_user_ids = set(self.filter(subcategory_id=subcategory_id, user_id__in=user_ids)
+                                       .values_list('user_id', flat=True))
+        with transaction.atomic():
+            return len(self.bulk_create([self.model(user_id=user_id, subcategory_id=subcategory_id,
+                                                    proficiency=proficiency, user_score=0)
+                                         for user_id in user_ids if user_id not in provisioned_user_ids]))
+
+    def fetch_or_create(self, user_id: int, subcategory_id: int) -> 'UserSubcategoryProficiency':
+        """
+        Fetches the user's proficiency in the subcategory,
+            creating the starter one if the subcategory's backfill has not reached him yet
+        """
+        user_proficiency, _ = self.get_or_create(user_id=user_id, subcategory_id=subcategory_id,
+                                                 defaults={'proficiency': Proficiency.fetch_starter_proficiency,
+                                                           'user_score': 0})
+        return user_proficiency
+
+
 class UserSubcategoryProficiency(models.Model):
     """ Holds each user's proficiency in a given subcategory """
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -269,6 +332,7 @@ class UserSubcategoryProficiency(models.Model):
     proficiency = models.ForeignKey(Proficiency, on_delete=models.SET_NULL, null=True)
     user_score = models.IntegerField(default=0,
                                      verbose_name='The score that the user has accumulated for this subcategory')
+    objects = UserSubcategoryProficiencyManager()
 
     class Meta:
         unique_together = ('user', 'subcategory')
@@ -301,7 +365,7 @@ class UserSubcategoryProficiency(models.Model):
             prof_award = SubcategoryProficiencyAward.objects.filter(subcategory_id=self.subcategory.id, proficiency_id=next_prof.id).first()
             
             self.user.score += prof_award.xp_reward
-            self.user.save()
+            self.user.save(update_fields=['score'])
             self.save()
 
             # create a newsfeed post about the user's achievement
@@ -319,4 +383,53 @@ class SubcategoryProficiencyAward(models.Model):
     xp_reward = models.IntegerField()
 
     class Meta:
-        unique_together = ('subcategory', 'proficiency')
\ No newline at end of file
+        unique_together = ('subcategory', 'proficiency')
+
+
+@receiver(post_save, sender=SubCategory)
+def subcategory_post_save(sender, instance, created, *args, **kwargs):
+    """
+    Gives every existing user the starter proficiency in a new subcategory, in a background task.
+    Until the task reaches a user, his proficiency gets created the first time it is fetched
+    """
+    if not created:
+        return
+
+    def schedule_backfill():
+        from challenges.tasks import backfill_subcategory_proficiencies
+        try:
+            backfill_subcategory_proficiencies.delay(instance.id)
+        except Exception as e:
+            logger.error(f'Could not schedule the proficiency backfill of subcategory {instance.id} due to {e}')
+
+    transaction.on_commit(schedule_backfill)
+
+
+def _submission_vote_dependents(vote: SubmissionVote) -> [str]:
+    """ The vote counts are shown on the submission and its challenge's submission list """
+    challenge_ids = Submission.objects.filter(id=vote.submission_id).values_list('challenge_id', flat=True)
+    return [model_version(Submission, vote.submission_id)] + [f'challenge-submissions:{challenge_id}'
+                                                             for challenge_id in challenge_ids]
+
+
+# Saving or deleting these invalidates the cached responses (see response_cache.py) built from them
+CACHE_VERSIONS.register(Language)
+CACHE_VERSIONS.register(MainCategory)
+CACHE_VERSIONS.register(SubCategory)
+CACHE_VERSIONS.register(Challenge)
+CACHE_VERSIONS.register(ChallengeDescription, lambda description: [model_version(Challenge)])
+CACHE_VERSIONS.register(ChallengeComment, lambda comment: [model_version(Challenge, comment.challenge_id)])
+# a graded submission gets saved after its test cases, so this covers grading as well
+CACHE_VERSIONS.register(Submission, lambda submission: [f'challenge-submissions:{submission.challenge_id}',
+                                                        f'user:{submission.author_id}'])
+CACHE_VERSIONS.register(SubmissionVote, _submission_vote_dependents)
+CACHE_VERSIONS.register(UserSubcategoryProficiency, lambda proficiency: [f'user:{proficiency.user_id}'])
+CACHE_VERSIONS.register(UserSolvedChallenges, lambda solved_challenge: [f'user:{solved_challenge.user_id}'])
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, *args, update_fields=None, **kwargs):
+    """ Only the user scores are cached, so the frequent saves of other fields (e.g last_submit_at) are skipped """
+    if update_fields is None or 'score' in update_fields:
+        bump_versions_on_commit('user-scores')
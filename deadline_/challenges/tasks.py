@@ -4,18 +4,24 @@ import os
 import json
 import time
 
+from django.utils import timezone
+
 from accounts.models import User
 from challenges.models import Challenge, Submission
 from challenges.helper import convert_to_normal_text
 from constants import (MAX_TEST_RUN_SECONDS, PYTHONLANG_NAME, RUSTLANG_NAME, CPPLANG_NAME, DOCKER_CLIENT,
                        DOCKER_IMAGE_PATH, TESTS_FOLDER_NAME, SITE_ROOT, CHALLENGES_APP_FOLDER_NAME, GRADER_FILE_NAME,
                        GOLANG_NAME, KOTLIN_NAME, GRADER_COMPILE_FAILURE, GRADER_TEST_RESULTS_RESULTS_KEY,
-                       GRADER_TEST_RESULT_TIME_KEY, RUBY_NAME)
+                       GRADER_TEST_RESULT_TIME_KEY, RUBY_NAME, GRADER_COMPILE_TIME_KEY)
 from deadline.celery import app
 
 from challenges.grader import RustGrader, PythonGrader, CppGrader, BaseGrader, GoGrader, KotlinGrader, RubyGrader
-from challenges.models import Submission
+from challenges.models import Submission, UserSubcategoryProficiency
 from challenges.helper import delete_file, grade_result, update_user_info, update_test_cases
+from challenges.timing import (GradingTimer, QUEUED_STAGE, IMAGE_BUILD_STAGE, CONTAINER_START_STAGE,
+                               CONTAINER_RUN_STAGE, COMPILE_STAGE, TESTS_STAGE, SLOWEST_TEST_STAGE,
+                               RESULT_PARSING_STAGE, CONTAINER_CLEANUP_STAGE, TEST_CASE_PERSISTENCE_STAGE,
+                               SCORING_STAGE, USER_UPDATE_STAGE, TOTAL_STAGE)
 from social.models.notification import Notification
 
 LANGUAGE_GRADERS = {
@@ -44,13 +50,14 @@ def create_temp_file(code: str) -> (str, str):
     return temp_file_name, os.path.join(SITE_ROOT, temp_file_name)
 
 
-def run_grader(test_case_count, test_folder_name, code, lang) -> dict:
+def run_grader(test_case_count, test_folder_name, code, lang, timer: GradingTimer=None) -> dict:
     """
     Given
         :param test_case_count: The number of test cases for the challenge
         :param test_folder_name: The folder where said test cases reside
         :param code: The solution's code
         :param lang: The language the solution's code is in
+        :param timer: records how long each stage took, including the ones measured in the container
     builds a Docker image, copies over relevant information so that the image can run grader.py and
     actually grade the solution and returns the results
     :return:
@@ -58,7 +65,9 @@ def run_grader(test_case_count, test_folder_name, code, lang) -> dict:
     if lang not in LANGUAGE_GRADERS:
         raise Exception(f'{lang} is not a supported language!')
 
-    docker_image = DOCKER_CLIENT.images.build(path=DOCKER_IMAGE_PATH)
+    timer = timer or GradingTimer()
+    with timer.stage(IMAGE_BUILD_STAGE):
+        docker_image = DOCKER_CLIENT.images.build(path=DOCKER_IMAGE_PATH)
     grader: BaseGrader = LANGUAGE_GRADERS[lang]
 
     temp_file_name, temp_file_abs_path = create_temp_file(code)  # creates a temp file with the code in it
@@ -79,26 +88,41 @@ def run_grader(test_case_count, test_folder_name, code, lang) -> dict:
         # select the image and run grader.py in it with the arguments {solution path} {test case count} {language}
         f" {docker_image.id} python {destination_grader_abs_path} sol {test_case_count} {lang}")
 
-    docker_id_ps_res: tuple = subprocess.Popen(docker_command.split(),
-                                               stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
+    with timer.stage(CONTAINER_START_STAGE):
+        docker_id_ps_res: tuple = subprocess.Popen(docker_command.split(),
+                                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
 
     if docker_id_ps_res[1] != b'':
         raise Exception(f'Error while running the container: {docker_id_ps_res[1]}')
 
     docker_id = docker_id_ps_res[0].decode()
 
-    process_results: tuple = subprocess.Popen(  # attach to the container and read the results
-        f'docker attach --sig-proxy=false {docker_id}'.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
+    with timer.stage(CONTAINER_RUN_STAGE):
+        process_results: tuple = subprocess.Popen(  # attach to the container and read the results
+            f'docker attach --sig-proxy=false {docker_id}'.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
     if process_results[1] != b'':
         raise Exception(f'Error while attaching to docker container {docker_id}.\n{process_results[1].decode()}')
 
-    results: str = process_results[0].decode().split('\n')[-2]
+    with timer.stage(RESULT_PARSING_STAGE):
+        results: str = process_results[0].decode().split('\n')[-2]
 
     # remove the docker container and the file with code
-    subprocess.Popen(f'docker rm -f {docker_id}'.split()).communicate()
-    delete_file(temp_file_name)
+    with timer.stage(CONTAINER_CLEANUP_STAGE):
+        subprocess.Popen(f'docker rm -f {docker_id}'.split()).communicate()
+        delete_file(temp_file_name)
+
+    with timer.stage(RESULT_PARSING_STAGE):
+        grade_results: dict = json.loads(results)
+
+    # the stages which ran in the container
+    timer.record(COMPILE_STAGE, grade_results.get(GRADER_COMPILE_TIME_KEY))
+    timer.record(TESTS_STAGE, grade_results.get(GRADER_TEST_RESULT_TIME_KEY))
+    test_seconds = [test_result[GRADER_TEST_RESULT_TIME_KEY]
+                    for test_result in grade_results.get(GRADER_TEST_RESULTS_RESULTS_KEY, [])]
+    if test_seconds:
+        timer.record(SLOWEST_TEST_STAGE, max(test_seconds))
 
-    return json.loads(results)
+    return grade_results
 
 
 @app.task
@@ -107,9 +131,14 @@ def run_grader_task(test_case_count: int, test_folder_name: str, code: str, lang
     Runs a celery task for the grader, after which save the result to the DB
     Note: The Grader runs in Docker and prints out the results in a JSON format at the end.
           That is why we get them by accessing [-2] from the stdout output
+    The time every stage took is saved in the Submission's timings and observed in the grading metrics
     """
-    submission_grade_result: dict = run_grader(test_case_count, test_folder_name, code, lang)
+    task_start = time.perf_counter()
+    timer = GradingTimer()
     submission = Submission.objects.get(id=submission_id)
+    timer.record(QUEUED_STAGE, (timezone.now() - submission.created_at).total_seconds())
+
+    submission_grade_result: dict = run_grader(test_case_count, test_folder_name, code, lang, timer=timer)
 
     if GRADER_COMPILE_FAILURE in submission_grade_result:
         # Compiling the code has failed
@@ -119,12 +148,20 @@ def run_grader_task(test_case_count: int, test_folder_name: str, code: str, lang
         submission.save()
     else:
         # Update the Submission's TestCases
-        timed_out_percentage = update_test_cases(grader_results=submission_grade_result[GRADER_TEST_RESULTS_RESULTS_KEY],
-                                    test_cases=submission.testcase_set.all())
+        with timer.stage(TEST_CASE_PERSISTENCE_STAGE):
+            timed_out_percentage = update_test_cases(grader_results=submission_grade_result[GRADER_TEST_RESULTS_RESULTS_KEY],
+                                        test_cases=submission.testcase_set.all())
         # update the submission
-        grade_result(submission, timed_out_percentage, submission_grade_result[GRADER_TEST_RESULT_TIME_KEY])
+        with timer.stage(SCORING_STAGE):
+            grade_result(submission, timed_out_percentage, submission_grade_result[GRADER_TEST_RESULT_TIME_KEY])
+
+        with timer.stage(USER_UPDATE_STAGE):
+            update_user_info(submission=submission)
 
-        update_user_info(submission=submission)
+    timer.record(TOTAL_STAGE, time.perf_counter() - task_start)
+    submission.timings = timer.as_dict()
+    submission.save(update_fields=['timings'])
+    timer.observe(language=lang, challenge_id=submission.challenge_id)
 
 
 @app.task
@@ -135,3 +172,11 @@ def notify_users_for_new_challenge(new_challenge):
 
     for user in User.objects.all():
         Notification.objects.create_new_challenge_notification(recipient=user, challenge=new_challenge)
+
+
+@app.task
+def backfill_subcategory_proficiencies(subcategory_id: int):
+    """
+    Gives every user who does not have a proficiency in the (new) subcategory the starter one
+    """
+    UserSubcategoryProficiency.objects.backfill_for_subcategory(subcategory_id)
@@ -21,3 +21,37 @@ def get_mock_function_arguments(mock_fn) -> []:
     args, kwargs = mock_fn.call_args
     argument_values = list(args) + list(kwargs.values())
     return argument_values
+
+
+def run_async(coroutine):
+    """
+    Runs the coroutine to completion on a fresh event loop and returns its result
+    """
+    import asyncio
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+async def run_inline(func, *args, **kwargs):
+    """
+    A replacement for async_helpers.run_in_db_thread, which calls the function in the current thread.
+    Needed in tests, as the DB threads use other connections and would not see the test transaction's data
+    """
+    return func(*args, **kwargs)
+
+
+def coroutine_mock(return_value=None, side_effect=None):
+    """
+    Returns a coroutine function which records its calls in a MagicMock, accessible through its `mock` attribute.
+    This is needed since a MagicMock cannot be awaited
+    """
+    from unittest.mock import MagicMock
+    call_mock = MagicMock(return_value=return_value, side_effect=side_effect)
+
+    async def _coroutine(*args, **kwargs):
+        return call_mock(*args, **kwargs)
+    _coroutine.mock = call_mock
+    return _coroutine
@@ -139,3 +139,60 @@ class UserSubcategoryProficiencyModelTest(TestCase):
 
     def test_proficiency_user_score_update_is_incremented_on_multiple_different_challenge_submissions(self):
         raise NotImplementedError()
+
+
+class UserSubcategoryProficiencyProvisioningTests(TestCase):
+    def setUp(self):
+        self.main_category = MainCategory.objects.create(name='Tank')
+        self.sub1 = SubCategory.objects.create(name='Unit', meta_category=self.main_category)
+        self.sub2 = SubCategory.objects.create(name='Integration', meta_category=self.main_category)
+        self.starter_prof = Proficiency.objects.create(name='starter', needed_percentage=0)
+
+    def test_new_user_gets_starter_proficiency_in_every_subcategory(self):
+        user = UserFactory()
+
+        user_proficiencies = UserSubcategoryProficiency.objects.filter(user=user)
+        self.assertEqual({usp.subcategory_id for usp in user_proficiencies}, {self.sub1.id, self.sub2.id})
+        self.assertTrue(all(usp.proficiency == self.starter_prof for usp in user_proficiencies))
+
+    def test_backfill_provisions_every_user_missing_a_proficiency(self):
+        users = [UserFactory() for _ in range(5)]
+        with patch('challenges.models.transaction.on_commit'):
+            new_subcategory = SubCategory.objects.create(name='Functional', meta_category=self.main_category)
+        UserSubcategoryProficiency.objects.create(user=users[0], subcategory=new_subcategory,
+                                                  proficiency=self.starter_prof, user_score=10)
+
+        created_count = UserSubcategoryProficiency.objects.backfill_for_subcategory(new_subcategory.id, chunk_size=2)
+
+        self.assertEqual(created_count, 4)
+        self.assertEqual(UserSubcategoryProficiency.objects.filter(subcategory=new_subcategory).count(), 5)
+        self.assertEqual(UserSubcategoryProficiency.objects.get(user=users[0], subcategory=new_subcategory).user_score,
+                         10)
+        self.assertEqual(UserSubcategoryProficiency.objects.backfill_for_subcategory(new_subcategory.id), 0)
+
+    @patch('challenges.tasks.backfill_subcategory_proficiencies.delay')
+    @patch('challenges.models.transaction.on_commit')
+    def test_new_subcategory_schedules_backfill_once_committed(self, mock_on_commit, mock_delay):
+        new_subcategory = SubCategory.objects.create(name='Functional', meta_category=self.main_category)
+        mock_delay.assert_not_called()
+
+        schedule_backfill = mock_on_commit.call_args[0][0]
+        schedule_backfill()
+        mock_delay.assert_called_once_with(new_subcategory.id)
+
+    def test_fetch_subcategory_proficiency_creates_missing_proficiency(self):
+        user = UserFactory()
+        with patch('challenges.models.transaction.on_commit'):
+            new_subcategory = SubCategory.objects.create(name='Functional', meta_category=self.main_category)
+
+        user_proficiency = user.fetch_subcategory_proficiency(new_subcategory.id)
+
+        self.assertEqual(user_proficiency.user, user)
+        self.assertEqual(user_proficiency.proficiency, self.starter_prof)
+        self.assertEqual(user.fetch_subcategory_proficiency(new_subcategory.id), user_proficiency)
+
+    def test_fetch_subcategory_proficiency_returns_the_users_own(self):
+        first_user, second_user = UserFactory(), UserFactory()
+
+        self.assertEqual(first_user.fetch_subcategory_proficiency(self.sub1.id).user, first_user)
+        self.assertEqual(second_user.fetch_subcategory_proficiency(self.sub1.id).user, second_user)
@@ -5,6 +5,9 @@ from challenges.tests.helpers import get_mock_function_arguments
 from challenges.tasks import run_grader_task, GRADER_COMPILE_FAILURE, GRADER_TEST_RESULTS_RESULTS_KEY, GRADER_TEST_RESULT_TIME_KEY, notify_users_for_new_challenge
 from challenges.tests.factories import SubmissionFactory, UserFactory
 from challenges.models import Proficiency
+from challenges.timing import (COMPILE_STAGE, QUEUED_STAGE, TEST_CASE_PERSISTENCE_STAGE, SCORING_STAGE,
+                               USER_UPDATE_STAGE, TOTAL_STAGE)
+from metrics import REGISTRY
 
 
 class TasksTests(TestCase):
@@ -33,7 +36,7 @@ class TasksTests(TestCase):
 
         # since the run_grader has returned a submission that has compiled, we should update the test case objects,
         # the submission score and user score
-        mock_run_grader.assert_called_once_with(test_case_count, test_folder_name, code, lang)
+        mock_run_grader.assert_called_once_with(test_case_count, test_folder_name, code, lang, timer=mock.ANY)
         mock_update_test_cases.assert_called()
         self.assertIn('batman', get_mock_function_arguments(mock_update_test_cases)) # grade results in the update_test_cases
         mock_grade_result.assert_called_once_with(submission, mock_update_test_cases.return_value, 155)
@@ -62,6 +65,28 @@ class TasksTests(TestCase):
         self.assertFalse(submission.pending)
         self.assertEqual(submission.compile_error_message, "FAILED MISERABLY")
 
+    @patch('challenges.tasks.update_test_cases')
+    @patch('challenges.tasks.grade_result')
+    @patch('challenges.tasks.update_user_info')
+    @patch('challenges.tasks.run_grader')
+    def test_run_grader_task_saves_stage_timings(self, mock_run_grader, mock_update_user_info, mock_grade_result, mock_update_test_cases):
+        def run_grader(*args, timer):
+            timer.record(COMPILE_STAGE, 1.5)
+            return {GRADER_TEST_RESULTS_RESULTS_KEY: 'batman', GRADER_TEST_RESULT_TIME_KEY: 155}
+        mock_run_grader.side_effect = run_grader
+        mock_update_test_cases.return_value = 0
+        submission = SubmissionFactory(author=UserFactory())
+
+        run_grader_task(test_case_count=5, test_folder_name='/tank/', code='print("hello world")', lang='python3',
+                        submission_id=submission.id)
+
+        submission.refresh_from_db()
+        self.assertEqual(submission.timings[COMPILE_STAGE], 1.5)
+        for stage in (QUEUED_STAGE, TEST_CASE_PERSISTENCE_STAGE, SCORING_STAGE, USER_UPDATE_STAGE, TOTAL_STAGE):
+            self.assertIn(stage, submission.timings)
+        self.assertIn('grading_stage_seconds_count{stage="total",language="python3",challenge="%s"}' % submission.challenge_id,
+                      REGISTRY.render())
+
     @patch('challenges.tasks.Notification.objects.create_new_challenge_notification')
     def test_creates_a_notification_for_every_user(self, mock_create_notif):
         # create 11 users
@@ -0,0 +1,31 @@
+from unittest import TestCase
+
+from challenges.timing import GradingTimer, RESULT_PARSING_STAGE, COMPILE_STAGE, GRADING_STAGE_SECONDS
+
+
+class GradingTimerTests(TestCase):
+    def test_stage_records_its_duration(self):
+        timer = GradingTimer()
+
+        with timer.stage(RESULT_PARSING_STAGE):
+            pass
+
+        self.assertIn(RESULT_PARSING_STAGE, timer.as_dict())
+        self.assertGreaterEqual(timer.as_dict()[RESULT_PARSING_STAGE], 0)
+
+    def test_record_accumulates_and_skips_missing_stages(self):
+        timer = GradingTimer()
+
+        timer.record(COMPILE_STAGE, 1.25)
+        timer.record(COMPILE_STAGE, 0.5)
+        timer.record(RESULT_PARSING_STAGE, None)  # e.g an interpreted language does not compile
+
+        self.assertEqual(timer.as_dict(), {COMPILE_STAGE: 1.75})
+
+    def test_observe_labels_the_stages(self):
+        timer = GradingTimer()
+        timer.record(COMPILE_STAGE, 2)
+
+        timer.observe(language='C++', challenge_id=987)
+
+        self.assertEqual(GRADING_STAGE_SECONDS.labels(stage=COMPILE_STAGE, language='C++', challenge=987).count, 1)
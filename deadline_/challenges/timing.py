@@ -0,0 +1,53 @@
+"""
+Timing of the stages a submission goes through while being graded (see run_grader_task)
+"""
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from metrics import REGISTRY
+
+GRADING_STAGE_SECONDS = REGISTRY.histogram('grading_stage_seconds', 'Time spent in a stage of grading a submission',
+                                           labels=('stage', 'language', 'challenge'))
+
+# The stages, in the order they run
+QUEUED_STAGE = 'queued'  # from the submission's creation until a worker picked it up
+IMAGE_BUILD_STAGE = 'image_build'
+CONTAINER_START_STAGE = 'container_start'
+CONTAINER_RUN_STAGE = 'container_run'  # everything done in the container, which includes compile and tests
+COMPILE_STAGE = 'compile'  # measured by the grader in the container
+TESTS_STAGE = 'tests'  # measured by the grader in the container
+SLOWEST_TEST_STAGE = 'slowest_test'
+RESULT_PARSING_STAGE = 'result_parsing'
+CONTAINER_CLEANUP_STAGE = 'container_cleanup'
+TEST_CASE_PERSISTENCE_STAGE = 'test_case_persistence'
+SCORING_STAGE = 'scoring'
+USER_UPDATE_STAGE = 'user_update'  # the user's score, solved challenges and proficiency
+TOTAL_STAGE = 'total'  # from the worker picking the submission up until it is done
+
+
+class GradingTimer:
+    """ Collects how long each stage of grading a submission took, in seconds """
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, seconds: float):
+        """ A stage which runs more than once accumulates its time """
+        if seconds is None:
+            return
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def as_dict(self) -> dict:
+        return OrderedDict((name, round(seconds, 4)) for name, seconds in self.stages.items())
+
+    def observe(self, language: str, challenge_id: int):
+        for name, seconds in self.stages.items():
+            GRADING_STAGE_SECONDS.labels(stage=name, language=language, challenge=challenge_id).observe(seconds)
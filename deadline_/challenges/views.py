@@ -9,7 +9,7 @@ from rest_framework.generics import RetrieveAPIView, ListAPIView, CreateAPIView
 from rest_framework.permissions import IsAuthenticated
 
 from accounts.models import User
-from constants import MIN_SUBMISSION_INTERVAL_SECONDS
+from constants import MIN_SUBMISSION_INTERVAL_SECONDS, VERSIONED_RESPONSE_CACHE_SECONDS
 
 from challenges.models import Challenge, Submission, TestCase, MainCategory, SubCategory, Language, SubmissionVote, \
     SubmissionComment, ChallengeComment
@@ -18,6 +18,8 @@ from challenges.serializers import ChallengeSerializer, SubmissionSerializer, Te
     LimitedSubmissionSerializer, SubmissionCommentSerializer, ChallengeCommentSerializer, LimitedSubCategorySerializer
 from challenges.tasks import run_grader_task
 from decorators import fetch_models
+from request_metrics import query_budget
+from response_cache import cache_response, model_version
 from views import BaseManageView
 
 # TODO: Fix URLs to be more RESTful
@@ -30,11 +32,19 @@ class ChallengeDetailView(RetrieveAPIView):
     serializer_class = ChallengeSerializer
     permission_classes = (IsAuthenticated, )
 
+    # the comments show their authors' scores
+    @cache_response(timeout=VERSIONED_RESPONSE_CACHE_SECONDS, per_user=False,
+                    versions=(model_version(Challenge), model_version(Challenge, '{pk}'), model_version(SubCategory),
+                              model_version(Language), 'user-scores'))
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
 
 # POST /challenges/{challenge_id}/comments
 class ChallengeCommentCreateView(APIView):
     permission_classes = (IsAuthenticated, )
     model_classes = (Challenge, )
+    model_only = {Challenge: ('id', )}
 
     @fetch_models
     def post(self, request, challenge: Challenge, *args, **kwargs):
@@ -52,6 +62,8 @@ class ChallengeCommentCreateView(APIView):
 class ChallengeCommentReplyCreateView(APIView):
     permission_classes = (IsAuthenticated, )
     model_classes = (Challenge, ChallengeComment)
+    model_only = {Challenge: ('id', )}
+    model_select_related = {ChallengeComment: ('author', )}
 
     @fetch_models
     def post(self, request, challenge: Challenge, challenge_comment: ChallengeComment, *args, **kwargs):
@@ -87,6 +99,7 @@ class LatestAttemptedChallengesListView(ListAPIView):
     serializer_class = LimitedChallengeSerializer
     permission_classes = (IsAuthenticated, )
 
+    @cache_response(timeout=60, versions=(model_version(Challenge), model_version(SubCategory), 'user:{user_id}'))
     def list(self, request, *args, **kwargs):
         latest_submissions = Submission.fetch_last_10_submissions_for_unique_challenges_by_user(
             user_id=request.user.id)
@@ -102,6 +115,11 @@ class MainCategoryListView(ListAPIView):
     serializer_class = MainCategorySerializer
     queryset = MainCategory.objects.all()
 
+    @cache_response(timeout=VERSIONED_RESPONSE_CACHE_SECONDS, per_user=False,
+                    versions=(model_version(MainCategory), model_version(SubCategory)))
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
 
 # /challenges/categories/{category_id/name}/subcategories
 class CategorySubcategoriesListView(APIView):
@@ -114,6 +132,9 @@ class CategorySubcategoriesListView(APIView):
     """
     permission_classes = (IsAuthenticated, )
 
+    @cache_response(timeout=VERSIONED_RESPONSE_CACHE_SECONDS,
+                    versions=(model_version(MainCategory), model_version(SubCategory), model_version(Challenge),
+                              'user:{user_id}'))
     def get(self, request, *args, **kwargs):
         category_pk = kwargs.get('category_pk', None)
         try:
@@ -138,6 +159,11 @@ class SubCategoryDetailView(RetrieveAPIView):
     permission_classes = (IsAuthenticated, )
     lookup_field = 'name'
 
+    @cache_response(timeout=VERSIONED_RESPONSE_CACHE_SECONDS,
+                    versions=(model_version(SubCategory), model_version(Challenge), 'user:{user_id}'))
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
 
 # /challenges/{challenge_id}/submissions/new
 class SubmissionCreateView(CreateAPIView):
@@ -163,7 +189,8 @@ class SubmissionCreateView(CreateAPIView):
                                             code=code_given, lang=language.name, submission_id=submission.id)
 
         request.user.last_submit_at = timezone.now()
-        request.user.save()
+        # request.user may be a cached snapshot (see accounts.authentication), so do not overwrite the other fields
+        request.user.save(update_fields=['last_submit_at'])
 
         submission.task_id = celery_task
         submission.save()
@@ -200,7 +227,9 @@ class SubmissionCreateView(CreateAPIView):
 
         # Check for time between submissions
         time_now = timezone.make_aware(datetime.now(), timezone.utc)
-        time_since_last_submission = time_now - user.last_submit_at
+        # read from the DB, as the cached request.user of this process misses submissions made through other processes
+        last_submit_at = User.objects.values_list('last_submit_at', flat=True).get(id=user.id)
+        time_since_last_submission = time_now - last_submit_at
         if time_since_last_submission.seconds < MIN_SUBMISSION_INTERVAL_SECONDS:
             resp = Response(data={'error': f'You must wait {MIN_SUBMISSION_INTERVAL_SECONDS} more seconds before submitting a solution.'}, status=400)
             return None, None, False, resp
@@ -263,6 +292,7 @@ class SubmissionListView(ListAPIView):
     serializer_class = LimitedSubmissionSerializer
     permission_classes = (IsAuthenticated,)
 
+    @cache_response(timeout=20, versions=('challenge-submissions:{challenge_pk}', 'user:{user_id}'))
     def list(self, request, *args, **kwargs):
         challenge_pk = kwargs.get('challenge_pk')
         return Response(data=LimitedSubmissionSerializer(Submission.objects
@@ -275,6 +305,8 @@ class SubmissionListView(ListAPIView):
 class SubmissionCommentCreateView(APIView):
     permission_classes = (IsAuthenticated, )
     model_classes = (Challenge, Submission)
+    model_only = {Challenge: ('id', 'name')}  # the notification holds its name
+    model_select_related = {Submission: ('author', )}
 
     @fetch_models
     def post(self, request, challenge: Challenge, submission: Submission, *args, **kwargs):
@@ -304,6 +336,8 @@ class SubmissionCommentReplyCreateView(CreateAPIView):
     permission_classes = (IsAuthenticated, )
     serializer_class = SubmissionCommentSerializer
     model_classes = (Challenge, Submission, SubmissionComment)
+    model_only = {Challenge: ('id', 'name')}  # the notification holds its name
+    model_select_related = {SubmissionComment: ('author', )}
 
     @fetch_models
     def post(self, request, challenge: Challenge, submission: Submission, submission_comment: SubmissionComment,
@@ -466,17 +500,23 @@ class LanguageDetailView(RetrieveAPIView):
     permission_classes = (IsAuthenticated, )
     lookup_field = 'name'
 
+    @cache_response(timeout=VERSIONED_RESPONSE_CACHE_SECONDS, versions=(model_version(Language), ), per_user=False)
     def retrieve(self, request, *args, **kwargs):
         self.kwargs['name'] = kwargs.get('name', '').capitalize()
         return super().retrieve(request, *args, **kwargs)
 
 
 # GET /challenges/languages
+@query_budget(3)
 class LanguageListView(ListAPIView):
     queryset = Language.objects.all()
     serializer_class = LanguageSerializer
     permission_classes = (IsAuthenticated, )
 
+    @cache_response(timeout=VERSIONED_RESPONSE_CACHE_SECONDS, versions=(model_version(Language), ), per_user=False)
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
 
 # /challenges/{challenge_id}/submissions/{submission_id}/test/{testcase_id}
 class TestCaseDetailView(RetrieveAPIView):
@@ -485,6 +525,7 @@ class TestCaseDetailView(RetrieveAPIView):
     serializer_class = TestCaseSerializer
     permission_classes = (IsAuthenticated, )
 
+    @cache_response(timeout=60*60, versions=(model_version(Submission, '{submission_pk}'), ), per_user=False)
     def retrieve(self, request, *args, **kwargs):
         # Validate the challenge and submission id
         test_case_pk = kwargs.get('pk')
@@ -518,6 +559,7 @@ class TestCaseListView(ListAPIView):
                                            challenge=Challenge.objects.filter(id=challenge_pk).first())
                                        .first())
 
+    @cache_response(timeout=60, versions=(model_version(Submission, '{submission_pk}'), ), per_user=False)
     def list(self, request, *args, **kwargs):
         response = super().list(request, *args, **kwargs)
 
@@ -530,6 +572,7 @@ class TestCaseListView(ListAPIView):
         return response
 
 
+@query_budget(3)
 class GetLeaderboardView(APIView):
     """
     Returns the overall leaderboard, returning a list of objects containing the user's name and position
@@ -546,6 +589,7 @@ class GetLeaderboardView(APIView):
         }
     ]
     """
+    @cache_response(timeout=30, versions=('user-scores', ), per_user=False)
     def get(self, request, *args, **kwargs):
         # Iterate through all the users and attach their position
         # This will be incredibly slow
@@ -1,6 +1,8 @@
 import os.path
-import docker
-DOCKER_CLIENT = docker.from_env()
+
+from external_services import LazyServiceHandle, create_docker_client
+
+DOCKER_CLIENT = LazyServiceHandle('Docker', create_docker_client)  # connects on first use
 ROOT_PATH = os.path.dirname(os.path.abspath(__file__))  # this is where the constants.py file should be
 DOCKER_IMAGE_PATH = ROOT_PATH
 SITE_ROOT = os.path.dirname(os.path.realpath(__file__))
@@ -12,6 +14,10 @@ CHALLENGES_APP_FOLDER_NAME = 'challenges'
 GRADER_FILE_NAME = 'grader.py'  # the file which is sent over to the docker container and executed there
 
 BASE_USER_ROLE_NAME = 'User'
+PROFICIENCY_BACKFILL_CHUNK_SIZE = 1000  # how many users get a new subcategory's proficiency at once
+# how long responses built only from versioned models (see response_cache.CACHE_VERSIONS) are cached,
+#   when the response cache is shared by every process (see response_cache.get_timeout)
+VERSIONED_RESPONSE_CACHE_SECONDS = 24 * 60 * 60
 
 RUSTLANG_NAME = 'Rust'
 PYTHONLANG_NAME = 'Python'
@@ -30,6 +36,7 @@ GRADER_TEST_RESULT_DESCRIPTION_KEY = 'description'
 GRADER_TEST_RESULT_TRACEBACK_KEY = 'traceback'
 GRADER_TEST_RESULT_ERROR_MESSAGE_KEY = 'error_message'
 GRADER_COMPILE_FAILURE = 'COMPILATION FAILED'
+GRADER_COMPILE_TIME_KEY = 'compile_elapsed_seconds'
 GRADER_TEST_RESULT_TIMED_OUT_KEY = 'timed_out'
 
 RUSTLANG_TIMEOUT_SECONDS = 5
@@ -1,8 +1,8 @@
 from __future__ import absolute_import, unicode_literals
+import logging
 import os
 from celery import Celery
-
-from deadline.settings import RABBITMQ_CLIENT
+from celery.signals import worker_process_init
 
 # set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'deadline.settings')
@@ -19,14 +19,33 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
 
 
+@worker_process_init.connect
+def serve_worker_metrics(*args, **kwargs):
+    """
+    Every worker process has its own metrics (e.g the grading stage timings),
+        so each one serves them on GRADER_METRICS_PORT plus its index in the pool
+    """
+    from billiard.process import current_process
+    from django.conf import settings
+    from metrics import serve_metrics_in_thread
+
+    port = settings.GRADER_METRICS_PORT + (current_process().index or 0)
+    try:
+        serve_metrics_in_thread(settings.GRADER_METRICS_HOST, port)
+    except OSError as e:
+        logging.getLogger('metrics').warning(f'Could not serve the worker metrics on port {port} due to {e}')
+
+
+@worker_process_init.connect
+def reset_service_clients(*args, **kwargs):
+    """ A prefork worker process opens its own connections, even if the parent used a client before forking """
+    from django.conf import settings
+    from constants import DOCKER_CLIENT
+
+    DOCKER_CLIENT.reset()
+    settings.RABBITMQ_CLIENT.reset()
+
+
 @app.task(bind=True)
 def debug_task(self):
     print('Request: {0!r}'.format(self.request))
-
-
-@app.task
-def send_notification(notification_id):
-    """
-    A task to asynchronously send a notification message to RabbitMQ
-    """
-    RABBITMQ_CLIENT.send_notification_message(notification_id)
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.10/ref/settings/
 """
 
 import os
+import socket
 import sys
 
 from os.path import join, dirname
@@ -93,21 +94,47 @@ if 'test' in sys.argv:
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',  # Need to use HTTPS otherwise not secure
+        'accounts.authentication.CachedTokenAuthentication',  # Need to use HTTPS otherwise not secure
     )
 }
 
+# What an auth token resolves to (its user and role) is cached per process, see accounts.authentication
+# A user or role change made by another process reaches this one's cache after at most AUTH_TOKEN_CACHE_SECONDS.
+# A revoked (logged out or rotated) token is rejected by every process right away, as long as they share the cache,
+#   see MEMCACHED_LOCATION below. With the default per-process cache, the other processes accept it for up to that long
+AUTH_TOKEN_CACHE_SECONDS = 30
+AUTH_TOKEN_CACHE_SIZE = 10000
+if 'test' in sys.argv:
+    # tests update users behind the ORM's back (e.g QuerySet.update()), the cache's own tests enable it
+    AUTH_TOKEN_CACHE_SECONDS = 0
+
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
     }
 }
+if os.environ.get('MEMCACHED_LOCATION'):
+    # a cache shared by every web and celery worker, so that a change invalidates the cached responses everywhere
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': os.environ['MEMCACHED_LOCATION'],
+    }
 
 if 'test' in sys.argv:
     CACHES['default'] = {'BACKEND': 'django.core.cache.backends.dummy.DummyCache',}
 
+RESPONSE_CACHE_ALIAS = 'default'  # the cache of the view responses, see response_cache.py
+# Whether every web and celery worker uses the same response cache. Otherwise version bumps made by other processes
+#   (e.g grading in celery) never reach a process's cached responses, so they are cached for a few seconds at most
+RESPONSE_CACHE_IS_SHARED = bool(os.environ.get('MEMCACHED_LOCATION'))
+UNSHARED_RESPONSE_CACHE_MAX_SECONDS = 5
+
+# A request exceeding its view's query budget (see request_metrics.query_budget) logs a warning, or fails in tests
+QUERY_BUDGETS_ENFORCED = 'test' in sys.argv
+METRICS_ALLOWED_IPS = ['127.0.0.1']  # who may scrape /metrics
+
 MIDDLEWARE = [
-    'django.middleware.cache.UpdateCacheMiddleware',
+    'request_metrics.RequestMetricsMiddleware',  # first, so that it measures the rest as well
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -116,19 +143,25 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'django.middleware.cache.FetchFromCacheMiddleware',
 ]
 
-CACHE_MIDDLEWARE_ALIAS = 'default'
-CACHE_MIDDLEWARE_SECONDS = 5
-CACHE_MIDDLEWARE_KEY_PREFIX = ''
-
 CHAT_WS_SERVER_HOST = 'localhost'
 CHAT_WS_SERVER_PORT = 5002
 
 NOTIFICATIONS_WS_SERVER_HOST = 'localhost'
 NOTIFICATIONS_WS_SERVER_PORT = 6002
 
+# The websocket servers expose their metrics (event loop lag, queue depths, etc) over HTTP on these ports
+CHAT_METRICS_PORT = 5003
+NOTIFICATIONS_METRICS_PORT = 6003
+# Every celery worker process serves its metrics (grading stage timings) on this port plus its index in the pool
+GRADER_METRICS_HOST = 'localhost'
+GRADER_METRICS_PORT = 7003
+# Identifies this notification server node (its queue and presence), every node needs a unique one
+NOTIFICATIONS_NODE_ID = os.environ.get('NOTIFICATIONS_NODE_ID', socket.gethostname())
+WS_DB_THREAD_POOL_SIZE = 10  # the number of threads (and DB connections) a websocket server uses for DB calls
+WS_WORKERS_PER_MESSAGE_TYPE = 8  # the number of coroutines (and queue shards) handling each type of websocket message
+
 ROOT_URLCONF = 'deadline.urls'
 
 TEMPLATES = [
@@ -202,6 +235,20 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 AUTH_USER_MODEL = 'accounts.User'
 
+# The algorithm new passwords get hashed with and the cost of every algorithm, see accounts.hashers
+# A changed algorithm or cost re-hashes a password on its next login. Pick the cost with benchmark_password_hashing
+ACCOUNTS_PASSWORD_HASHER = 'pbkdf2_sha256'
+ACCOUNTS_PASSWORD_HASHER_PARAMETERS = {
+    'pbkdf2_sha256': {'iterations': 100000},
+    'scrypt': {'n': 2 ** 14, 'r': 8, 'p': 1},
+}
+if 'test' in sys.argv:
+    # every test user gets his password hashed, so keep it cheap
+    ACCOUNTS_PASSWORD_HASHER_PARAMETERS = {
+        'pbkdf2_sha256': {'iterations': 1},
+        'scrypt': {'n': 2, 'r': 1, 'p': 1},
+    }
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/1.10/topics/i18n/
@@ -16,10 +16,13 @@ Including another URLconf
 from django.conf.urls import url, include
 from django.contrib import admin
 
+from views import metrics
+
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
     url(r'^accounts/', include('accounts.urls')),
     url(r'^challenges/', include('challenges.urls')),
     url(r'^social/', include('social.urls')),
-    url(r'^chat/', include('private_chat.urls'))
+    url(r'^chat/', include('private_chat.urls')),
+    url(r'^metrics$', metrics, name='metrics'),
 ]
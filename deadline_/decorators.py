@@ -24,6 +24,10 @@ def fetch_models(response_function, *args, **kwargs):
             the permission_classes for a has_object_permissions method and call it.
             This is done to check for permissions easily.
              If it does not have the permission, the decorator outright returns a 403 Response
+        model_select_related: dict - the relations to fetch along with a model, e.g {SubmissionComment: ('author', )}
+        model_only: dict - the only fields to load of a model, e.g {Challenge: ('id', )}
+    When every model belongs to the previous one (e.g Challenge, Submission, SubmissionComment),
+        they are fetched with a single query, see helpers.fetch_model_chain
     """
 
     def view_decorator(class_view, *args, **kwargs):
@@ -36,7 +40,9 @@ def fetch_models(response_function, *args, **kwargs):
             raise Exception(f'Class {class_view} does not have enough classes defined in the model_classes!')
 
         try:
-            models = fetch_models_by_pks({model: model_pk for model, model_pk in zip(class_view.model_classes, kwargs.values())})
+            models = fetch_models_by_pks({model: model_pk for model, model_pk in zip(class_view.model_classes, kwargs.values())},
+                                         select_related=getattr(class_view, 'model_select_related', None),
+                                         only=getattr(class_view, 'model_only', None))
             if hasattr(class_view, 'main_class') and hasattr(class_view, 'permission_classes'):
                 main_obj = [model for model in models if isinstance(model, class_view.main_class)][0]
                 for PermissionClass in [permission for permission in class_view.permission_classes
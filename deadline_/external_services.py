@@ -1,17 +1,121 @@
+import logging
+import threading
+import time
+
 import pika
+from pika.exceptions import AMQPConnectionError, AMQPChannelError
+
+from metrics import REGISTRY
+from notifications.constants import NOTIFICATIONS_EXCHANGE, NOTIFICATIONS_EXCHANGE_TYPE
+from notifications.routing import recipient_routing_key
+
+logger = logging.getLogger('external_services')
+
+SERVICE_CONNECT_SECONDS = REGISTRY.histogram('external_service_connect_seconds',
+                                             'Time spent creating the client of an external service',
+                                             labels=('service', ))
+
+
+class LazyServiceHandle:
+    """
+    A process-wide handle to the client of an external service (e.g Docker), which is created on first use
+        instead of at import time, so that importing the project never waits on (or fails because of) the service.
+    Every thread of the process shares the one client, and attribute access is forwarded to it,
+        so the handle can be used in place of the client itself
+    """
+    def __init__(self, service_name: str, create_client):
+        self.service_name = service_name
+        self._create_client = create_client
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    start = time.perf_counter()
+                    self._client = self._create_client()
+                    elapsed_seconds = time.perf_counter() - start
+                    SERVICE_CONNECT_SECONDS.labels(service=self.service_name).observe(elapsed_seconds)
+                    logger.info(f'Created the {self.service_name} client in {elapsed_seconds:.3f}s')
+        return self._client
+
+    @property
+    def is_created(self) -> bool:
+        return self._client is not None
+
+    def reset(self):
+        """
+        Drops the client, the next use creates a new one.
+        Meant for a freshly forked process, which must not share the parent's connection -
+            the lock is replaced rather than acquired, as a parent thread might have held it while forking
+        """
+        self._lock = threading.Lock()
+        self._client = None
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def create_docker_client():
+    import docker  # only the processes which grade submissions need it, and it is slow to import
+    return docker.from_env()
 
 
 class RabbitMQClient:
+    """
+    A blocking RabbitMQ client used to publish messages from the web processes.
+    It connects on the first publish rather than when it is created, as it is created while the settings load.
+    Publishes are confirmed by the broker and a dropped connection is re-established on the next publish
+    """
     def __init__(self, connection_params):
-        self.connection = pika.BlockingConnection(connection_params)
+        self.connection_params = connection_params
+        self.connection = None
+        self.channel = None
+        self._lock = threading.Lock()  # the blocking connection is not thread-safe
+
+    def reset(self):
+        """ Forgets the connection without closing it, see LazyServiceHandle.reset() """
+        self._lock = threading.Lock()
+        self.connection = None
+        self.channel = None
+
+    def connect(self):
+        with SERVICE_CONNECT_SECONDS.labels(service='RabbitMQ').time():
+            self.connection = pika.BlockingConnection(self.connection_params)
         self.channel = self.connection.channel()
+        self.channel.confirm_delivery()
         self.init_notification_exchange()
 
     def init_notification_exchange(self):
-        self.channel.exchange_declare(exchange='notifications', exchange_type='fanout')
+        self.channel.exchange_declare(exchange=NOTIFICATIONS_EXCHANGE, exchange_type=NOTIFICATIONS_EXCHANGE_TYPE)
 
-    def send_notification_message(self, notif_id: int):
+    def send_notification_message(self, notif_id: int, recipient_id: int):
         """
-        Sends a message that a notification has been created
+        Sends a message that a notification has been created, routed by its recipient
         """
-        self.channel.basic_publish(exchange='notifications', routing_key='', body=str(notif_id))
+        self.send_notification_messages([(notif_id, recipient_id)])
+
+    def send_notification_messages(self, notifications: [(int, int)]):
+        """
+        Sends a message for each of the given (notification ID, recipient ID) pairs,
+            reconnecting once if the connection was lost.
+        Raises an exception if the broker does not confirm all of them
+        """
+        with self._lock:
+            try:
+                self._publish_notification_messages(notifications)
+            except (AMQPConnectionError, AMQPChannelError):
+                self.connect()
+                self._publish_notification_messages(notifications)
+
+    def _publish_notification_messages(self, notifications: [(int, int)]):
+        if self.connection is None or self.connection.is_closed:
+            self.connect()
+
+        for notif_id, recipient_id in notifications:
+            if not self.channel.basic_publish(exchange=NOTIFICATIONS_EXCHANGE,
+                                              routing_key=recipient_routing_key(recipient_id),
+                                              body=str(notif_id)):
+                raise AMQPChannelError(f'RabbitMQ did not confirm the message for notification {notif_id}')
@@ -8,25 +8,101 @@ import django.db.models
 from errors import FetchError
 
 
-def fetch_models_by_pks(ids_by_models: {django.db.models.Model: int}) -> []:
+def fetch_models_by_pks(ids_by_models: {django.db.models.Model: int}, select_related: dict=None, only: dict=None) -> []:
     """
     Given a dictionary of Django ORM Model Objects: Primary Keys,
         tries to fetch the object and returns an error message if any fetch fails
     Returning them in correct order obviously relies on Python 3.6's ordered dictionaries
+    Models where each one belongs to the previous one are fetched with a single query (see fetch_model_chain)
 
     :param ids_by_models: a dictionary of Django ORM Model Objects: Primary Keys. e.g {Course: 1}
+    :param select_related: the relations to fetch along with a model, e.g {SubmissionComment: ('author', )}
+    :param only: the only fields to load of a model, e.g {Challenge: ('id', )}
     :returns a list of the fetched objects, a boolean indicating if everything is valid and a potential error string
     """
+    select_related, only = select_related or {}, only or {}
+    if len(ids_by_models) > 1:
+        fetched_objects = fetch_model_chain(ids_by_models, select_related, only)
+        if fetched_objects is not None:
+            return fetched_objects
+
     fetched_objects = []
     for model, id in ids_by_models.items():
+        query = apply_fetch_hints(model.objects.all(), select_related.get(model, ()),
+                                  get_loaded_fields(model, select_related.get(model, ()), only.get(model)))
         try:
-            fetched_objects.append(model.objects.get(id=id))
+            fetched_objects.append(query.get(id=id))
         except model.DoesNotExist:
             raise FetchError(f'{model.__name__} with ID {id} does not exist.')
 
     return fetched_objects
 
 
+def fetch_model_chain(ids_by_models: {django.db.models.Model: int}, select_related: dict, only: dict) -> []:
+    """
+    Fetches models where each one has a foreign key to the previous one, e.g Challenge, Submission, SubmissionComment,
+        by selecting the last one joined to the others and filtered by all of their IDs
+    :returns the fetched objects in order, or None if the models are not such a chain or if nothing matched
+        (a missing object or one which does not belong to its parent), in which case they should be fetched one by one
+    """
+    models, ids = list(ids_by_models.keys()), list(ids_by_models.values())
+    parent_field_names = []  # from the last model upwards, e.g ['submission', 'challenge']
+    for parent, child in zip(models[-2::-1], models[:0:-1]):
+        field_name = get_parent_field_name(child, parent)
+        if field_name is None:
+            return None
+        parent_field_names.append(field_name)
+    # the lookup path from the last model to each model, in the order of the models, e.g ['submission__challenge__', ...]
+    prefixes = ['__'.join(parent_field_names[:depth] + ['']) for depth in range(len(models) - 1, -1, -1)]
+
+    related_lookups, only_lookups = [], []
+    for model, prefix in zip(models, prefixes):
+        model_select_related = select_related.get(model, ())
+        if prefix:  # the relation to this model, which only() must not defer
+            related_lookups.append(prefix[:-2])
+            only_lookups.append(prefix[:-2])
+        related_lookups.extend(prefix + lookup for lookup in model_select_related)
+        only_lookups.extend(prefix + field_name
+                            for field_name in get_loaded_fields(model, model_select_related, only.get(model)) or
+                            [field.name for field in model._meta.concrete_fields])
+    if not any(model in only for model in models):
+        only_lookups = None
+
+    query = models[-1].objects.filter(**{prefix + 'id': model_id for prefix, model_id in zip(prefixes, ids)})
+    try:
+        fetched_object = apply_fetch_hints(query, related_lookups, only_lookups).get()
+    except models[-1].DoesNotExist:
+        return None
+
+    fetched_objects = [fetched_object]
+    for field_name in parent_field_names:
+        fetched_objects.append(getattr(fetched_objects[-1], field_name))
+    return fetched_objects[::-1]
+
+
+def get_parent_field_name(child: django.db.models.Model, parent: django.db.models.Model) -> str:
+    """ The name of the child model's foreign key to the parent model, None if it has none or more than one """
+    field_names = [field.name for field in child._meta.concrete_fields
+                   if field.many_to_one and field.related_model is parent]
+    return field_names[0] if len(field_names) == 1 else None
+
+
+def get_loaded_fields(model: django.db.models.Model, select_related: tuple, only: tuple) -> [str]:
+    """ The fields to pass to only(), which must include the relations select_related follows. None loads them all """
+    if only is None:
+        return None
+    return list(only) + [lookup.split('__')[0] for lookup in select_related]
+
+
+def apply_fetch_hints(query: django.db.models.QuerySet, select_related: [str], only: [str]) -> django.db.models.QuerySet:
+    # an empty select_related() would follow every foreign key
+    if select_related:
+        query = query.select_related(*select_related)
+    if only:
+        query = query.only(*only)
+    return query
+
+
 def get_date_difference(end_date: datetime, start_date: datetime) -> timedelta:
     """
     Returns the difference between two dates
@@ -0,0 +1,227 @@
+"""
+Minimal in-process metrics which are exported in the Prometheus text format
+
+Usage:
+    REQUESTS = REGISTRY.counter('requests_total', 'The number of handled requests', labels=('endpoint', ))
+    REQUESTS.labels(endpoint='/challenges').inc()
+"""
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+logger = logging.getLogger('metrics')
+
+DEFAULT_HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LOOP_LAG_CHECK_INTERVAL_SECONDS = 0.5
+
+
+class Metric:
+    """
+    Base class of all metrics.
+    A metric with labels holds one child metric per distinct label value combination, created on first use
+    """
+    TYPE = None
+
+    def __init__(self, name: str, description: str, labels: tuple=(), **kwargs):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._children = {}
+        self._init_values()
+
+    def labels(self, **label_values) -> 'Metric':
+        key = tuple(str(label_values[label]) for label in self.label_names)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self.__class__(self.name, self.description, **self._kwargs))
+        return child
+
+    def render(self) -> [str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.TYPE}']
+        if not self.label_names:
+            return lines + self._render_values('')
+
+        for key, child in list(self._children.items()):
+            label_str = ','.join(f'{name}="{value}"' for name, value in zip(self.label_names, key))
+            lines += child._render_values(label_str)
+        return lines
+
+    def _init_values(self):
+        raise NotImplementedError()
+
+    def _render_values(self, label_str: str) -> [str]:
+        raise NotImplementedError()
+
+    @staticmethod
+    def _with_labels(name: str, label_str: str) -> str:
+        return f'{name}{{{label_str}}}' if label_str else name
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def _init_values(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def _render_values(self, label_str: str) -> [str]:
+        return [f'{self._with_labels(self.name, label_str)} {self.value}']
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def _init_values(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def _render_values(self, label_str: str) -> [str]:
+        return [f'{self._with_labels(self.name, label_str)} {self.value}']
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def _init_values(self):
+        self.buckets = tuple(self._kwargs.get('buckets', DEFAULT_HISTOGRAM_BUCKETS))
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value: float):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for idx, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    self.bucket_counts[idx] += 1
+                    break
+
+    @contextmanager
+    def time(self):
+        """ Observes the time the wrapped block took, in seconds """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def _render_values(self, label_str: str) -> [str]:
+        separator = ',' if label_str else ''
+        lines, cumulative_count = [], 0
+        for upper_bound, bucket_count in zip(self.buckets, self.bucket_counts):
+            cumulative_count += bucket_count
+            lines.append(f'{self.name}_bucket{{{label_str}{separator}le="{upper_bound}"}} {cumulative_count}')
+        lines.append(f'{self.name}_bucket{{{label_str}{separator}le="+Inf"}} {self.count}')
+        lines.append(f'{self._with_labels(self.name + "_sum", label_str)} {self.sum}')
+        lines.append(f'{self._with_labels(self.name + "_count", label_str)} {self.count}')
+        return lines
+
+
+class MetricsRegistry:
+    """ Holds every metric of the process. Registering a metric with an existing name returns the existing one """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, description, labels=()) -> Counter:
+        return self._register(Counter, name, description, labels)
+
+    def gauge(self, name, description, labels=()) -> Gauge:
+        return self._register(Gauge, name, description, labels)
+
+    def histogram(self, name, description, labels=(), buckets=DEFAULT_HISTOGRAM_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, description, labels, buckets=buckets)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric_class, name, description, labels, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = metric_class(name, description, labels, **kwargs)
+            return self._metrics[name]
+
+
+REGISTRY = MetricsRegistry()
+
+LOOP_LAG = REGISTRY.histogram('event_loop_lag_seconds',
+                              'How late the event loop woke up a sleeping coroutine, in seconds')
+
+
+async def monitor_loop_lag(interval=LOOP_LAG_CHECK_INTERVAL_SECONDS):
+    """
+    Sleeps for `interval` seconds forever and records how much later than that the loop woke us up.
+    Anything blocking the event loop shows up as lag
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(loop.time() - start - interval, 0))
+
+
+async def serve_metrics(host: str, port: int, registry: MetricsRegistry=REGISTRY):
+    """ Starts a bare-bones HTTP server which answers every request with the rendered metrics """
+    async def handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = registry.render().encode()
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                         b'Connection: close\r\n\r\n' + body)
+            await writer.drain()
+        except Exception as e:
+            logger.debug(f'Could not serve metrics due to {e}')
+        finally:
+            writer.close()
+
+    logger.info(f'Serving metrics on {host}:{port}')
+    return await asyncio.start_server(handle_request, host, port)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_metrics_in_thread(host: str, port: int, registry: MetricsRegistry=REGISTRY) -> HTTPServer:
+    """ serve_metrics for processes without an event loop (e.g celery workers), served from a daemon thread """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    server = _ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info(f'Serving metrics on {host}:{port}')
+    return server
@@ -1,4 +1,7 @@
-import asyncio
+from async_helpers import ShardedQueue
 
-user_authentication = asyncio.Queue()
-read_notification = asyncio.Queue()
+# sharded by user, see MessageRouter
+user_authentication = ShardedQueue('notifications.user_authentication')
+read_notification = ShardedQueue('notifications.read_notification')
+# the (registry method, user ID) updates of the presence registry, sharded by user so that his run in order
+presence_updates = ShardedQueue('notifications.presence_updates')
@@ -1,13 +1,14 @@
-import json
-
 from websockets import WebSocketServerProtocol
 
+from websocket_sender import WebSocketSender
+
 
 class WebSocketConnection:
     def __init__(self, socket: WebSocketServerProtocol, user_id):
         self.web_socket = socket
         self.user_id = user_id
         self.is_valid = False
+        self.sender = WebSocketSender(socket)
 
     def __hash__(self):
         return hash(str(self.user_id))
@@ -31,12 +32,9 @@ class UserConnection(WebSocketConnection):
         print(f'Received message {received_message} from user {self.user_id}')
         return received_message
 
-    async def send_message(self, payload):
+    def send_message(self, payload, coalesce_key: str=None, droppable: bool=False) -> bool:
         """
-        Sends a payload (message) to one connection
+        Queues up a payload (message) to be sent to the connection, see WebSocketSender
         """
-        try:
-            await self.web_socket.send(json.dumps(payload))
-        except Exception as e:
-            print(f'Could not send message to websocket due to {e}')
+        return self.sender.send(payload, coalesce_key=coalesce_key, droppable=droppable)
 
@@ -0,0 +1,16 @@
+# Notifications are published to a direct exchange, routed by the recipient's routing key (see notifications.routing)
+NOTIFICATIONS_EXCHANGE = 'notifications.recipients'
+NOTIFICATIONS_EXCHANGE_TYPE = 'direct'
+NOTIFICATION_ROUTING_SHARDS = 1024  # the number of distinct recipient routing keys
+NOTIFICATION_NODE_QUEUE_PREFIX = 'notifications.node.'  # every notification server node consumes its own queue
+NOTIFICATION_CONSUMER_PREFETCH_COUNT = 500  # the maximum amount of unacknowledged notifications a node holds
+NOTIFICATION_DELIVERY_BATCH_SIZE = 100  # the maximum amount of notifications a node fetches and sends at once
+NOTIFICATION_DELIVERY_BATCH_WINDOW_SECONDS = 0.05  # how long a node waits for a delivery batch to fill up
+
+NOTIFICATION_OUTBOX_CHANNEL = 'notification_outbox'  # the Postgres LISTEN/NOTIFY channel which wakes up the relay
+NOTIFICATION_PUBLISH_BATCH_SIZE = 100  # the maximum amount of notification IDs published at once
+NOTIFICATION_RELAY_POLL_SECONDS = 1  # how often the relay checks the outbox if it does not get woken up
+NOTIFICATION_PUBLISH_RETRY_SECONDS = 2  # how long we wait before retrying a failed publish
+
+NOTIFICATION_PRESENCE_HEARTBEAT_SECONDS = 30  # how often a node refreshes the presence of its connected users
+NOTIFICATION_PRESENCE_TTL_SECONDS = 90  # presence which was not refreshed for this long belongs to a dead node
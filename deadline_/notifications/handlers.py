@@ -1,25 +1,29 @@
-import asyncio
 import websockets
 import logging
 
+from django.conf import settings
+
 from accounts.models import User
+from async_helpers import run_in_db_thread
+from notifications.channels import presence_updates
 from notifications.classes import UserConnection
 from notifications.errors import NotificationAlreadyRead, OfflineRecipientError, InvalidNotificationToken, \
     RecipientMismatchError
 from notifications.helpers import extract_connect_path
+from notifications.presence import PresenceRegistry
 from notifications.router import MessageRouter
+from notifications.routing import routing_table
 from social.models.notification import Notification
 from social.serializers import NotificationSerializer
 
 """
-REVISIT: This way of handling connections is not scalable in the slightest way - 
-    we can never run more than one process of this server, as the ws_connections variable will not get shared
-IDEA:    Maybe it could get shared via some message broker (e.g connection established/authenticated/disconnected) 
-            or store it in something like Redis or a DB?
-IDEA:    Maybe we could rewrite it to something which allows parallelism with shared memory
+ws_connections only holds the websockets connected to this node (process).
+The server scales out by running more nodes - each one binds its RabbitMQ queue to the routing keys
+    of the users connected to it (see notifications.routing) and records them in the shared presence registry
 """
 logger = logging.getLogger('notifications')
 ws_connections: {int: UserConnection} = {}
+presence_registry = PresenceRegistry(settings.NOTIFICATIONS_NODE_ID)
 
 
 class NotificationsHandler:
@@ -30,11 +34,11 @@ class NotificationsHandler:
     """
 
     @staticmethod
-    def fetch_notification(notif_id: int) -> Notification:
+    async def fetch_notification(notif_id: int) -> Notification:
         """
-        Fetches a notification and validates it
+        Fetches a notification (off the event loop) and validates it
         """
-        notif: Notification = Notification.objects.get(id=notif_id)
+        notif: Notification = await run_in_db_thread(Notification.objects.get, id=notif_id)
         try:
             NotificationsHandler.validate_notification(notif)
         except (NotificationAlreadyRead, OfflineRecipientError) as e:
@@ -55,16 +59,16 @@ class NotificationsHandler:
             raise OfflineRecipientError(f'The notification recipient {notif.recipient_id} is not authorized!')
 
     @staticmethod
-    def receive_message(msg: str) -> bool:
+    async def receive_message(msg: str) -> bool:
         """
         Processes the message and sends it to the handler
         :return: a boolean indicating if hte message was successfully processed
         """
         try:
             notif_id = int(msg)
-            notification = NotificationsHandler.fetch_notification(notif_id)
+            notification = await NotificationsHandler.fetch_notification(notif_id)
 
-            asyncio.ensure_future(NotificationsHandler.send_notification(notification))
+            NotificationsHandler.send_notification(notification)
         except (NotificationAlreadyRead, Notification.DoesNotExist) as e:
             print(f'DEBUG - Notification was either read or with an invalid ID - {e}')
         except OfflineRecipientError as e:
@@ -79,26 +83,95 @@ class NotificationsHandler:
         return True
 
     @staticmethod
-    async def send_notification(notification: Notification):
+    async def receive_messages(msgs: [str]) -> [bool]:
+        """
+        Processes a batch of messages - loads all of their notifications in a single query
+            and sends each connected recipient his notifications in a single frame
+        :return: a boolean per message, indicating if it was successfully processed
+        """
+        notif_ids = []
+        for msg in msgs:
+            try:
+                notif_ids.append(int(msg))
+            except ValueError as e:
+                logger.warning(f'Value error, most probably while parsing MSG - msg: {msg}\n {e}')
+                notif_ids.append(None)
+
+        try:
+            notifications = await run_in_db_thread(NotificationsHandler.fetch_notifications,
+                                                   [notif_id for notif_id in notif_ids if notif_id is not None])
+        except Exception as e:
+            logger.error(f'Exception while receiving a batch of messages - {e}')
+            return [False] * len(msgs)
+
+        notifications_by_recipient: {int: [Notification]} = {}
+        for notification in notifications:
+            recipient_connection = ws_connections.get(notification.recipient_id)
+            if recipient_connection is None or not recipient_connection.is_valid:
+                continue  # the recipient is not eligible to receive it
+            notifications_by_recipient.setdefault(notification.recipient_id, []).append(notification)
+
+        for recipient_notifications in notifications_by_recipient.values():
+            NotificationsHandler.send_notifications(recipient_notifications)
+
+        return [notif_id is not None for notif_id in notif_ids]
+
+    @staticmethod
+    def fetch_notifications(notif_ids: [int]) -> [Notification]:
+        """
+        Fetches the unread notifications with the given IDs in a single query.
+        Read and non-existent ones are left out, as are duplicates
+        """
+        if not notif_ids:
+            return []
+        return list(Notification.objects.filter(id__in=notif_ids, is_read=False).order_by('id'))
+
+    @staticmethod
+    def send_notifications(notifications: [Notification]):
+        """
+        Sends multiple notifications of one recipient in a single frame
+        {
+            "type": "NOTIFICATIONS",
+            "notifications": [{...}, {...}]
+        }
+        A single notification is sent as usual, see send_notification()
+        Notification frames are dropped first if the recipient is too slow, as he can always fetch them later
+        """
+        if len(notifications) == 1:
+            return NotificationsHandler.send_notification(notifications[0])
+
+        recipient_id = notifications[0].recipient_id
+        if recipient_id not in ws_connections or not ws_connections[recipient_id].is_valid:
+            logger.warning(f'Notification recipient with ID {recipient_id} was either not connected or not authorized')
+            return
+
+        ws_connections[recipient_id].send_message({
+            "type": "NOTIFICATIONS",
+            "notifications": NotificationSerializer(notifications, many=True).data
+        }, droppable=True)
+
+    @staticmethod
+    def send_notification(notification: Notification):
         """
         Sends the following JSON to the recipient
         {
             "type": "NOTIFICATION",
             "notification": {...}
         }
+        A newer version of a (squashed) notification replaces the older one if it is still waiting to be sent
         """
         recipient_id = notification.recipient_id
         if recipient_id not in ws_connections or not ws_connections[recipient_id].is_valid:
             print(f'Notification recipient with ID {recipient_id} was either not connected or not authorized')
             return
 
-        asyncio.ensure_future(ws_connections[recipient_id].send_message({
+        ws_connections[recipient_id].send_message({
             "type": "NOTIFICATION",
             "notification": NotificationSerializer(notification).data
-        }))
+        }, coalesce_key=f'notification:{notification.id}', droppable=True)
 
 
-async def authenticate_user(stream):
+async def authenticate_user(auth_message: dict):
     """
     Authenticates the user, essentially validating his connection
         and proving he is who he claims to be
@@ -120,48 +193,46 @@ async def authenticate_user(stream):
             "message": "Successfully authenticated"
         }
     """
-    while True:
-        auth_message = await stream.get()
-        token, user_id = auth_message.get('token'), auth_message.get('user_id')
-        if user_id not in ws_connections:
-            print(f'Somebody else tried to authenticate user_id {user_id}.')
-            continue
-
-        user_connection: UserConnection = ws_connections[user_id]
-        if not user_connection.user.notification_token_is_valid(token):
-            asyncio.ensure_future(user_connection.send_message({
-                "type": "INVALID_NOTIFICATION_TOKEN",
-                "message": "Notification token is invalid or expired!"
-            }))
-            continue
-
-        # User has authenticated
-        user_connection.is_valid = True
-        asyncio.ensure_future(user_connection.send_message({
-            "type": "OK",
-            "message": "Successfully authenticated!"
-        }))
-
-
-def _read_notification(notification_token, user_id, notification_id):
+    token, user_id = auth_message.get('token'), auth_message.get('user_id')
     if user_id not in ws_connections:
         print(f'Somebody else tried to authenticate user_id {user_id}.')
-        raise OfflineRecipientError(f'Somebody else tried to authenticate user_id {user_id}.')
-    if not ws_connections[user_id].is_valid:
-        raise OfflineRecipientError(f'User {user_id} is not authenticated!')
+        return
 
     user_connection: UserConnection = ws_connections[user_id]
-    if not user_connection.user.notification_token_is_valid(notification_token):
-        raise InvalidNotificationToken(f'User with ID {user_id} provided an invalid notification token {notification_token}!')
+    try:
+        # re-fetch the user, as the token might have been refreshed since he connected
+        user_connection.user = await run_in_db_thread(User.objects.get, id=user_id)
+    except User.DoesNotExist:
+        return
+    if not user_connection.user.notification_token_is_valid(token):
+        user_connection.send_message({
+            "type": "INVALID_NOTIFICATION_TOKEN",
+            "message": "Notification token is invalid or expired!"
+        })
+        return
+
+    # User has authenticated
+    user_connection.is_valid = True
+    user_connection.send_message({
+        "type": "OK",
+        "message": "Successfully authenticated!"
+    })
+
+
+def _read_notification(notification_token, user: User, notification_id):
+    """ Runs in the DB thread pool, so it does not touch ws_connections - the caller validates the connection """
+    if not user.notification_token_is_valid(notification_token):
+        raise InvalidNotificationToken(f'User with ID {user.id} provided an invalid notification token {notification_token}!')
 
     notif = Notification.objects.get(id=notification_id)
-    if not notif.is_recipient(user_connection.user):
-        raise RecipientMismatchError(f'User {user_id} is not the recipient for notification {notification_id}')
+    if not notif.is_recipient(user):
+        raise RecipientMismatchError(f'User {user.id} is not the recipient for notification {notification_id}')
 
     notif.is_read = True
-    notif.save()
+    notif.save(update_fields=['is_read'])
+
 
-async def read_notification(stream):
+async def read_notification(message: dict):
     """
     Marks a notification as read by the user.
 
@@ -183,40 +254,50 @@ async def read_notification(stream):
             "message": ""
         }
     """
+    token, user_id, notif_id = message.get('token'), message.get('user_id'), message.get('notification_id')
+    # the user might disconnect while we are in the DB, so the reply goes through the connection we validated
+    user_connection: UserConnection = ws_connections.get(user_id)
+    if user_connection is None or not user_connection.is_valid:
+        logger.warning(f'User {user_id} tried to read a notification without being connected and authenticated')
+        return
 
-    while True:
-        message = await stream.get()
+    try:
+        await run_in_db_thread(_read_notification, token, user_connection.user, notif_id)
+        user_connection.send_message({
+            "type": "OK",
+            "message": f"Notification with ID {notif_id} was read successfully"
+        })
+    except InvalidNotificationToken:
+        user_connection.send_message({
+            "type": "INVALID_NOTIFICATION_TOKEN",
+            "message": "Notification token is invalid or expired!"
+        })
+    except (RecipientMismatchError, Notification.DoesNotExist):
+        user_connection.send_message({
+            "type": "ERROR",
+            "message": "You are not the recipient of that notification!"
+        })
 
-        token, user_id, notif_id = message.get('token'), message.get('user_id'), message.get('notification_id')
 
-        try:
-            _read_notification(token, user_id, notif_id)
-            asyncio.ensure_future(ws_connections[user_id].send_message({
-                "type": "OK",
-                "message": f"Notification with ID {notif_id} was read successfully"
-            }))
-        except InvalidNotificationToken:
-            asyncio.ensure_future(ws_connections[user_id].send_message({
-                "type": "INVALID_NOTIFICATION_TOKEN",
-                "message": "Notification token is invalid or expired!"
-            }))
-        except (RecipientMismatchError, Notification.DoesNotExist):
-            asyncio.ensure_future(ws_connections[user_id].send_message({
-                "type": "ERROR",
-                "message": "You are not the recipient of that notification!"
-            }))
-        except OfflineRecipientError:
-            pass
+async def update_presence(update: tuple):
+    """
+    Applies a (registry method, user ID) update from the presence_updates queue.
+    A user's updates always land in the same shard, so they run in the order they were made -
+        e.g a disconnect running before its connect would leave the user online for good
+    """
+    registry_method, user_id = update
+    try:
+        await run_in_db_thread(registry_method, user_id)
+    except Exception as e:
+        logger.error(f'Could not update the presence of user {user_id} due to {e}')
 
 
 async def main_handler(websocket, path):
-    # TODO: All these notification_tokens being sent are useless, as once we authenticate a user we have this websocket saved
-    # TODO:     These were made before we added checks for malicious `user_id` checks and as now we simply overwrite
-    # TODO:     the field, we know that each message from a `user_id` is from him,
-    # TODO:         so no need to authenticate on each message
+    # Each message from this websocket is from its authenticated owner, whose User is kept on the UserConnection.
+    #   The notification token sent along is still checked, as it expires, but that is a cached comparison (no query)
     user_id = extract_connect_path(path)
     try:
-        user = User.objects.get(id=user_id)
+        user = await run_in_db_thread(User.objects.get, id=user_id)
     except User.DoesNotExist as e:
         print(str(e))
         return
@@ -227,13 +308,16 @@ async def main_handler(websocket, path):
             logger.debug(f'Tried to overwrite socket with ID {user.id} but did not since it was valid!')
             return
         logger.debug(f'Overwrote socket with ID {user.id}')
+    else:
+        routing_table.add_recipient(user.id)
 
     ws_connections[user.id] = UserConnection(websocket, user)
+    await presence_updates.put((presence_registry.connect, user.id), shard_key=user.id)
 
-    asyncio.ensure_future(ws_connections[user_id].send_message({
+    ws_connections[user_id].send_message({
         "type": "OK",
         "message": "Connected!"
-    }))
+    })
 
     # While the websocket is open, listen for incoming messages/events
     is_overwritten = False
@@ -259,5 +343,7 @@ async def main_handler(websocket, path):
     finally:
         if not is_overwritten:
             del ws_connections[user.id]
+            routing_table.remove_recipient(user.id)
+            await presence_updates.put((presence_registry.disconnect, user.id), shard_key=user.id)
         else:
             logger.debug(f'Deleted old overwritten socket with ID {user_id}')
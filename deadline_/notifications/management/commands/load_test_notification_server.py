@@ -0,0 +1,125 @@
+import asyncio
+import random
+import re
+import time
+
+from django.conf import settings
+
+from accounts.models import User
+from deadline.settings import RABBITMQ_CLIENT
+from social.constants import RECEIVE_FOLLOW_NOTIFICATION
+from social.models.notification import Notification
+from ws_load_test import LoadTestCommand, LoadTestClient, LatencyStats, get_or_create_load_test_users, run_at_rate
+
+LOAD_TEST_NODE_ID = 'loadtest'
+PUBLISH_INTERVAL_SECONDS = 0.1  # the notifications due in this interval are created and published together
+DELIVERY_GRACE_SECONDS = 2  # how long we wait for the frames still in flight once the traffic stops
+READ_OK_REGEX = r'^Notification with ID (?P<notification_id>\d+) was read successfully$'
+
+
+class NotificationLoadTestClient(LoadTestClient):
+    """
+    A user subscribed to his notifications, who reads some of the ones he receives
+    """
+    def __init__(self, url: str, stats: LatencyStats, user: User, published_at: {int: float}, read_ratio: float):
+        super().__init__(url, stats)
+        self.user = user
+        self.published_at = published_at
+        self.read_ratio = read_ratio
+        self.read_sent_at: {int: float} = {}
+
+    async def authenticate(self):
+        await self.send({'type': 'authentication', 'token': self.user.notification_token})
+
+    def on_frame(self, frame: dict):
+        frame_type = frame.get('type')
+        if frame_type == 'OK':
+            read_match = re.match(READ_OK_REGEX, frame['message'])
+            if read_match is not None:
+                sent_at = self.read_sent_at.pop(int(read_match.group('notification_id')), None)
+                if sent_at is not None:
+                    self.stats.record('read-notification', time.perf_counter() - sent_at)
+            elif frame['message'].startswith('Successfully authenticated'):
+                self.mark_authenticated()
+        elif frame_type == 'NOTIFICATION':
+            self.on_notifications([frame['notification']])
+        elif frame_type == 'NOTIFICATIONS':
+            self.on_notifications(frame['notifications'])
+
+    def on_notifications(self, notifications: [dict]):
+        now = time.perf_counter()
+        for notification in notifications:
+            published_at = self.published_at.pop(notification['id'], None)
+            if published_at is not None:
+                self.stats.record('notification', now - published_at)
+            if random.random() < self.read_ratio:
+                self.read_sent_at[notification['id']] = now
+                asyncio.ensure_future(self.send({'type': 'read_notification', 'notification_id': notification['id'],
+                                                 'token': self.user.notification_token}))
+
+
+class Command(LoadTestCommand):
+    help = 'Load tests the notification websocket server with simulated subscribers. ' \
+           'Notifications are published straight to RabbitMQ, without the outbox relay'
+    SERVER_COMMAND = 'run_notification_server'
+    DEFAULT_HOST = settings.NOTIFICATIONS_WS_SERVER_HOST
+    DEFAULT_PORT = settings.NOTIFICATIONS_WS_SERVER_PORT + 100
+    DEFAULT_METRICS_PORT = settings.NOTIFICATIONS_METRICS_PORT + 100
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--notifications-per-second', type=float, default=500,
+                            help='How many notifications are published a second, to random clients')
+        parser.add_argument('--read-ratio', type=float, default=0.5,
+                            help='The share of received notifications which the clients read')
+
+    def get_server_args(self, options) -> [str]:
+        return ['--node-id', LOAD_TEST_NODE_ID]
+
+    def create_clients(self, options, stats: LatencyStats) -> [NotificationLoadTestClient]:
+        self.published_at: {int: float} = {}
+        self.notification_ids: [int] = []
+        clients = []
+        for user in get_or_create_load_test_users(options['clients']):
+            if user.notification_token_is_expired():
+                user.refresh_notification_token(force=True)
+            clients.append(NotificationLoadTestClient(
+                f'ws://{options["host"]}:{options["port"]}/notifications/{user.id}/subscribe',
+                stats, user, self.published_at, options['read_ratio']))
+        return clients
+
+    async def run_load(self, clients: [NotificationLoadTestClient], options):
+        loop = asyncio.get_event_loop()
+        recipient_ids = [client.user.id for client in clients]
+        due_count = 0.0
+
+        async def publish_due_notifications():
+            nonlocal due_count
+            due_count += options['notifications_per_second'] * PUBLISH_INTERVAL_SECONDS
+            count, due_count = int(due_count), due_count - int(due_count)
+            if count:
+                await loop.run_in_executor(None, self.publish_notifications,
+                                           [random.choice(recipient_ids) for _ in range(count)])
+
+        try:
+            if recipient_ids:
+                await run_at_rate(1 / PUBLISH_INTERVAL_SECONDS, options['duration'], publish_due_notifications)
+            await asyncio.sleep(DELIVERY_GRACE_SECONDS)
+        finally:
+            Notification.objects.filter(id__in=self.notification_ids).delete()
+
+    def publish_notifications(self, recipient_ids: [int]):
+        """
+        Creates the notifications in bulk, which skips the outbox (see notif_post_save_send),
+            and publishes them ourselves
+        """
+        notifications = Notification.objects.bulk_create([
+            Notification(recipient_id=recipient_id, type=RECEIVE_FOLLOW_NOTIFICATION,
+                         content={'follower_id': recipient_id, 'follower_name': 'loadtest'})
+            for recipient_id in recipient_ids])
+        self.notification_ids += [notification.id for notification in notifications]
+        published_at = time.perf_counter()
+        for notification in notifications:
+            self.published_at[notification.id] = published_at
+        RABBITMQ_CLIENT.send_notification_messages([(notification.id, notification.recipient_id)
+                                                    for notification in notifications])
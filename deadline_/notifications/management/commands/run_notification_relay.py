@@ -0,0 +1,15 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from notifications.outbox import NotificationOutboxRelay
+
+logger = logging.getLogger('notifications')
+
+
+class Command(BaseCommand):
+    help = 'Starts the relay which publishes created notifications from the outbox to RabbitMQ'
+
+    def handle(self, *args, **options):
+        logger.info('Running the notification outbox relay')
+        NotificationOutboxRelay().run()
@@ -9,8 +9,10 @@ from django.core.management.base import BaseCommand
 
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())  # needs to be set before websockets for some reason
 
+from metrics import monitor_loop_lag, serve_metrics
 from notifications import channels, handlers
 from notifications.notifications_consumer import NotificationsConsumerConnection
+from notifications.presence import PresenceRegistry, keep_presence_alive
 from deadline.settings import RABBITMQ_CONNECTION_URL
 
 logger = logging.getLogger('notifications')
@@ -19,19 +21,33 @@ logger = logging.getLogger('notifications')
 class Command(BaseCommand):
     help = 'Starts message center chat engine'
 
+    def add_arguments(self, parser):
+        # several nodes can run side by side (e.g locally), as long as each has its own ID and ports
+        parser.add_argument('--node-id', default=settings.NOTIFICATIONS_NODE_ID)
+        parser.add_argument('--port', type=int, default=settings.NOTIFICATIONS_WS_SERVER_PORT)
+        parser.add_argument('--metrics-port', type=int, default=settings.NOTIFICATIONS_METRICS_PORT)
+
     def handle(self, *args, **options):
+        node_id, port = options['node_id'], options['port']
+        handlers.presence_registry = PresenceRegistry(node_id)
+        handlers.presence_registry.clear()
+
         asyncio.async(
             websockets.serve(
                 handlers.main_handler,
                 settings.NOTIFICATIONS_WS_SERVER_HOST,
-                settings.NOTIFICATIONS_WS_SERVER_PORT
+                port
             )
         )
 
-        asyncio.async(handlers.authenticate_user(channels.user_authentication))
-        asyncio.async(handlers.read_notification(channels.read_notification))
+        channels.user_authentication.start_workers(handlers.authenticate_user)
+        channels.read_notification.start_workers(handlers.read_notification)
+        channels.presence_updates.start_workers(handlers.update_presence)
+        asyncio.async(keep_presence_alive(handlers.presence_registry))
+        asyncio.async(monitor_loop_lag())
+        asyncio.async(serve_metrics(settings.NOTIFICATIONS_WS_SERVER_HOST, options['metrics_port']))
         loop = asyncio.get_event_loop()
 
-        NotificationsConsumerConnection(RABBITMQ_CONNECTION_URL, handlers.NotificationsHandler).run()
-        logger.info(f'Running WS server on {settings.NOTIFICATIONS_WS_SERVER_HOST}:{settings.NOTIFICATIONS_WS_SERVER_PORT}')
+        NotificationsConsumerConnection(RABBITMQ_CONNECTION_URL, handlers.NotificationsHandler, node_id).run()
+        logger.info(f'Running WS server node {node_id} on {settings.NOTIFICATIONS_WS_SERVER_HOST}:{port}')
         loop.run_forever()
@@ -0,0 +1,16 @@
+from datetime import timedelta
+
+from django.db import models
+from django.utils import timezone
+
+from notifications.constants import NOTIFICATION_PRESENCE_TTL_SECONDS
+
+
+class NotificationPresenceManager(models.Manager):
+    def alive(self):
+        """ Returns the presence rows which were refreshed recently enough to be trusted """
+        return self.filter(last_seen__gte=timezone.now() - timedelta(seconds=NOTIFICATION_PRESENCE_TTL_SECONDS))
+
+    def online_user_ids(self, user_ids: [int]) -> {int}:
+        """ Returns which of the given users are connected to a live node """
+        return set(self.alive().filter(user_id__in=user_ids).values_list('user_id', flat=True))
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationPresence',
+            fields=[
+                ('user_id', models.IntegerField(primary_key=True, serialize=False)),
+                ('node_id', models.CharField(db_index=True, max_length=100)),
+                ('is_authenticated', models.BooleanField(default=False)),
+                ('last_seen', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import models
+
+from notifications.managers import NotificationPresenceManager
+
+
+class NotificationPresence(models.Model):
+    """
+    The shared registry of which notification server node holds the websocket of which user.
+    Rows are refreshed by their node's heartbeat and a row whose last_seen is too old belongs to a dead node
+    """
+    user_id = models.IntegerField(primary_key=True)
+    node_id = models.CharField(max_length=100, db_index=True)
+    last_seen = models.DateTimeField()
+
+    objects = NotificationPresenceManager()
@@ -1,6 +1,7 @@
 """
 The RabbitMQ class which establishes the connection, creates exchanges/queues and delegates messages
 """
+import asyncio
 from datetime import datetime
 import logging
 
@@ -10,6 +11,10 @@ from pika.spec import BasicProperties, Basic
 from pika.channel import Channel
 from pika.frame import Method as FrameMethod
 
+from notifications.constants import NOTIFICATIONS_EXCHANGE, NOTIFICATIONS_EXCHANGE_TYPE, \
+    NOTIFICATION_CONSUMER_PREFETCH_COUNT, NOTIFICATION_DELIVERY_BATCH_SIZE, NOTIFICATION_DELIVERY_BATCH_WINDOW_SECONDS
+from notifications.routing import RecipientRoutingTable, routing_table, node_queue_name
+
 LOGGER = logging.getLogger('notifications')
 
 
@@ -36,6 +41,12 @@ class BaseRabbitMQConsumerConnection:
             and setup the correct handlers for receiving a message and closing a connection
     """
     NEEDED_STATIC_VARIABLES = ['EXCHANGE', 'EXCHANGE_TYPE', 'QUEUE', 'ROUTING_KEY']
+    QUEUE_OPTIONS = {}  # extra queue_declare arguments, e.g exclusive
+    PREFETCH_COUNT = 0  # the maximum amount of unacknowledged deliveries RabbitMQ sends us, 0 means unlimited
+    # If set, deliveries are collected into batches of up to BATCH_SIZE, waiting at most BATCH_WINDOW_SECONDS
+    #   for a batch to fill up, and are processed by the handler's receive_messages method
+    BATCH_SIZE = None
+    BATCH_WINDOW_SECONDS = 0
 
     def __init__(self, amqp_url: str, handler):
         """
@@ -47,12 +58,17 @@ class BaseRabbitMQConsumerConnection:
         self._consumer_tag = None
         self._url = amqp_url
         self.handler = handler
+        self._deliveries: asyncio.Queue = None
+        self._left_unacked = False  # whether a delivery on the current channel was not acknowledged
         self._validate_instantiation()
 
     def run(self):
         """
         Run the example consumer by connecting to RabbitMQ
         """
+        if self.BATCH_SIZE:
+            self._deliveries = asyncio.Queue()
+            asyncio.ensure_future(self.consume_batches())
         self._connection = self.connect()
 
     def connect(self) -> pika.adapters.AsyncioConnection:
@@ -64,18 +80,75 @@ class BaseRabbitMQConsumerConnection:
         return adapters.AsyncioConnection(pika.URLParameters(self._url),
                                           self.on_connection_open)
 
-    def on_message(self, _: Channel, basic_deliver: Basic.Deliver,
+    def on_message(self, channel: Channel, basic_deliver: Basic.Deliver,
                    __: BasicProperties, body: str):
         """
         The heart of this class, this is the method that processes a received message
-        It sends it to the consumer's receive_message method and expects a boolean value returned, indicating
+        It sends it to the consumer's receive_message coroutine and expects a boolean value returned, indicating
             if the message was processed
+        The processing runs as a separate task, as the handler might need to wait on the DB
+        In batch mode, the message is queued up for the next batch instead
         """
         LOGGER.info(f'Received message #{basic_deliver.delivery_tag}: {body}')
-        was_processed = self.handler.receive_message(body)
+        if self.BATCH_SIZE:
+            self._deliveries.put_nowait((channel, basic_deliver.delivery_tag, body))
+            return
+        asyncio.ensure_future(self.process_message(basic_deliver.delivery_tag, body))
+
+    async def process_message(self, delivery_tag: int, body: str):
+        was_processed = await self.handler.receive_message(body)
 
-        if was_processed:
-            self._channel.basic_ack(basic_deliver.delivery_tag)  # acknowledge that the message has been processed
+        if was_processed and self._channel is not None:
+            self._channel.basic_ack(delivery_tag)  # acknowledge that the message has been processed
+
+    async def consume_batches(self):
+        """
+        Collects the queued deliveries into batches and processes them one batch at a time.
+        Batches must not overlap, as a batch acknowledges every delivery before its last one at once
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self._deliveries.get()]
+            batch_deadline = loop.time() + self.BATCH_WINDOW_SECONDS
+            while len(batch) < self.BATCH_SIZE:
+                if not self._deliveries.empty():
+                    batch.append(self._deliveries.get_nowait())
+                    continue
+                time_left = batch_deadline - loop.time()
+                if time_left <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._deliveries.get(), time_left))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                await self.process_batch(batch)
+            except Exception as e:
+                LOGGER.error(f'Could not process a batch of {len(batch)} messages due to {e}')
+
+    async def process_batch(self, batch: [(Channel, int, str)]):
+        results = await self.handler.receive_messages([body for _, _, body in batch])
+
+        # deliveries from a closed channel can not be acknowledged, RabbitMQ will redeliver them
+        channel = self._channel
+        deliveries = [(delivery_tag, was_processed)
+                      for (delivery_channel, delivery_tag, _), was_processed in zip(batch, results)
+                      if channel is not None and delivery_channel is channel]
+        if not deliveries:
+            return
+
+        if not self._left_unacked and all(was_processed for _, was_processed in deliveries):
+            # acknowledges every delivery up to and including the last one
+            channel.basic_ack(deliveries[-1][0], multiple=True)
+            return
+
+        # an unprocessed delivery stays unacknowledged, so from now on we can only acknowledge one by one
+        for delivery_tag, was_processed in deliveries:
+            if was_processed:
+                channel.basic_ack(delivery_tag)
+            else:
+                self._left_unacked = True
 
     # Setup methods
 
@@ -91,7 +164,10 @@ class BaseRabbitMQConsumerConnection:
 
     def on_channel_open(self, channel: Channel):
         self._channel = channel
+        self._left_unacked = False
         self._channel.add_on_close_callback(self.on_channel_closed)
+        if self.PREFETCH_COUNT:
+            self._channel.basic_qos(prefetch_count=self.PREFETCH_COUNT)
 
         self.setup_exchange(self.EXCHANGE)
 
@@ -103,7 +179,7 @@ class BaseRabbitMQConsumerConnection:
 
     def on_successful_exchange_declaration(self, _: FrameMethod):
         # LOGGER.info('Exchange declared')
-        self._channel.queue_declare(self.on_successful_queue_declaration, self.QUEUE)
+        self._channel.queue_declare(self.on_successful_queue_declaration, self.QUEUE, **self.QUEUE_OPTIONS)
 
     def on_successful_queue_declaration(self, _: FrameMethod):
         """
@@ -193,13 +269,59 @@ class BaseRabbitMQConsumerConnection:
                 raise Exception(f'{var_name} needs to be defined for {self.__class__.__name__}')
         if not hasattr(self.handler, 'receive_message'):
             raise Exception('Consumer is required to have defined the receive_message method!')
+        if self.BATCH_SIZE and not hasattr(self.handler, 'receive_messages'):
+            raise Exception('A batching consumer is required to have defined the receive_messages method!')
 
 
 class NotificationsConsumerConnection(BaseRabbitMQConsumerConnection):
     """
-    This class defines the needed variables to establish a RabbitMQ connection
+    Consumes the notifications of the users connected to this node.
+    Every node has its own queue, bound only to the routing keys of its connected users (see notifications.routing)
+        and the bindings follow the users as they connect and disconnect
     """
-    EXCHANGE = 'notifications'
-    EXCHANGE_TYPE = 'fanout'
-    QUEUE = 'text'
-    ROUTING_KEY = 'example.text'
+    EXCHANGE = NOTIFICATIONS_EXCHANGE
+    EXCHANGE_TYPE = NOTIFICATIONS_EXCHANGE_TYPE
+    QUEUE_OPTIONS = {'exclusive': True}  # the queue dies with the node, its users will reconnect to another one
+    ROUTING_KEY = None  # bound dynamically
+    # bursts (e.g a new challenge notifying everybody) are delivered in batches, see NotificationsHandler.receive_messages
+    PREFETCH_COUNT = NOTIFICATION_CONSUMER_PREFETCH_COUNT
+    BATCH_SIZE = NOTIFICATION_DELIVERY_BATCH_SIZE
+    BATCH_WINDOW_SECONDS = NOTIFICATION_DELIVERY_BATCH_WINDOW_SECONDS
+
+    def __init__(self, amqp_url: str, handler, node_id: str, recipient_routing_table: RecipientRoutingTable=routing_table):
+        self.QUEUE = node_queue_name(node_id)
+        self.routing_table = recipient_routing_table
+        self._is_consuming = False
+        super().__init__(amqp_url, handler)
+        self.routing_table.consumer = self
+
+    def on_successful_queue_declaration(self, _: FrameMethod):
+        """
+        Binds the queue to the routing keys of the currently connected users and starts consuming
+        """
+        LOGGER.info(f'Binding {self.EXCHANGE} to queue {self.QUEUE} with {len(self.routing_table.routing_keys)} keys')
+        for routing_key in self.routing_table.routing_keys:
+            self._channel.queue_bind(self.on_routing_key_bound, self.QUEUE, self.EXCHANGE, routing_key)
+        self.on_bindok(None)
+        self._is_consuming = True
+
+    def bind_routing_key(self, routing_key: str):
+        if not self._is_consuming:
+            return  # the key will get bound once the queue is (re)declared
+        self._channel.queue_bind(self.on_routing_key_bound, self.QUEUE, self.EXCHANGE, routing_key)
+
+    def unbind_routing_key(self, routing_key: str):
+        if not self._is_consuming:
+            return
+        self._channel.queue_unbind(queue=self.QUEUE, exchange=self.EXCHANGE, routing_key=routing_key)
+
+    def on_routing_key_bound(self, _: FrameMethod):
+        pass
+
+    def on_connection_closed(self, connection: adapters.AsyncioConnection, reply_code: int, reply_text: str):
+        self._is_consuming = False
+        super().on_connection_closed(connection, reply_code, reply_text)
+
+    def on_channel_closed(self, channel: Channel, reply_code: int, reply_text: str):
+        self._is_consuming = False
+        super().on_channel_closed(channel, reply_code, reply_text)
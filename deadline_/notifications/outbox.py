@@ -0,0 +1,87 @@
+"""
+The relay which publishes created notifications from the NotificationOutboxEntry table to RabbitMQ.
+
+Every Notification gets an outbox entry in the transaction that creates it, so
+    - a notification is never published before it is committed
+    - a committed notification of an online recipient is always published, at least once, even if RabbitMQ was down
+Entries are published in batches, in the order they were created, and deleted once RabbitMQ confirms them.
+Entries of recipients who are not connected to any node (see PresenceRegistry) are deleted without being published,
+    as nobody would receive them - the recipient fetches his unread notifications once he comes online
+"""
+import logging
+import select
+import time
+
+from django.db import transaction, connection
+
+from deadline.settings import RABBITMQ_CLIENT
+from notifications.constants import NOTIFICATION_PUBLISH_BATCH_SIZE, NOTIFICATION_RELAY_POLL_SECONDS, \
+    NOTIFICATION_PUBLISH_RETRY_SECONDS, NOTIFICATION_OUTBOX_CHANNEL
+from notifications.models import NotificationPresence
+from social.models.notification import NotificationOutboxEntry
+
+logger = logging.getLogger('notifications')
+
+
+class NotificationOutboxRelay:
+    """
+    Drains the notification outbox into RabbitMQ.
+    Running more than one relay is safe, as the batch being published is locked,
+        but they will simply take turns
+    """
+    def __init__(self, rabbitmq_client=RABBITMQ_CLIENT, batch_size=NOTIFICATION_PUBLISH_BATCH_SIZE,
+                 poll_seconds=NOTIFICATION_RELAY_POLL_SECONDS):
+        self.rabbitmq_client = rabbitmq_client
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+
+    def drain_once(self) -> int:
+        """
+        Publishes the oldest batch of outbox entries whose recipients are online and deletes them all.
+        If the publish fails, the transaction is rolled back and the entries stay for the next attempt
+        :return: the number of drained entries
+        """
+        with transaction.atomic():
+            entries = list(NotificationOutboxEntry.objects.select_for_update().order_by('id')[:self.batch_size])
+            if not entries:
+                return 0
+
+            online_user_ids = NotificationPresence.objects.online_user_ids({entry.recipient_id for entry in entries})
+            online_entries = [entry for entry in entries if entry.recipient_id in online_user_ids]
+            if online_entries:
+                self.rabbitmq_client.send_notification_messages([(entry.notification_id, entry.recipient_id)
+                                                                  for entry in online_entries])
+            NotificationOutboxEntry.objects.filter(id__in=[entry.id for entry in entries]).delete()
+
+        return len(entries)
+
+    def run(self):
+        """ Drains the outbox forever, sleeping until a new entry gets committed or poll_seconds pass """
+        is_listening = False
+        while True:
+            try:
+                if not is_listening:
+                    self.listen()
+                    is_listening = True
+
+                published_count = self.drain_once()
+                if published_count < self.batch_size:
+                    self.wait_for_entries()
+            except Exception as e:
+                logger.error(f'Could not publish notifications from the outbox due to {e}, '
+                             f'retrying in {NOTIFICATION_PUBLISH_RETRY_SECONDS} seconds')
+                # the DB connection might be the culprit, start over with a fresh one
+                connection.close()
+                is_listening = False
+                time.sleep(NOTIFICATION_PUBLISH_RETRY_SECONDS)
+
+    def listen(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'LISTEN {NOTIFICATION_OUTBOX_CHANNEL};')
+
+    def wait_for_entries(self):
+        """ Blocks until Postgres notifies us of a committed outbox entry or poll_seconds pass """
+        pg_connection = connection.connection
+        if select.select([pg_connection], [], [], self.poll_seconds) != ([], [], []):
+            pg_connection.poll()
+            pg_connection.notifies.clear()
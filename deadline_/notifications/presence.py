@@ -0,0 +1,47 @@
+"""
+The shared presence registry of the notification server nodes.
+Every node records the users connected to it, so the outbox relay can skip the notifications of offline recipients
+"""
+import asyncio
+import logging
+
+from django.utils import timezone
+
+from async_helpers import run_in_db_thread
+from notifications.constants import NOTIFICATION_PRESENCE_HEARTBEAT_SECONDS
+from notifications.models import NotificationPresence
+
+logger = logging.getLogger('notifications')
+
+
+class PresenceRegistry:
+    """
+    Records the presence of the users connected to one node.
+    A user connected to several nodes is registered to the last one, the others do not remove him on disconnect
+    """
+    def __init__(self, node_id: str):
+        self.node_id = node_id
+
+    def connect(self, user_id: int):
+        NotificationPresence.objects.update_or_create(user_id=user_id, defaults={
+            'node_id': self.node_id, 'last_seen': timezone.now()
+        })
+
+    def disconnect(self, user_id: int):
+        NotificationPresence.objects.filter(user_id=user_id, node_id=self.node_id).delete()
+
+    def heartbeat(self):
+        NotificationPresence.objects.filter(node_id=self.node_id).update(last_seen=timezone.now())
+
+    def clear(self):
+        """ Removes everything left over from a previous run of this node """
+        NotificationPresence.objects.filter(node_id=self.node_id).delete()
+
+
+async def keep_presence_alive(registry: PresenceRegistry, interval=NOTIFICATION_PRESENCE_HEARTBEAT_SECONDS):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_db_thread(registry.heartbeat)
+        except Exception as e:
+            logger.error(f'Could not refresh the presence of node {registry.node_id} due to {e}')
@@ -37,7 +37,11 @@ class MessageRouter:
     def __call__(self):
         logger.debug('routing message: {}'.format(self.packet))
         send_queue = self.get_send_queue()
-        yield from send_queue.put(self.packet)
+        yield from send_queue.put(self.packet, shard_key=self.get_shard_key())
+
+    def get_shard_key(self):
+        """ The messages of a user are handled in order """
+        return self.packet['user_id']
 
     def get_send_queue(self):
         return self.MESSAGE_QUEUES[self.packet['type']]
@@ -0,0 +1,55 @@
+"""
+Routing of notifications to the notification server node which holds the recipient's websocket.
+
+Every recipient hashes to one of NOTIFICATION_ROUTING_SHARDS routing keys and notifications are published with it.
+Every node declares its own queue and binds it only to the routing keys of the users connected to it,
+    so a node only ever receives the notifications of (roughly) the recipients it holds
+"""
+import logging
+
+from notifications.constants import NOTIFICATION_ROUTING_SHARDS, NOTIFICATION_NODE_QUEUE_PREFIX
+
+logger = logging.getLogger('notifications')
+
+
+def recipient_routing_key(recipient_id: int) -> str:
+    return f'recipient.{int(recipient_id) % NOTIFICATION_ROUTING_SHARDS}'
+
+
+def node_queue_name(node_id: str) -> str:
+    return f'{NOTIFICATION_NODE_QUEUE_PREFIX}{node_id}'
+
+
+class RecipientRoutingTable:
+    """
+    Keeps count of the connected users per routing key on this node.
+    The consumer gets told to bind a routing key once its first user connects and to unbind it once its last one leaves
+    """
+    def __init__(self):
+        self._connection_counts: {str: int} = {}
+        self.consumer = None  # set by the consumer connection, see NotificationsConsumerConnection
+
+    @property
+    def routing_keys(self) -> [str]:
+        return list(self._connection_counts.keys())
+
+    def add_recipient(self, user_id: int):
+        routing_key = recipient_routing_key(user_id)
+        self._connection_counts[routing_key] = self._connection_counts.get(routing_key, 0) + 1
+        if self._connection_counts[routing_key] == 1 and self.consumer is not None:
+            self.consumer.bind_routing_key(routing_key)
+
+    def remove_recipient(self, user_id: int):
+        routing_key = recipient_routing_key(user_id)
+        if routing_key not in self._connection_counts:
+            logger.warning(f'Tried to remove recipient {user_id} which was not in the routing table')
+            return
+
+        self._connection_counts[routing_key] -= 1
+        if self._connection_counts[routing_key] == 0:
+            del self._connection_counts[routing_key]
+            if self.consumer is not None:
+                self.consumer.unbind_routing_key(routing_key)
+
+
+routing_table = RecipientRoutingTable()
@@ -1,13 +1,25 @@
-from unittest.mock import MagicMock, patch
+from datetime import timedelta
+from unittest.mock import MagicMock, patch, call
 
 import asyncio
 from django.test import TestCase
+from django.utils import timezone
 
 from challenges.tests.base import TestHelperMixin
+from challenges.tests.factories import UserFactory
+from challenges.tests.helpers import run_async, run_inline, coroutine_mock
+from external_services import RabbitMQClient
+from notifications.constants import NOTIFICATION_ROUTING_SHARDS, NOTIFICATION_PRESENCE_TTL_SECONDS
 from notifications.errors import NotificationAlreadyRead, OfflineRecipientError, RecipientMismatchError, \
     InvalidNotificationToken
-from notifications.handlers import NotificationsHandler, _read_notification
-from social.models.notification import Notification
+from notifications import handlers
+from notifications.handlers import NotificationsHandler, _read_notification, update_presence
+from notifications.models import NotificationPresence
+from notifications.notifications_consumer import NotificationsConsumerConnection
+from notifications.outbox import NotificationOutboxRelay
+from notifications.presence import PresenceRegistry
+from notifications.routing import RecipientRoutingTable, recipient_routing_key, node_queue_name
+from social.models.notification import Notification, NotificationOutboxEntry
 from social.serializers import NotificationSerializer
 
 
@@ -16,13 +28,15 @@ class NotificationsHandlerTests(TestCase, TestHelperMixin):
         self.base_set_up(create_user=True)
         self.notification = Notification.objects.create_new_challenge_notification(recipient=self.auth_user, challenge=self.challenge)
 
+    @patch('notifications.handlers.run_in_db_thread', run_inline)
     def test_receive_message_functions(self):
         with patch('notifications.handlers.ws_connections', {self.notification.recipient_id: MagicMock()}):
-            self.assertTrue(NotificationsHandler.receive_message(str(self.notification.id)))
+            self.assertTrue(run_async(NotificationsHandler.receive_message(str(self.notification.id))))
 
+    @patch('notifications.handlers.run_in_db_thread', run_inline)
     @patch('notifications.handlers.NotificationsHandler.validate_notification')
     def test_fetch_notification_returns_notif_and_calls_validate(self, mock_validate_notif):
-        received_notif = NotificationsHandler.fetch_notification(self.notification.id)
+        received_notif = run_async(NotificationsHandler.fetch_notification(self.notification.id))
         self.assertEqual(received_notif, self.notification)
         mock_validate_notif.assert_called_once_with(self.notification)
 
@@ -48,115 +62,213 @@ class NotificationsHandlerTests(TestCase, TestHelperMixin):
             with self.assertRaises(OfflineRecipientError):
                 NotificationsHandler.validate_notification(self.notification)
 
-    @patch('notifications.handlers.NotificationsHandler.fetch_notification')
     @patch('notifications.handlers.NotificationsHandler.send_notification')
-    @patch('notifications.handlers.asyncio.ensure_future')
-    def test_receive_message_calls_expected_methods(self, mock_ensure_future, mock_send_notif, mock_fetch):
-        mock_send_notif.return_value = 'fixThis'
-        mock_fetch.return_value = 'HipHop'
+    def test_receive_message_calls_expected_methods(self, mock_send_notif):
+        mock_fetch = coroutine_mock(return_value='HipHop')
 
-        is_processed = NotificationsHandler.receive_message('1')
+        with patch('notifications.handlers.NotificationsHandler.fetch_notification', mock_fetch):
+            is_processed = run_async(NotificationsHandler.receive_message('1'))
 
         self.assertTrue(is_processed)
-        mock_fetch.assert_called_once_with(1)
-        mock_send_notif.assert_called_once_with(mock_fetch.return_value)
-        mock_ensure_future.assert_called_once_with(mock_send_notif.return_value)
+        mock_fetch.mock.assert_called_once_with(1)
+        mock_send_notif.assert_called_once_with('HipHop')
 
-    @patch('notifications.handlers.NotificationsHandler.fetch_notification')
     @patch('notifications.handlers.NotificationsHandler.send_notification')
-    def test_receive_message_returns_true_on_notif_already_read_error(self, mock_send, mock_fetch):
-        mock_fetch.side_effect = NotificationAlreadyRead()
+    def test_receive_message_returns_true_on_notif_already_read_error(self, mock_send):
+        mock_fetch = coroutine_mock(side_effect=NotificationAlreadyRead())
 
-        is_processed = NotificationsHandler.receive_message('1111')
+        with patch('notifications.handlers.NotificationsHandler.fetch_notification', mock_fetch):
+            is_processed = run_async(NotificationsHandler.receive_message('1111'))
 
         self.assertTrue(is_processed)
-        mock_fetch.assert_called_once_with(1111)
+        mock_fetch.mock.assert_called_once_with(1111)
         mock_send.assert_not_called()
 
-    @patch('notifications.handlers.NotificationsHandler.fetch_notification')
     @patch('notifications.handlers.NotificationsHandler.send_notification')
-    def test_receive_message_returns_true_on_notif_doesnt_exist_err(self, mock_send, mock_fetch):
-        mock_fetch.side_effect = Notification.DoesNotExist()
-        is_processed = NotificationsHandler.receive_message('1111')
+    def test_receive_message_returns_true_on_notif_doesnt_exist_err(self, mock_send):
+        mock_fetch = coroutine_mock(side_effect=Notification.DoesNotExist())
+
+        with patch('notifications.handlers.NotificationsHandler.fetch_notification', mock_fetch):
+            is_processed = run_async(NotificationsHandler.receive_message('1111'))
 
         self.assertTrue(is_processed)
-        mock_fetch.assert_called_once_with(1111)
+        mock_fetch.mock.assert_called_once_with(1111)
         mock_send.assert_not_called()
 
-    @patch('notifications.handlers.NotificationsHandler.fetch_notification')
     @patch('notifications.handlers.NotificationsHandler.send_notification')
-    def test_receive_message_returns_true_on_offlineRecipientError(self, mock_send, mock_fetch):
-        mock_fetch.side_effect = OfflineRecipientError()
-        is_processed = NotificationsHandler.receive_message('1111')
+    def test_receive_message_returns_true_on_offlineRecipientError(self, mock_send):
+        mock_fetch = coroutine_mock(side_effect=OfflineRecipientError())
+
+        with patch('notifications.handlers.NotificationsHandler.fetch_notification', mock_fetch):
+            is_processed = run_async(NotificationsHandler.receive_message('1111'))
 
         self.assertTrue(is_processed)
-        mock_fetch.assert_called_once_with(1111)
+        mock_fetch.mock.assert_called_once_with(1111)
         mock_send.assert_not_called()
 
     @patch('notifications.handlers.NotificationsHandler.send_notification')
     def test_receive_message_returns_false_on_invalid_message(self, mock_send):
         """ This is unexpected, as most probably the message structure is not as expected
         (not a valid int for the parsing), as such, it should not bep rocessed """
-        is_processed = NotificationsHandler.receive_message('{"notif_id": "1"}')
+        is_processed = run_async(NotificationsHandler.receive_message('{"notif_id": "1"}'))
         self.assertFalse(is_processed)
         mock_send.assert_not_called()
 
-    @patch('notifications.handlers.NotificationsHandler.fetch_notification')
     @patch('notifications.handlers.NotificationsHandler.send_notification')
-    def test_receive_message_returns_false_on_other_error(self, mock_send, mock_fetch):
+    def test_receive_message_returns_false_on_other_error(self, mock_send):
         """ This is an unexpected error and as such the message should be marked as non-processed"""
-        mock_fetch.side_effect = Exception()
-        is_processed = NotificationsHandler.receive_message('1111')
+        mock_fetch = coroutine_mock(side_effect=Exception())
+
+        with patch('notifications.handlers.NotificationsHandler.fetch_notification', mock_fetch):
+            is_processed = run_async(NotificationsHandler.receive_message('1111'))
 
         self.assertFalse(is_processed)
         mock_send.assert_not_called()
 
-    @patch('notifications.handlers.asyncio.ensure_future')
-    def test_send_notification_send_message(self, mock_ensure):
-        @asyncio.coroutine
-        def _test():
-            send_message_mock = MagicMock()
-            send_message_mock.return_value = 1
-            expected_message = {
-                "type": "NOTIFICATION",
-                "notification": NotificationSerializer(self.notification).data
-            }
-            ws_conn_mock = MagicMock(send_message=send_message_mock, is_valid=True)
-            with patch('notifications.handlers.ws_connections', {self.notification.recipient_id: ws_conn_mock}):
-                yield from NotificationsHandler.send_notification(self.notification)
-
-            send_message_mock.assert_called_once_with(expected_message)
-            mock_ensure.assert_called_once_with(send_message_mock.return_value)
-        self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(None)
-        self.loop.run_until_complete(_test())
-
-    @patch('notifications.handlers.asyncio.ensure_future')
-    def test_send_notification_doesnt_send_if_recipient_not_in_ws(self, mock_ensure):
-        @asyncio.coroutine
-        def _test():
-            with patch('notifications.handlers.ws_connections', {}):
-                yield from NotificationsHandler.send_notification(self.notification)
-                mock_ensure.assert_not_called()
-        self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(None)
-        self.loop.run_until_complete(_test())
-
-    @patch('notifications.handlers.asyncio.ensure_future')
-    def test_send_notification_doesnt_send_if_recipient_not_validated(self, mock_ensure):
-        @asyncio.coroutine
-        def _test():
-            send_message_mock = MagicMock()
-            send_message_mock.return_value = 1
-
-            ws_conn_mock = MagicMock(send_message=send_message_mock, is_valid=False)
-            with patch('notifications.handlers.ws_connections', {self.notification.recipient_id: ws_conn_mock}):
-                yield from NotificationsHandler.send_notification(self.notification)
-            send_message_mock.assert_not_called()
-            mock_ensure.assert_not_called()
-        self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(None)
-        self.loop.run_until_complete(_test())
+    def test_send_notification_send_message(self):
+        send_message_mock = MagicMock()
+        expected_message = {
+            "type": "NOTIFICATION",
+            "notification": NotificationSerializer(self.notification).data
+        }
+        ws_conn_mock = MagicMock(send_message=send_message_mock, is_valid=True)
+        with patch('notifications.handlers.ws_connections', {self.notification.recipient_id: ws_conn_mock}):
+            NotificationsHandler.send_notification(self.notification)
+
+        send_message_mock.assert_called_once_with(expected_message, coalesce_key=f'notification:{self.notification.id}',
+                                                  droppable=True)
+
+    def test_send_notification_doesnt_send_if_recipient_not_in_ws(self):
+        with patch('notifications.handlers.ws_connections', {}):
+            NotificationsHandler.send_notification(self.notification)
+
+    def test_send_notification_doesnt_send_if_recipient_not_validated(self):
+        send_message_mock = MagicMock()
+
+        ws_conn_mock = MagicMock(send_message=send_message_mock, is_valid=False)
+        with patch('notifications.handlers.ws_connections', {self.notification.recipient_id: ws_conn_mock}):
+            NotificationsHandler.send_notification(self.notification)
+        send_message_mock.assert_not_called()
+
+
+@patch('notifications.handlers.run_in_db_thread', run_inline)
+class NotificationsHandlerBatchTests(TestCase, TestHelperMixin):
+    def setUp(self):
+        self.base_set_up(create_user=True)
+        self.second_user = UserFactory()
+        self.first_notifs = [Notification.objects.create_new_challenge_notification(recipient=self.auth_user,
+                                                                                   challenge=self.challenge)
+                             for _ in range(2)]
+        self.second_notif = Notification.objects.create_new_challenge_notification(recipient=self.second_user,
+                                                                                  challenge=self.challenge)
+        self.first_conn, self.second_conn = MagicMock(is_valid=True), MagicMock(is_valid=True)
+        self.ws_connections = {self.auth_user.id: self.first_conn, self.second_user.id: self.second_conn}
+
+    def receive_messages(self, msgs):
+        with patch('notifications.handlers.ws_connections', self.ws_connections):
+            return run_async(NotificationsHandler.receive_messages(msgs))
+
+    def test_sends_one_frame_per_recipient(self):
+        with self.assertNumQueries(1):
+            results = self.receive_messages([str(notif.id) for notif in self.first_notifs + [self.second_notif]])
+
+        self.assertEqual(results, [True, True, True])
+        self.first_conn.send_message.assert_called_once_with({
+            "type": "NOTIFICATIONS",
+            "notifications": NotificationSerializer(self.first_notifs, many=True).data
+        }, droppable=True)
+        self.second_conn.send_message.assert_called_once_with({
+            "type": "NOTIFICATION",
+            "notification": NotificationSerializer(self.second_notif).data
+        }, coalesce_key=f'notification:{self.second_notif.id}', droppable=True)
+
+    def test_skips_read_duplicate_and_missing_notifications(self):
+        self.first_notifs[0].is_read = True
+        self.first_notifs[0].save()
+
+        results = self.receive_messages([str(self.first_notifs[0].id), str(self.first_notifs[1].id),
+                                            str(self.first_notifs[1].id), '111111'])
+
+        self.assertEqual(results, [True, True, True, True])
+        self.first_conn.send_message.assert_called_once_with({
+            "type": "NOTIFICATION",
+            "notification": NotificationSerializer(self.first_notifs[1]).data
+        }, coalesce_key=f'notification:{self.first_notifs[1].id}', droppable=True)
+
+    def test_skips_offline_and_unauthenticated_recipients(self):
+        self.ws_connections.pop(self.auth_user.id)
+        self.second_conn.is_valid = False
+
+        results = self.receive_messages([str(notif.id) for notif in self.first_notifs + [self.second_notif]])
+
+        self.assertEqual(results, [True, True, True])
+        self.second_conn.send_message.assert_not_called()
+
+    def test_invalid_message_is_not_processed(self):
+        results = self.receive_messages(['{"notif_id": 1}', str(self.second_notif.id)])
+
+        self.assertEqual(results, [False, True])
+        self.second_conn.send_message.assert_called_once()
+
+    @patch('notifications.handlers.NotificationsHandler.fetch_notifications')
+    def test_no_message_is_processed_on_fetch_error(self, mock_fetch):
+        mock_fetch.side_effect = Exception()
+
+        results = self.receive_messages([str(self.second_notif.id), '1'])
+
+        self.assertEqual(results, [False, False])
+        self.second_conn.send_message.assert_not_called()
+
+
+class NotificationsConsumerBatchTests(TestCase):
+    def setUp(self):
+        self.handler = MagicMock()
+        self.consumer = NotificationsConsumerConnection('amqp://', self.handler, 'node', RecipientRoutingTable())
+        self.channel = MagicMock()
+        self.consumer._channel = self.channel
+
+    def process_batch(self, results, channel=None):
+        self.handler.receive_messages = coroutine_mock(return_value=results)
+        batch = [(channel or self.channel, delivery_tag, str(delivery_tag)) for delivery_tag in range(1, len(results) + 1)]
+        run_async(self.consumer.process_batch(batch))
+
+    def test_processed_batch_is_acknowledged_at_once(self):
+        self.process_batch([True, True, True])
+
+        self.handler.receive_messages.mock.assert_called_once_with(['1', '2', '3'])
+        self.channel.basic_ack.assert_called_once_with(3, multiple=True)
+
+    def test_batch_with_unprocessed_message_is_acknowledged_one_by_one(self):
+        self.process_batch([True, False, True])
+        self.assertEqual(self.channel.basic_ack.call_args_list, [call(1), call(3)])
+
+        # the unprocessed message must not get acknowledged by a later batch
+        self.channel.basic_ack.reset_mock()
+        self.process_batch([True])
+        self.channel.basic_ack.assert_called_once_with(1)
+
+    def test_deliveries_of_closed_channel_are_not_acknowledged(self):
+        self.process_batch([True, True], channel=MagicMock())
+        self.channel.basic_ack.assert_not_called()
+
+    def test_consume_batches_collects_up_to_batch_size(self):
+        self.consumer.BATCH_SIZE = 2
+        self.consumer.process_batch = coroutine_mock()
+
+        async def _test():
+            self.consumer._deliveries = asyncio.Queue()
+            for delivery_tag in range(1, 4):
+                self.consumer._deliveries.put_nowait((self.channel, delivery_tag, str(delivery_tag)))
+            consumer_task = asyncio.ensure_future(self.consumer.consume_batches())
+            await asyncio.sleep(self.consumer.BATCH_WINDOW_SECONDS * 2)
+            consumer_task.cancel()
+
+        run_async(_test())
+
+        self.assertEqual(self.consumer.process_batch.mock.call_args_list, [
+            call([(self.channel, 1, '1'), (self.channel, 2, '2')]),
+            call([(self.channel, 3, '3')])
+        ])
 
 
 class ReadNotificationHandlerTests(TestCase, TestHelperMixin):
@@ -165,42 +277,236 @@ class ReadNotificationHandlerTests(TestCase, TestHelperMixin):
         self.user_obj_mock = MagicMock(id=self.user_id)
         self.user_connection_mock = MagicMock(user=self.user_obj_mock, is_valid=True)
         self.ws_connections_mock = {self.user_id: self.user_connection_mock}
+        self.message = {'type': 'read_notification', 'notification_id': 1, 'user_id': self.user_id, 'token': ''}
 
     def test_sets_notif_is_read(self):
         self.base_set_up(create_user=True)
         self.notification = Notification.objects.create_new_challenge_notification(recipient=self.auth_user,
                                                                                    challenge=self.challenge)
         self.user_obj_mock.id = self.auth_user.id
-        with patch('notifications.handlers.ws_connections', {self.auth_user.id: self.user_connection_mock}) as mock_conn:
-            _read_notification('notification_token', self.auth_user.id, self.notification.id)
-
-            self.user_connection_mock.user.notification_token_is_valid.assert_called_once_with('notification_token')
+        _read_notification('notification_token', self.user_obj_mock, self.notification.id)
 
-            self.notification.refresh_from_db()
-            self.assertTrue(self.notification.is_read)
+        self.user_obj_mock.notification_token_is_valid.assert_called_once_with('notification_token')
+        self.notification.refresh_from_db()
+        self.assertTrue(self.notification.is_read)
 
     def test_raises_recipient_mismatch_error_if_user_is_not_recipient_of_notification(self):
         self.base_set_up(create_user=True)
         self.notification = Notification.objects.create_new_challenge_notification(recipient=self.auth_user, challenge=self.challenge)
         self.user_obj_mock.id = 111
-        with patch('notifications.handlers.ws_connections', {111: self.user_connection_mock}) as mock_conn:
-            with self.assertRaises(RecipientMismatchError):
-                _read_notification('notification_token', 111, self.notification.id)
-                self.user_connection_mock.user.notification_token_is_valid.assert_called_once_with('notification_token')
+        with self.assertRaises(RecipientMismatchError):
+            _read_notification('notification_token', self.user_obj_mock, self.notification.id)
 
-    def test_raises_offline_recipient_error_if_user_not_authenticated(self):
+    def test_invalid_token_raises_invalid_notification_token(self):
+        self.user_obj_mock.notification_token_is_valid.return_value = False
+        with self.assertRaises(InvalidNotificationToken):
+            _read_notification('', self.user_obj_mock, 1)
+
+    @patch('notifications.handlers.run_in_db_thread')
+    def test_ignores_user_not_connected(self, mock_run_in_db_thread):
+        self.message['user_id'] = self.user_id + 1
         with patch('notifications.handlers.ws_connections', self.ws_connections_mock):
-            with self.assertRaises(OfflineRecipientError):
-                _read_notification('', self.user_id + 1, 1)
+            run_async(handlers.read_notification(self.message))
+        mock_run_in_db_thread.assert_not_called()
 
-    def test_raises_offline_recipient_error_if_user_not_connected(self):
+    @patch('notifications.handlers.run_in_db_thread')
+    def test_ignores_user_not_authenticated(self, mock_run_in_db_thread):
         self.user_connection_mock.is_valid = False
         with patch('notifications.handlers.ws_connections', self.ws_connections_mock):
-            with self.assertRaises(OfflineRecipientError):
-                _read_notification('', self.user_id, 1)
+            run_async(handlers.read_notification(self.message))
+        mock_run_in_db_thread.assert_not_called()
+        self.user_connection_mock.send_message.assert_not_called()
 
-    def test_invalid_token_raises_invalid_notification_token(self):
-        self.user_obj_mock.notification_token_is_valid.return_value = False
-        with patch('notifications.handlers.ws_connections', self.ws_connections_mock):
-            with self.assertRaises(InvalidNotificationToken):
-                _read_notification('', self.user_id, 1)
+    def test_replies_through_connection_even_if_user_disconnects_meanwhile(self):
+        """ The socket can go away during the DB round trip, the reply should not look it up again """
+        async def disconnect(*args):
+            del self.ws_connections_mock[self.user_id]
+
+        with patch('notifications.handlers.ws_connections', self.ws_connections_mock), \
+                patch('notifications.handlers.run_in_db_thread', disconnect):
+            run_async(handlers.read_notification(self.message))
+
+        self.assertEqual(self.user_connection_mock.send_message.call_args[0][0]['type'], 'OK')
+
+
+class NotificationOutboxRelayTests(TestCase, TestHelperMixin):
+    def setUp(self):
+        self.base_set_up(create_user=True)
+        self.client_mock = MagicMock()
+        self.relay = NotificationOutboxRelay(self.client_mock, batch_size=2)
+        self.notifications = [Notification.objects.create_new_challenge_notification(recipient=self.auth_user,
+                                                                                     challenge=self.challenge)
+                              for _ in range(3)]
+        PresenceRegistry('first').connect(self.auth_user.id)
+
+    def test_drain_once_publishes_oldest_batch_in_order_and_deletes_it(self):
+        published_count = self.relay.drain_once()
+
+        self.assertEqual(published_count, 2)
+        self.client_mock.send_notification_messages.assert_called_once_with(
+            [(notif.id, self.auth_user.id) for notif in self.notifications[:2]])
+        self.assertEqual(list(NotificationOutboxEntry.objects.values_list('notification_id', flat=True)),
+                         [self.notifications[2].id])
+
+    def test_drain_once_keeps_entries_if_publish_fails(self):
+        self.client_mock.send_notification_messages.side_effect = Exception()
+
+        with self.assertRaises(Exception):
+            self.relay.drain_once()
+
+        self.assertEqual(NotificationOutboxEntry.objects.count(), 3)
+
+    def test_drain_once_deletes_entries_of_offline_recipients_without_publishing_them(self):
+        NotificationPresence.objects.all().delete()
+
+        self.assertEqual(self.relay.drain_once(), 2)
+        self.client_mock.send_notification_messages.assert_not_called()
+        self.assertEqual(NotificationOutboxEntry.objects.count(), 1)
+
+    def test_drain_once_returns_zero_on_empty_outbox(self):
+        NotificationOutboxEntry.objects.all().delete()
+
+        self.assertEqual(self.relay.drain_once(), 0)
+        self.client_mock.send_notification_messages.assert_not_called()
+
+
+class LocalBroker:
+    """
+    A stand-in for RabbitMQ's direct exchange, acting as the channel of both the publisher and the node consumers.
+    Every published message is put in each queue bound to its routing key
+    """
+    def __init__(self):
+        self.bindings: {str: set} = {}
+        self.queues: {str: list} = {}
+
+    def queue_bind(self, callback, queue, exchange, routing_key):
+        self.bindings.setdefault(routing_key, set()).add(queue)
+        callback(None)
+
+    def queue_unbind(self, queue, exchange, routing_key):
+        self.bindings[routing_key].discard(queue)
+
+    def basic_publish(self, exchange, routing_key, body):
+        for queue in self.bindings.get(routing_key, ()):
+            self.queues.setdefault(queue, []).append(body)
+        return True
+
+    def confirm_delivery(self):
+        pass
+
+    def exchange_declare(self, *args, **kwargs):
+        pass
+
+    def add_on_cancel_callback(self, callback):
+        pass
+
+    def basic_consume(self, callback, queue):
+        return f'ctag-{queue}'
+
+
+class NotificationRoutingTests(TestCase):
+    def setUp(self):
+        self.broker = LocalBroker()
+        with patch('external_services.pika.BlockingConnection') as connection_mock:
+            connection_mock.return_value.channel.return_value = self.broker
+            self.publisher = RabbitMQClient(MagicMock())
+            self.publisher.connect()
+        self.first_node_table, self.first_node = self.start_node('first')
+        self.second_node_table, self.second_node = self.start_node('second')
+
+    def start_node(self, node_id, routing_table=None):
+        routing_table = routing_table or RecipientRoutingTable()
+        consumer = NotificationsConsumerConnection('amqp://', MagicMock(), node_id, routing_table)
+        consumer._channel = self.broker
+        consumer.on_successful_queue_declaration(None)
+        return routing_table, consumer
+
+    def received_messages(self, node_id):
+        return self.broker.queues.get(node_queue_name(node_id), [])
+
+    def test_recipient_routing_key_is_stable_and_sharded(self):
+        self.assertEqual(recipient_routing_key(1), recipient_routing_key(1))
+        self.assertEqual(recipient_routing_key(1), recipient_routing_key(1 + NOTIFICATION_ROUTING_SHARDS))
+        self.assertNotEqual(recipient_routing_key(1), recipient_routing_key(2))
+
+    def test_nodes_receive_only_the_notifications_of_their_recipients(self):
+        self.first_node_table.add_recipient(1)
+        self.second_node_table.add_recipient(2)
+
+        self.publisher.send_notification_messages([(10, 1), (20, 2), (30, 3)])
+
+        self.assertEqual(self.received_messages('first'), ['10'])
+        self.assertEqual(self.received_messages('second'), ['20'])
+
+    def test_routing_key_is_unbound_once_its_last_recipient_leaves(self):
+        self.first_node_table.add_recipient(1)
+        self.first_node_table.add_recipient(1 + NOTIFICATION_ROUTING_SHARDS)
+
+        self.first_node_table.remove_recipient(1)
+        self.publisher.send_notification_message(10, 1 + NOTIFICATION_ROUTING_SHARDS)
+        self.first_node_table.remove_recipient(1 + NOTIFICATION_ROUTING_SHARDS)
+        self.publisher.send_notification_message(20, 1 + NOTIFICATION_ROUTING_SHARDS)
+
+        self.assertEqual(self.received_messages('first'), ['10'])
+        self.assertEqual(self.first_node_table.routing_keys, [])
+
+    def test_recipients_connected_before_the_queue_is_declared_get_bound(self):
+        routing_table = RecipientRoutingTable()
+        routing_table.add_recipient(5)
+        self.start_node('third', routing_table)
+
+        self.publisher.send_notification_message(50, 5)
+
+        self.assertEqual(self.received_messages('third'), ['50'])
+
+
+@patch('notifications.handlers.run_in_db_thread', run_inline)
+class PresenceUpdatesTests(TestCase, TestHelperMixin):
+    def setUp(self):
+        self.base_set_up(create_user=True)
+
+    def test_update_presence_applies_updates(self):
+        registry = PresenceRegistry('first')
+
+        run_async(update_presence((registry.connect, self.auth_user.id)))
+        run_async(update_presence((registry.disconnect, self.auth_user.id)))
+
+        self.assertEqual(NotificationPresence.objects.online_user_ids([self.auth_user.id]), set())
+
+
+class PresenceRegistryTests(TestCase):
+    def setUp(self):
+        self.first_registry = PresenceRegistry('first')
+        self.second_registry = PresenceRegistry('second')
+
+    def test_connect_records_node_of_user(self):
+        self.first_registry.connect(1)
+
+        self.assertEqual(NotificationPresence.objects.get(user_id=1).node_id, 'first')
+        self.assertEqual(NotificationPresence.objects.online_user_ids([1, 2]), {1})
+
+    def test_connect_moves_user_to_latest_node_and_old_node_cannot_remove_him(self):
+        self.first_registry.connect(1)
+        self.second_registry.connect(1)
+        self.first_registry.disconnect(1)
+
+        self.assertEqual(NotificationPresence.objects.get(user_id=1).node_id, 'second')
+
+    def test_stale_presence_is_not_online(self):
+        self.first_registry.connect(1)
+        self.first_registry.connect(2)
+        NotificationPresence.objects.filter(user_id=1).update(
+            last_seen=timezone.now() - timedelta(seconds=NOTIFICATION_PRESENCE_TTL_SECONDS + 1))
+
+        self.assertEqual(NotificationPresence.objects.online_user_ids([1, 2]), {2})
+
+        self.first_registry.heartbeat()
+        self.assertEqual(NotificationPresence.objects.online_user_ids([1, 2]), {1, 2})
+
+    def test_clear_removes_only_own_presence(self):
+        self.first_registry.connect(1)
+        self.second_registry.connect(2)
+
+        self.first_registry.clear()
+
+        self.assertEqual(list(NotificationPresence.objects.values_list('user_id', flat=True)), [2])
@@ -1,5 +1,6 @@
-import asyncio
+from async_helpers import ShardedQueue
 
-new_messages = asyncio.Queue()
-authenticate = asyncio.Queue()
-is_typing = asyncio.Queue()
+# sharded by dialog, see MessageRouter
+new_messages = ShardedQueue('chat.new_messages')
+authenticate = ShardedQueue('chat.authenticate')
+is_typing = ShardedQueue('chat.is_typing')
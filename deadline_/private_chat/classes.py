@@ -1,9 +1,40 @@
+import time
+
+from private_chat.constants import TYPING_EVENT_WINDOW_SECONDS
+from websocket_sender import WebSocketSender
+
+
 class WebSocketConnection:
+    """
+    A participant's connection to a dialog.
+    Once authenticated, it holds the session - the participants and their dialog,
+        so that the messages which follow need no identity queries
+    """
     def __init__(self, socket, owner_id, opponent_id):
         self.web_socket = socket
         self.owner_id = owner_id
         self.opponent_id = opponent_id
         self.is_valid = False
+        self.sender = WebSocketSender(socket)
+        self.owner = None
+        self.opponent = None
+        self.dialog = None
+        self._typing_forwarded_at = None
+
+    def start_session(self, owner, opponent, dialog):
+        self.owner, self.opponent, self.dialog = owner, opponent, dialog
+        self.is_valid = True
+
+    def throttle_typing(self, window=TYPING_EVENT_WINDOW_SECONDS) -> bool:
+        """
+        Typing events fire on every keystroke, so we forward at most one per window.
+        :return: a boolean indicating if the typing event should be dropped
+        """
+        now = time.monotonic()
+        if self._typing_forwarded_at is not None and now - self._typing_forwarded_at < window:
+            return True
+        self._typing_forwarded_at = now
+        return False
 
     def __hash__(self):
         return hash(str(self.owner_id) + str(self.opponent_id))
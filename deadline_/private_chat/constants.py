@@ -6,3 +6,8 @@ AUTHORIZATION_ERR_TYPE = 'NO_AUTHORIZATION'
 NOT_FOUND_ERR_TYPE = 'NOT_FOUND'
 VALIDATION_ERR_TYPE = 'VALIDATION_ERROR'
 WARNING_ERR_TYPE = 'WARNING'
+MESSAGE_FLUSH_INTERVAL_SECONDS = 0.5  # the longest a relayed chat message waits before it gets persisted
+MESSAGE_FLUSH_BATCH_SIZE = 200  # the most messages persisted in a single query, a full batch is flushed right away
+MESSAGE_MAX_PENDING = 5000  # over this many unpersisted messages, new ones wait for a flush
+MESSAGE_ID_BLOCK_SIZE = 100  # how many message IDs we reserve from the DB sequence at once
+TYPING_EVENT_WINDOW_SECONDS = 1  # a participant's typing events are forwarded at most once per this window
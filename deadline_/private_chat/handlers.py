@@ -1,20 +1,19 @@
 """
 Defines handlers for the different type of received messages
 """
-import json
 import logging
 
-import asyncio
 import websockets
 
 from accounts.models import User
+from async_helpers import run_in_db_thread
 from private_chat.classes import WebSocketConnection
 from private_chat.constants import EXPIRED_TOKEN_ERR_TYPE, AUTHORIZATION_ERR_TYPE, NOT_FOUND_ERR_TYPE, \
     VALIDATION_ERR_TYPE, WARNING_ERR_TYPE
 from private_chat.errors import ChatPairingError, UserTokenMatchError
 from private_chat.helpers import extract_connect_path, fetch_and_validate_participants
 from private_chat.models import Dialog, Message
-from private_chat.services.dialog import get_or_create_dialog_token
+from private_chat.services.message_writer import message_writer
 from private_chat.router import MessageRouter
 
 """
@@ -25,33 +24,30 @@ REVISIT: This way of handling connections is not scalable in the slightest way -
 IDEA:    Maybe it could get shared via some message broker (e.g connection established/authenticated/disconnected) 
             or store it in something like Redis or a DB?
 IDEA:    Maybe we could rewrite it to something which allows parallelism with shared memory
+
+Every message type is handled by a pool of workers, sharded by dialog (see channels), and the DB work runs
+    in the DB thread pool, so a slow query only holds up the messages of its own shard
 """
 logger = logging.getLogger('django-private-dialog')
 ws_connections: {(int, int): WebSocketConnection} = {}
 
 
-async def send_message(conn, payload):
+def send_message(conn: WebSocketConnection, payload, coalesce_key: str=None, droppable: bool=False) -> bool:
     """
-    Distributed payload (message) to one connection
+    Queues up a payload (message) to be sent to one connection, see WebSocketSender
     """
-    try:
-        await conn.send(json.dumps(payload))
-    except Exception as e:
-        logger.error(f'Could not send message to websocket due to {e}')
+    return conn.sender.send(payload, coalesce_key=coalesce_key, droppable=droppable)
 
 
-async def fan_out_message(connections, payload):
+def fan_out_message(connections: [WebSocketConnection], payload):
     """
     distributes payload (message) to all connected ws clients
     """
     for conn in connections:
-        try:
-            await conn.send(json.dumps(payload))
-        except Exception as e:
-            logger.error(f'Could not send message to multiple websockets due to {e}')
+        send_message(conn, payload)
 
 
-async def authenticate(stream):
+async def authenticate(packet: dict):
     """
     Authenticates the user and marks his websocket as valid
 
@@ -63,29 +59,36 @@ async def authenticate(stream):
     "opponent_id": HIS_ID_HERE
     }
     """
-    while True:
-        packet = await stream.get()
-        owner_id, opponent_id = int(packet.get('user_id')), int(packet.get('opponent_id'))
+    owner_id, opponent_id = int(packet.get('user_id')), int(packet.get('opponent_id'))
+    connection = ws_connections.get((owner_id, opponent_id))
+    if connection is None:
+        return
 
-        to_send_message, payload = _authenticate(packet, owner_id, opponent_id)
-        if to_send_message:
-            asyncio.ensure_future(send_message(ws_connections[(owner_id, opponent_id)].web_socket, payload))
+    session, payload = await run_in_db_thread(_authenticate, packet, owner_id, opponent_id)
+    # ws_connections is only touched on the event loop, the socket may have closed or been replaced meanwhile
+    if ws_connections.get((owner_id, opponent_id)) is not connection:
+        logger.debug(f'Connection {(owner_id, opponent_id)} closed or was replaced while authenticating')
+        return
+    if session is not None:
+        connection.start_session(*session)
+    send_message(connection, payload)
+    if session is None:
+        return
 
-            opponent_is_online = ((opponent_id, owner_id) in ws_connections
-                                  and ws_connections[(opponent_id, owner_id)].is_valid)
-            asyncio.ensure_future(send_message(ws_connections[(owner_id, opponent_id)].web_socket,
-                                               {'type': 'online-check', 'is_online': opponent_is_online}))
-            # Notify the opponent that we came online
-            if opponent_is_online:
-                asyncio.ensure_future(send_message(ws_connections[(opponent_id, owner_id)].web_socket,
-                                                   {'type': 'online-check', 'is_online': True}))
+    opponent_connection = ws_connections.get((opponent_id, owner_id))
+    opponent_is_online = opponent_connection is not None and opponent_connection.is_valid
+    send_message(connection, {'type': 'online-check', 'is_online': opponent_is_online}, coalesce_key='online-check')
+    # Notify the opponent that we came online
+    if opponent_is_online:
+        send_message(opponent_connection, {'type': 'online-check', 'is_online': True}, coalesce_key='online-check')
 
 
-def _authenticate(packet: dict, owner_id, opponent_id) -> (bool, dict):
+def _authenticate(packet: dict, owner_id, opponent_id) -> ((User, User, Dialog), dict):
     """
+    Runs in the DB thread pool, so it does not touch ws_connections
     :return:
-        - boolean indicating if we want to send a message
-        - the payload we would send
+        - the (owner, opponent, dialog) to start the connection's session with, None if the authentication failed
+        - the payload to send
     """
 
     try:
@@ -95,13 +98,14 @@ def _authenticate(packet: dict, owner_id, opponent_id) -> (bool, dict):
     except (User.DoesNotExist, UserTokenMatchError) as e:
         err_type = {User.DoesNotExist: NOT_FOUND_ERR_TYPE, UserTokenMatchError: AUTHORIZATION_ERR_TYPE}[e.__class__]
         logger.debug(f'Raised {e.__class__} in fetch-token handler. Error message was {str(e)}')
-        return True, {'type': 'error', 'error_type': err_type, 'message': str(e)}
+        return None, {'type': 'error', 'error_type': err_type, 'message': str(e)}
 
-    ws_connections[(owner_id, opponent_id)].is_valid = True
-    return True, {'type': 'OK', 'message': 'AUTHENTICATED'}
+    # the session lasts as long as the connection, so we fetch everything the following messages need just once
+    dialog: Dialog = Dialog.objects.get_or_create_dialog_with_users(owner, opponent)
+    return (owner, opponent, dialog), {'type': 'OK', 'message': 'AUTHENTICATED'}
 
 
-async def new_messages_handler(stream):
+async def new_messages_handler(packet: dict):
     """
     Receives a message from a user and direct it to the recipient
 
@@ -114,27 +118,27 @@ async def new_messages_handler(stream):
         "conversation_token": YOUR_CONVESRATION_TOKEN_HERE
     }
     """
-    while True:
-        packet = await stream.get()
-        owner_id, opponent_id = packet.get('user_id'), packet.get('opponent_id')
-        to_send, is_err, payload = _new_messages_handler(packet, owner_id, opponent_id)
+    owner_id, opponent_id = packet.get('user_id'), packet.get('opponent_id')
+    to_send, is_err, payload = await _new_messages_handler(packet, owner_id, opponent_id)
 
-        if to_send:
-            owner_id, opponent_id = int(owner_id), int(opponent_id)
-            owner_socket = ws_connections[(owner_id, opponent_id)]
+    if to_send:
+        owner_id, opponent_id = int(owner_id), int(opponent_id)
+        owner_socket = ws_connections[(owner_id, opponent_id)]
 
-            connections = [owner_socket.web_socket]
-            if not is_err and (opponent_id, owner_id) in ws_connections:
-                opponent_socket: WebSocketConnection = ws_connections[(opponent_id, owner_id)]
-                if opponent_socket.is_valid:
-                    connections.append(opponent_socket.web_socket)
+        connections = [owner_socket]
+        if not is_err and (opponent_id, owner_id) in ws_connections:
+            opponent_socket: WebSocketConnection = ws_connections[(opponent_id, owner_id)]
+            if opponent_socket.is_valid:
+                connections.append(opponent_socket)
 
-            await fan_out_message(connections, payload)
+        fan_out_message(connections, payload)
 
 
-def _new_messages_handler(packet: dict, owner_id, opponent_id):
+async def _new_messages_handler(packet: dict, owner_id, opponent_id):
     """
-    Validates the user_ids, the connection's validity and owner's authorization and sends the message to both
+    Validates the connection's validity and owner's authorization and sends the message to both
+    The participants and the dialog come from the connection's session and the message gets persisted
+        shortly after it is relayed, see MessageWriter
     """
     if (owner_id, opponent_id) not in ws_connections:
         return False, True, {}  # no such connection, we cannot send this to anybody
@@ -143,22 +147,14 @@ def _new_messages_handler(packet: dict, owner_id, opponent_id):
     if not message:
         return True, True, {'type': 'error', 'error_type': VALIDATION_ERR_TYPE, 'message': 'Message cannot be empty!'}
 
-    try:
-        owner, opponent = fetch_and_validate_participants(owner_id, opponent_id)
-    except (User.DoesNotExist, ChatPairingError) as e:
-        # should not happen, as we should not have a non-existent user in ws_connections
-        return True, True, {'type': 'error', 'error_type': NOT_FOUND_ERR_TYPE, 'message': str(e)}
-
-    owner_socket: WebSocketConnection = ws_connections[(owner.id, opponent.id)]
+    owner_socket: WebSocketConnection = ws_connections[(owner_id, opponent_id)]
     if not owner_socket.is_valid:
         return True, True, {'type': 'error', 'error_type': AUTHORIZATION_ERR_TYPE,
                             'message': 'You need to authorize yourself by fetching a token!'}
 
-    dialog: Dialog = Dialog.objects.get_or_create_dialog_with_users(owner, opponent)
-
-    msg = Message.objects.create(
-        dialog=dialog,
-        sender=owner,
+    msg: Message = await message_writer.write(
+        dialog=owner_socket.dialog,
+        sender=owner_socket.owner,
         text=message
     )
 
@@ -173,7 +169,7 @@ def _new_messages_handler(packet: dict, owner_id, opponent_id):
     return True, False, payload_to_send
 
 
-async def is_typing_handler(stream):
+async def is_typing_handler(packet: dict):
     """
     Show message to opponent if user is typing message
     Expects the following JSON
@@ -184,45 +180,35 @@ async def is_typing_handler(stream):
     "opponent_id": OPPONENT_ID_HERE
     }
     """
-    while True:
-        packet = await stream.get()
-        owner_id, opponent_id = packet.get('user_id'), packet.get('opponent_id')
-        conversation_token = packet.get('conversation_token')
-
-        to_send_msg, payload = _is_typing(owner_id, opponent_id, conversation_token)
-        owner_socket = ws_connections[(owner_id, opponent_id)].web_socket
-        if to_send_msg:
-            asyncio.ensure_future(send_message(owner_socket, payload))
-            continue
-
-        opponent_is_online = ((opponent_id, owner_id) in ws_connections
-                              and ws_connections[(opponent_id, owner_id)].is_valid)
-        if opponent_is_online:
-            opponent_socket = ws_connections[(opponent_id, owner_id)].web_socket
-            asyncio.ensure_future(send_message(opponent_socket, {'type': 'opponent-typing'}))
-        else:
-            asyncio.ensure_future(send_message(owner_socket, {'type': 'error', 'error_type': WARNING_ERR_TYPE,
-                                                              'message': f'User {opponent_id} is offline!'}))
+    owner_id, opponent_id = packet.get('user_id'), packet.get('opponent_id')
 
+    to_send_msg, payload = _is_typing(owner_id, opponent_id)
+    if to_send_msg:
+        send_message(ws_connections[(owner_id, opponent_id)], payload)
 
-def _is_typing(owner_id: int, opponent_id: int, conversation_token: str) -> (bool, dict):
+
+def _is_typing(owner_id: int, opponent_id: int) -> (bool, dict):
     """
-    Returns a boolean indicating if we should send a message and the payload of said message
+    Forwards the typing event to the opponent, at most once per TYPING_EVENT_WINDOW_SECONDS for every participant
+    Returns a boolean indicating if we should send a message to the owner and the payload of said message
+    Only the connections' state is checked, this does not touch the DB
     """
     if (owner_id, opponent_id) not in ws_connections:
         return False, {}  # no such connection, we cannot send this to anybody
 
-    try:
-        owner, opponent = fetch_and_validate_participants(owner_id, opponent_id)
-    except (User.DoesNotExist, ChatPairingError) as e:
-        # should not happen, as we should not have a non-existent user in ws_connections
-        return True, {'type': 'error', 'error_type': NOT_FOUND_ERR_TYPE, 'message': str(e)}
-
-    owner_socket: WebSocketConnection = ws_connections[(owner.id, opponent.id)]
+    owner_socket: WebSocketConnection = ws_connections[(owner_id, opponent_id)]
     if not owner_socket.is_valid:
         return True, {'type': 'error', 'error_type': AUTHORIZATION_ERR_TYPE,
                       'message': 'You need to authorize yourself by fetching a token!'}
+    if owner_socket.throttle_typing():
+        return False, {}
 
+    opponent_socket = ws_connections.get((opponent_id, owner_id))
+    if opponent_socket is None or not opponent_socket.is_valid:
+        return True, {'type': 'error', 'error_type': WARNING_ERR_TYPE, 'message': f'User {opponent_id} is offline!'}
+
+    # a stale typing event is worthless, so a pending one gets replaced and a slow opponent can miss it
+    send_message(opponent_socket, {'type': 'opponent-typing'}, coalesce_key='opponent-typing', droppable=True)
     return False, {}
 
 
@@ -237,13 +223,11 @@ async def main_handler(websocket, path):
     Expected path for initial connection is
     /user_id/user_token/user_to_speak_to_id
     """
-    # TODO: All these tokens being sent are useless, as once we authenticate a user we have this websocket saved
-    # TODO:     These were made before we added checks for malicious `user_id` checks and as now we simply overwrite
-    # TODO:     the field, we know that each message from a `user_id` is from him,
-    # TODO:         so no need to authenticate on each message
+    # The tokens sent along with every message are not needed, as each message from this websocket is
+    #   from its authenticated owner - the session established by `authenticate` is what the handlers check
     owner_id, opponent_id = extract_connect_path(path)
     try:
-        owner, opponent = fetch_and_validate_participants(owner_id, opponent_id)
+        owner, opponent = await run_in_db_thread(fetch_and_validate_participants, owner_id, opponent_id)
     except (ChatPairingError, User.DoesNotExist) as e:
         print(str(e))
         return
@@ -257,7 +241,7 @@ async def main_handler(websocket, path):
 
     ws_connections[(owner.id, opponent.id)] = WebSocketConnection(websocket, owner_id, opponent_id)
 
-    asyncio.ensure_future(send_message(websocket, {'tank': 'YOU ARE CONNECTED :)'}))
+    send_message(ws_connections[(owner.id, opponent.id)], {'tank': 'YOU ARE CONNECTED :)'})
 
     # While the websocket is open, listen for incoming messages/events
     is_overwritten = False
@@ -284,7 +268,7 @@ async def main_handler(websocket, path):
         if not is_overwritten:
             del ws_connections[(owner.id, opponent.id)]
             if (opponent.id, owner.id) in ws_connections and ws_connections[(opponent.id, owner.id)].is_valid:
-                asyncio.ensure_future(send_message(ws_connections[(opponent.id, owner.id)].web_socket,
-                                                   {'type': 'online-check', 'is_online': False}))
+                send_message(ws_connections[(opponent.id, owner.id)],
+                             {'type': 'online-check', 'is_online': False}, coalesce_key='online-check')
         else:
             logger.debug(f'Deleted old overwritten socket with ID {(owner.id, opponent.id)}')
@@ -47,5 +47,12 @@ def fetch_and_validate_participants(owner_id: int, opponent_id: int) -> (User, U
     return owner, opponent
 
 
+def order_user_pair(first_user_id: int, second_user_id: int) -> (int, int):
+    """
+    Orders the IDs of a dialog's participants, so that the pair is the same regardless of who is the owner
+    """
+    return min(first_user_id, second_user_id), max(first_user_id, second_user_id)
+
+
 def get_utc_time():
     return datetime.utcnow()
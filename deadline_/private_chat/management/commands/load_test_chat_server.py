@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+from django.conf import settings
+from rest_framework.authtoken.models import Token
+
+from accounts.models import User
+from ws_load_test import LoadTestCommand, LoadTestClient, LatencyStats, get_or_create_load_test_users, run_at_rate
+
+MESSAGE_PREFIX = 'loadtest'
+DELIVERY_GRACE_SECONDS = 2  # how long we wait for the frames still in flight once the traffic stops
+
+
+class ChatLoadTestClient(LoadTestClient):
+    """
+    One participant of a dialog. Every message carries the time it was sent at,
+        so its opponent can tell how long the delivery took
+    """
+    def __init__(self, url: str, stats: LatencyStats, user: User, auth_token: str):
+        super().__init__(url, stats)
+        self.user = user
+        self.auth_token = auth_token
+        self.opponent: ChatLoadTestClient = None
+        self.typing_sent_at = None
+        self.message_count = 0
+
+    async def authenticate(self):
+        await self.send({'type': 'authenticate', 'auth_token': self.auth_token})
+
+    async def send_chat_message(self):
+        self.message_count += 1
+        await self.send({'type': 'new-message',
+                         'message': f'{MESSAGE_PREFIX} {self.message_count} {time.perf_counter()}'})
+
+    async def send_typing(self):
+        self.typing_sent_at = time.perf_counter()
+        await self.send({'type': 'is-typing'})
+
+    def on_frame(self, frame: dict):
+        frame_type = frame.get('type')
+        if frame_type == 'OK':
+            self.mark_authenticated()
+        elif frame_type == 'received-message' and frame['sender_name'] != self.user.username:
+            prefix, _, sent_at = frame['message'].split(' ')
+            if prefix == MESSAGE_PREFIX:
+                self.stats.record('chat-message', time.perf_counter() - float(sent_at))
+        elif frame_type == 'opponent-typing' and self.opponent.typing_sent_at is not None:
+            # typing events are throttled, so this is measured from the latest one the opponent sent
+            self.stats.record('typing', time.perf_counter() - self.opponent.typing_sent_at)
+
+
+class Command(LoadTestCommand):
+    help = 'Load tests the chat websocket server with simulated dialogs'
+    SERVER_COMMAND = 'run_chat_server'
+    DEFAULT_HOST = settings.CHAT_WS_SERVER_HOST
+    DEFAULT_PORT = settings.CHAT_WS_SERVER_PORT + 100
+    DEFAULT_METRICS_PORT = settings.CHAT_METRICS_PORT + 100
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--messages-per-second', type=float, default=0.5,
+                            help='How many chat messages every client sends a second')
+        parser.add_argument('--typing-per-second', type=float, default=2,
+                            help='How many typing events every client sends a second')
+
+    def create_clients(self, options, stats: LatencyStats) -> [ChatLoadTestClient]:
+        """ Pairs the clients up in dialogs, every user connects to his opponent """
+        users = get_or_create_load_test_users(options['clients'] - options['clients'] % 2)
+        auth_tokens = dict(Token.objects.filter(user__in=users).values_list('user_id', 'key'))
+        clients = []
+        for owner, opponent in zip(users[::2], users[1::2]):
+            owner_client, opponent_client = (
+                ChatLoadTestClient(f'ws://{options["host"]}:{options["port"]}/chat/{user.id}/{other_user.id}',
+                                   stats, user, auth_tokens[user.id])
+                for user, other_user in ((owner, opponent), (opponent, owner)))
+            owner_client.opponent, opponent_client.opponent = opponent_client, owner_client
+            clients += [owner_client, opponent_client]
+        return clients
+
+    async def run_load(self, clients: [ChatLoadTestClient], options):
+        await asyncio.gather(*[run_at_rate(options['messages_per_second'], options['duration'],
+                                           client.send_chat_message) for client in clients],
+                             *[run_at_rate(options['typing_per_second'], options['duration'],
+                                           client.send_typing) for client in clients])
+        await asyncio.sleep(DELIVERY_GRACE_SECONDS)
@@ -1,4 +1,5 @@
 import asyncio
+import signal
 
 import uvloop
 import websockets
@@ -6,23 +7,40 @@ import websockets
 from django.conf import settings
 from django.core.management.base import BaseCommand
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())  # needs to be set before websockets for some reason
+from metrics import monitor_loop_lag, serve_metrics
 from private_chat import channels, handlers
+from private_chat.services.message_writer import message_writer
 
 
 class Command(BaseCommand):
     help = 'Starts message center chat engine'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=settings.CHAT_WS_SERVER_PORT)
+        parser.add_argument('--metrics-port', type=int, default=settings.CHAT_METRICS_PORT)
+
     def handle(self, *args, **options):
         asyncio.async(
             websockets.serve(
                 handlers.main_handler,
                 settings.CHAT_WS_SERVER_HOST,
-                settings.CHAT_WS_SERVER_PORT
+                options['port']
             )
         )
 
-        asyncio.async(handlers.new_messages_handler(channels.new_messages))
-        asyncio.async(handlers.authenticate(channels.authenticate))
-        asyncio.async(handlers.is_typing_handler(channels.is_typing))
+        channels.new_messages.start_workers(handlers.new_messages_handler)
+        channels.authenticate.start_workers(handlers.authenticate)
+        channels.is_typing.start_workers(handlers.is_typing_handler)
+        asyncio.async(message_writer.run())
+        asyncio.async(monitor_loop_lag())
+        asyncio.async(serve_metrics(settings.CHAT_WS_SERVER_HOST, options['metrics_port']))
         loop = asyncio.get_event_loop()
-        loop.run_forever()
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # persist every message we have already relayed before exiting
+            self.stdout.write(f'Flushing {message_writer.pending_count} pending chat messages')
+            loop.run_until_complete(message_writer.flush())
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def populate_user_pairs(apps, schema_editor):
+    """
+    Fills in the ordered participant pair of every existing dialog.
+    Should two dialogs share a pair, only the oldest one gets it, as the pair is about to become unique
+    """
+    Dialog = apps.get_model('private_chat', 'Dialog')
+    seen_pairs = set()
+    for dialog in Dialog.objects.exclude(owner=None).exclude(opponent=None).order_by('id'):
+        user_pair = (min(dialog.owner_id, dialog.opponent_id), max(dialog.owner_id, dialog.opponent_id))
+        if user_pair in seen_pairs:
+            continue
+        seen_pairs.add(user_pair)
+        Dialog.objects.filter(id=dialog.id).update(min_user_id=user_pair[0], max_user_id=user_pair[1])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('private_chat', '0004_auto_20171221_2130'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dialog',
+            name='max_user_id',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='dialog',
+            name='min_user_id',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.RunPython(populate_user_pairs, migrations.RunPython.noop),
+    ]
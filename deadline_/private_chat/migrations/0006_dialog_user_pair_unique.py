@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('private_chat', '0005_dialog_user_pair'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='dialog',
+            unique_together=set([('min_user_id', 'max_user_id')]),
+        ),
+    ]
@@ -1,14 +1,13 @@
-import jwt
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.conf import settings
-from django.db.models import Q
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.template.defaultfilters import date as dj_date
 from model_utils.models import TimeStampedModel, SoftDeletableModel
 
 from accounts.models import User
-from private_chat.helpers import generate_dialog_tokens
+from private_chat.helpers import generate_dialog_tokens, order_user_pair
+from token_cache import TOKEN_EXPIRY_CACHE, tokens_match
 
 
 class DialogManager(models.Manager):
@@ -18,13 +17,18 @@ class DialogManager(models.Manager):
         """
         dialog: Dialog = self.fetch_dialog_with_users(user_owner, user_opponent)
         if dialog is None:
-            dialog = self.create(owner=user_owner, opponent=user_opponent)
+            try:
+                with transaction.atomic():
+                    dialog = self.create(owner=user_owner, opponent=user_opponent)
+            except IntegrityError:
+                # the other participant created it in the meantime
+                dialog = self.fetch_dialog_with_users(user_owner, user_opponent)
 
         return dialog
 
     def fetch_dialog_with_users(self, user_owner, user_opponent):
-        return self.filter(Q(owner=user_owner, opponent=user_opponent)
-                           | Q(opponent=user_owner, owner=user_opponent)).first()
+        min_user_id, max_user_id = order_user_pair(user_owner.id, user_opponent.id)
+        return self.filter(min_user_id=min_user_id, max_user_id=max_user_id).first()
 
 
 class Dialog(models.Model):
@@ -37,31 +41,41 @@ class Dialog(models.Model):
     opponent = models.ForeignKey(User, verbose_name="Dialog opponent", on_delete=models.SET_NULL, null=True)
     opponent_token = models.CharField(max_length=200, null=True)
     secret_key = models.CharField(max_length=50, null=True)
+    # the participants' IDs in ascending order, which identify the dialog regardless of who started it
+    min_user_id = models.IntegerField(null=True)
+    max_user_id = models.IntegerField(null=True)
     objects = DialogManager()
 
+    class Meta:
+        unique_together = ('min_user_id', 'max_user_id')
+
     def __str__(self):
         return f'Chat between {self.owner.username} and {self.opponent.username}'
 
+    def save(self, *args, **kwargs):
+        if self.min_user_id is None and self.owner_id is not None and self.opponent_id is not None:
+            self.min_user_id, self.max_user_id = order_user_pair(self.owner_id, self.opponent_id)
+        super().save(*args, **kwargs)
+
     def tokens_are_expired(self) -> bool:
-        """ Checks whether the current tokens are expired """
-        try:
-            jwt.decode(self.owner_token, self.secret_key)
-            jwt.decode(self.opponent_token, self.secret_key)
-            return False
-        except jwt.ExpiredSignatureError:
-            return True
+        """ Checks whether the current tokens are expired, decoding them only the first time they are checked """
+        return (TOKEN_EXPIRY_CACHE.is_expired(self.owner_token, self.secret_key)
+                or TOKEN_EXPIRY_CACHE.is_expired(self.opponent_token, self.secret_key))
 
     def refresh_tokens(self, force=False):
         if not force and self.tokens_are_expired():
             raise Exception("Will not reset Dialog's tokens when they are not expired without being forced!")
         secret_key, owner_token, opponent_token = generate_dialog_tokens(self.owner.username, self.opponent.username)
+        TOKEN_EXPIRY_CACHE.invalidate(self.owner_token, self.secret_key)
+        TOKEN_EXPIRY_CACHE.invalidate(self.opponent_token, self.secret_key)
         self.secret_key = secret_key
         self.owner_token = owner_token
         self.opponent_token = opponent_token
         self.save()
 
     def token_is_valid(self, token):
-        return token in [self.owner_token, self.opponent_token] and not self.tokens_are_expired()
+        return ((tokens_match(token, self.owner_token) or tokens_match(token, self.opponent_token))
+                and not self.tokens_are_expired())
 
 
 @receiver(post_save, sender=Dialog)
@@ -86,13 +100,35 @@ class Message(TimeStampedModel, SoftDeletableModel):
 
     class Meta:
         ordering = ('created', )
+        indexes = [
+            # serves the history pages, which walk a single dialog's messages in (created, id) order
+            models.Index(fields=['dialog', 'created', 'id'], name='message_dialog_created_idx'),
+        ]
 
     def get_formatted_create_datetime(self):
         return dj_date(self.created, settings.DATETIME_FORMAT)
 
     @staticmethod
-    def fetch_messages_from_dialog_created_before(message, message_count: int):
-        return Message.objects.filter(dialog=message.dialog, created__lt=message.created).all()[:message_count]
+    def fetch_messages_from_dialog_created_before(message, message_count: int) -> ['Message']:
+        """
+        Fetches the message_count messages of the dialog which immediately precede the given one, oldest first.
+        Messages are ordered by (created, id), so the ones created at the same time as the cursor are not skipped
+        """
+        messages = (Message.objects.filter(dialog_id=message.dialog_id, created__lte=message.created)
+                    .exclude(created=message.created, id__gte=message.id)
+                    .select_related('sender')
+                    .order_by('-created', '-id')[:message_count])
+        return list(reversed(messages))
+
+    @staticmethod
+    def fetch_messages_from_dialog_created_after(message, message_count: int) -> ['Message']:
+        """
+        Fetches the message_count messages of the dialog which immediately follow the given one, oldest first
+        """
+        return list(Message.objects.filter(dialog_id=message.dialog_id, created__gte=message.created)
+                    .exclude(created=message.created, id__lte=message.id)
+                    .select_related('sender')
+                    .order_by('created', 'id')[:message_count])
 
     def __str__(self):
         return self.sender.username + "(" + self.get_formatted_create_datetime() + ") - '" + self.text + "'"
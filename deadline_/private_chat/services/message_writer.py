@@ -0,0 +1,137 @@
+"""
+Write-behind persistence of chat messages.
+
+A message gets its ID (reserved in blocks from the table's sequence) and its timestamps up front, so it can be
+    relayed to the participants right away, and is then persisted along with others in a bulk_create batch.
+A message is persisted at most MESSAGE_FLUSH_INTERVAL_SECONDS after it was written and the pending ones are flushed
+    on shutdown, so only a crash of the process (not a restart) can lose that last interval's messages
+"""
+import asyncio
+import logging
+from collections import deque
+
+from django.db import connection, IntegrityError, DataError
+from django.utils import timezone
+
+from accounts.models import User
+from async_helpers import run_in_db_thread
+from metrics import REGISTRY
+from private_chat.constants import MESSAGE_FLUSH_INTERVAL_SECONDS, MESSAGE_FLUSH_BATCH_SIZE, MESSAGE_MAX_PENDING, \
+    MESSAGE_ID_BLOCK_SIZE
+from private_chat.models import Dialog, Message
+
+logger = logging.getLogger('django-private-dialog')
+
+PENDING_MESSAGES = REGISTRY.gauge('chat_pending_messages', 'Chat messages relayed but not yet persisted')
+FLUSH_SECONDS = REGISTRY.histogram('chat_message_flush_seconds', 'Time spent persisting a batch of chat messages')
+LOST_MESSAGES = REGISTRY.counter('chat_lost_messages_total', 'Chat messages which could not be persisted')
+
+
+def reserve_message_ids(count: int) -> [int]:
+    """ Reserves IDs from the message table's sequence, which bulk_create then uses as is """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+                       [Message._meta.db_table, 'id', count])
+        return [row[0] for row in cursor.fetchall()]
+
+
+
+def last_reserved_message_id() -> int:
+    """ Returns the highest ID reserved from the message table's sequence so far, no message can have a higher one """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [Message._meta.db_table, 'id'])
+        sequence_name = cursor.fetchone()[0]  # already quoted by postgres
+        cursor.execute(f'SELECT last_value FROM {sequence_name}')
+        return cursor.fetchone()[0]
+
+def persist_messages(messages: [Message]) -> int:
+    """
+    Persists the messages in a single query.
+    If a message is invalid (e.g its dialog got deleted), they are persisted one by one,
+        so that a single bad message does not take the rest with it.
+    Any other error (e.g the DB being unreachable) is raised, the messages are then retried on the next flush
+    :return: the number of messages which could not be persisted
+    """
+    try:
+        Message.objects.bulk_create(messages)
+        return 0
+    except (IntegrityError, DataError) as e:
+        logger.error(f'Could not persist a batch of {len(messages)} messages due to {e}, persisting them one by one')
+
+    lost_count = 0
+    for message in messages:
+        try:
+            Message.objects.bulk_create([message])
+        except (IntegrityError, DataError) as e:
+            logger.error(f'Could not persist message {message.id} from dialog {message.dialog_id} due to {e}')
+            lost_count += 1
+    return lost_count
+
+
+class MessageWriter:
+    """
+    Creates chat messages in memory and persists them in batches from a background task (see run()).
+    Unpersisted messages are bounded by max_pending - past it, writing waits for a flush
+    """
+    def __init__(self, flush_interval=MESSAGE_FLUSH_INTERVAL_SECONDS, batch_size=MESSAGE_FLUSH_BATCH_SIZE,
+                 max_pending=MESSAGE_MAX_PENDING, id_block_size=MESSAGE_ID_BLOCK_SIZE):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.id_block_size = id_block_size
+        self._pending: [Message] = []
+        self._ids = deque()
+        self._flush_lock: asyncio.Lock = None
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    async def write(self, dialog: Dialog, sender: User, text: str) -> Message:
+        """
+        Creates the message in memory, with its final ID and timestamps, and queues it up to be persisted
+        """
+        if len(self._pending) >= self.max_pending:
+            await self.flush()  # the DB can not keep up, so we do not either
+
+        now = timezone.now()
+        message = Message(id=await self._next_id(), dialog=dialog, sender=sender, text=text, created=now, modified=now)
+        self._pending.append(message)
+        PENDING_MESSAGES.inc()
+        if len(self._pending) >= self.batch_size:
+            asyncio.ensure_future(self.flush())
+        return message
+
+    async def run(self):
+        """ Flushes the pending messages every flush_interval seconds """
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f'Could not flush chat messages due to {e}')
+
+    async def flush(self):
+        """ Persists every pending message, one batch at a time, in the order they were written """
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+
+        async with self._flush_lock:
+            while self._pending:
+                batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+                try:
+                    with FLUSH_SECONDS.time():
+                        lost_count = await run_in_db_thread(persist_messages, batch)
+                except Exception:
+                    self._pending[:0] = batch  # keep them for the next flush
+                    raise
+                PENDING_MESSAGES.dec(len(batch))
+                LOST_MESSAGES.inc(lost_count)
+
+    async def _next_id(self) -> int:
+        if not self._ids:
+            self._ids.extend(await run_in_db_thread(reserve_message_ids, self.id_block_size))
+        return self._ids.popleft()
+
+
+message_writer = MessageWriter()
@@ -3,9 +3,13 @@ from unittest.mock import MagicMock, patch
 from django.test import TestCase
 
 from challenges.tests.factories import UserFactory
-from private_chat.constants import EXPIRED_TOKEN_ERR_TYPE, AUTHORIZATION_ERR_TYPE, VALIDATION_ERR_TYPE
-from private_chat.handlers import _authenticate, _new_messages_handler, _is_typing
+from challenges.tests.helpers import run_async, run_inline
+from private_chat.constants import EXPIRED_TOKEN_ERR_TYPE, AUTHORIZATION_ERR_TYPE, VALIDATION_ERR_TYPE, \
+    WARNING_ERR_TYPE
+from private_chat.classes import WebSocketConnection
+from private_chat.handlers import _authenticate, _new_messages_handler, _is_typing, authenticate
 from private_chat.models import Dialog, Message
+from private_chat.services.message_writer import MessageWriter
 
 
 class AuthenticateTests(TestCase):
@@ -13,34 +17,79 @@ class AuthenticateTests(TestCase):
         self.first_user = UserFactory()
         self.second_user = UserFactory()
 
-    def test_returns_token_and_validates_websocket(self):
+    def test_returns_session_and_ok_payload(self):
         """
-        On a successful authentication, the user's websocket must be marked as valid
+        On a successful authentication, the connection's session must be returned, so that it is started on the loop
         :return:
         """
-        websocket_mock = MagicMock(is_valid=False)
-        ws_connections = {(self.first_user.id, self.second_user.id): websocket_mock}
-        with patch('private_chat.handlers.ws_connections', ws_connections):
-            to_send_message, payload = _authenticate({'auth_token': self.first_user.auth_token.key},
-                                                           self.first_user.id, self.second_user.id)
+        session, payload = _authenticate({'auth_token': self.first_user.auth_token.key},
+                                         self.first_user.id, self.second_user.id)
 
-            self.assertTrue(to_send_message)
-            self.assertEqual(payload['type'], 'OK')
-            self.assertEqual(websocket_mock.is_valid, True)
+        self.assertEqual(payload['type'], 'OK')
+        self.assertEqual(session, (self.first_user, self.second_user,
+                                   Dialog.objects.fetch_dialog_with_users(self.first_user, self.second_user)))
 
     def test_returns_error_if_invalid_token(self):
-        websocket_mock = MagicMock(is_valid=False)
-        ws_connections = {(self.first_user.id, self.second_user.id): websocket_mock}
-        with patch('private_chat.handlers.ws_connections', {(self.first_user.id, self.second_user.id): ws_connections}):
-            to_send_message, payload = _authenticate({'auth_token': 'sELEMENT'},
-                                                           self.first_user.id, self.second_user.id)
+        session, payload = _authenticate({'auth_token': 'sELEMENT'}, self.first_user.id, self.second_user.id)
 
-            self.assertTrue(to_send_message)
-            self.assertEqual('error', payload['type'])
-            self.assertEqual(AUTHORIZATION_ERR_TYPE, payload['error_type'])
-            self.assertEqual(websocket_mock.is_valid, False)
+        self.assertIsNone(session)
+        self.assertEqual('error', payload['type'])
+        self.assertEqual(AUTHORIZATION_ERR_TYPE, payload['error_type'])
+
+
+@patch('private_chat.handlers.run_in_db_thread', run_inline)
+class AuthenticateConnectionTests(TestCase):
+    def setUp(self):
+        self.first_user = UserFactory()
+        self.second_user = UserFactory()
+        self.key = (self.first_user.id, self.second_user.id)
+        self.packet = {'type': 'authenticate', 'user_id': self.first_user.id, 'opponent_id': self.second_user.id,
+                       'auth_token': self.first_user.auth_token.key}
+
+    @patch('private_chat.handlers.send_message')
+    def test_starts_session_of_the_connection(self, mock_send_message):
+        connection = MagicMock(is_valid=False)
+        with patch('private_chat.handlers.ws_connections', {self.key: connection}):
+            run_async(authenticate(self.packet))
+
+        connection.start_session.assert_called_once_with(
+            self.first_user, self.second_user,
+            Dialog.objects.fetch_dialog_with_users(self.first_user, self.second_user))
+        mock_send_message.assert_any_call(connection, {'type': 'OK', 'message': 'AUTHENTICATED'})
+
+    @patch('private_chat.handlers.send_message')
+    def test_does_not_start_session_of_a_replaced_connection(self, mock_send_message):
+        connection, new_connection = MagicMock(is_valid=False), MagicMock(is_valid=False)
+        ws_connections = {self.key: connection}
+
+        def replace_connection_while_authenticating(*args):
+            ws_connections[self.key] = new_connection
+            return _authenticate(*args)
+
+        with patch('private_chat.handlers.ws_connections', ws_connections), \
+                patch('private_chat.handlers._authenticate', replace_connection_while_authenticating):
+            run_async(authenticate(self.packet))
+
+        connection.start_session.assert_not_called()
+        new_connection.start_session.assert_not_called()
+        mock_send_message.assert_not_called()
 
+    @patch('private_chat.handlers.send_message')
+    def test_ignores_a_closed_connection(self, mock_send_message):
+        ws_connections = {self.key: MagicMock()}
 
+        def close_connection_while_authenticating(*args):
+            del ws_connections[self.key]
+            return _authenticate(*args)
+
+        with patch('private_chat.handlers.ws_connections', ws_connections), \
+                patch('private_chat.handlers._authenticate', close_connection_while_authenticating):
+            run_async(authenticate(self.packet))
+
+        mock_send_message.assert_not_called()
+
+
+@patch('private_chat.services.message_writer.run_in_db_thread', run_inline)
 class NewsMessageTests(TestCase):
     def setUp(self):
         self.first_user = UserFactory()
@@ -53,12 +102,19 @@ class NewsMessageTests(TestCase):
             'conversation_token': dialog.owner_token
         }
 
-        with patch('private_chat.handlers.ws_connections',
-                   {(self.first_user.id, self.second_user.id): MagicMock(is_valid=True)}):
-            to_send_msg, is_err, payload = _new_messages_handler(packet, self.first_user.id, self.second_user.id)
+        connection = WebSocketConnection(MagicMock(), self.first_user.id, self.second_user.id)
+        connection.start_session(self.first_user, self.second_user, dialog)
+        writer = MessageWriter()
+        with patch('private_chat.handlers.ws_connections', {(self.first_user.id, self.second_user.id): connection}), \
+                patch('private_chat.handlers.message_writer', writer):
+            with self.assertNumQueries(1):  # reserving message IDs, the identities come from the session
+                to_send_msg, is_err, payload = run_async(_new_messages_handler(packet, self.first_user.id,
+                                                                               self.second_user.id))
 
             self.assertTrue(to_send_msg)
             self.assertFalse(is_err)
+            self.assertEqual(Message.objects.count(), 0)  # it is relayed before it is persisted
+            run_async(writer.flush())
             self.assertEqual(Message.objects.count(), 1)
             msg = Message.objects.first()
             self.assertEqual(msg.text, 'Hello Bob :)')
@@ -78,7 +134,8 @@ class NewsMessageTests(TestCase):
         }
         with patch('private_chat.handlers.ws_connections',
                    {(self.first_user.id, self.second_user.id): MagicMock(is_valid=True)}):
-            to_send_msg, is_err, payload = _new_messages_handler(packet, self.first_user.id, self.second_user.id)
+            to_send_msg, is_err, payload = run_async(_new_messages_handler(packet, self.first_user.id,
+                                                                           self.second_user.id))
             self.assertTrue(to_send_msg)
             self.assertTrue(is_err)
             self.assertEqual('error', payload['type'])
@@ -86,7 +143,7 @@ class NewsMessageTests(TestCase):
             self.assertIn('message', payload['message'].lower())
 
     def test_doesnt_send_message_if_websocket_not_available(self):
-        to_send_msg, is_err, payload = _new_messages_handler({}, self.first_user.id, 200)
+        to_send_msg, is_err, payload = run_async(_new_messages_handler({}, self.first_user.id, 200))
         self.assertFalse(to_send_msg)
         self.assertTrue(is_err)
 
@@ -97,7 +154,8 @@ class NewsMessageTests(TestCase):
         }
         with patch('private_chat.handlers.ws_connections',
                    {(self.first_user.id, self.second_user.id): MagicMock(is_valid=False)}):
-            to_send_msg, is_err, payload = _new_messages_handler(packet, self.first_user.id, self.second_user.id)
+            to_send_msg, is_err, payload = run_async(_new_messages_handler(packet, self.first_user.id,
+                                                                           self.second_user.id))
             self.assertTrue(to_send_msg)
             self.assertTrue(is_err)
             self.assertEqual('error', payload['type'])
@@ -108,22 +166,47 @@ class IsTypingTests(TestCase):
     def setUp(self):
         self.first_user = UserFactory()
         self.second_user = UserFactory()
+        self.owner_socket = WebSocketConnection(MagicMock(), self.first_user.id, self.second_user.id)
+        self.owner_socket.is_valid = True
+        self.opponent_socket = WebSocketConnection(MagicMock(), self.second_user.id, self.first_user.id)
+        self.opponent_socket.is_valid = True
+        self.opponent_socket.sender = MagicMock()
+        self.ws_connections = {(self.first_user.id, self.second_user.id): self.owner_socket,
+                               (self.second_user.id, self.first_user.id): self.opponent_socket}
 
     def test_doesnt_send_message_if_websocket_not_available(self):
-        to_send_msg, payload = _is_typing(self.first_user.id, 200, 'what')
+        to_send_msg, payload = _is_typing(self.first_user.id, 200)
         self.assertFalse(to_send_msg)
 
     def test_sends_error_if_websocket_is_not_valid(self):
         with patch('private_chat.handlers.ws_connections',
                    {(self.first_user.id, self.second_user.id): MagicMock(is_valid=False)}):
-            to_send_msg, payload = _is_typing(self.first_user.id, self.second_user.id, 'TANK')
+            to_send_msg, payload = _is_typing(self.first_user.id, self.second_user.id)
             self.assertTrue(to_send_msg)
             self.assertTrue(payload['type'], 'error')
             self.assertEqual(AUTHORIZATION_ERR_TYPE, payload['error_type'])
 
-    def test_doesnt_send_message_if_all_ok(self):
-        dialog = Dialog.objects.get_or_create_dialog_with_users(self.first_user, self.second_user)
-        with patch('private_chat.handlers.ws_connections',
-                   {(self.first_user.id, self.second_user.id): MagicMock(is_valid=True)}):
-            to_send_msg, payload = _is_typing(self.first_user.id, self.second_user.id, dialog.owner_token)
+    def test_forwards_event_to_opponent_without_db_access(self):
+        with patch('private_chat.handlers.ws_connections', self.ws_connections):
+            with self.assertNumQueries(0):
+                to_send_msg, payload = _is_typing(self.first_user.id, self.second_user.id)
             self.assertFalse(to_send_msg)
+            self.opponent_socket.sender.send.assert_called_once_with({'type': 'opponent-typing'},
+                                                                     coalesce_key='opponent-typing', droppable=True)
+
+    def test_forwards_at_most_one_event_per_window(self):
+        with patch('private_chat.handlers.ws_connections', self.ws_connections):
+            for _ in range(5):
+                _is_typing(self.first_user.id, self.second_user.id)
+            self.assertEqual(self.opponent_socket.sender.send.call_count, 1)
+
+            with patch('private_chat.classes.time.monotonic', return_value=10 ** 9):
+                _is_typing(self.first_user.id, self.second_user.id)
+            self.assertEqual(self.opponent_socket.sender.send.call_count, 2)
+
+    def test_warns_if_opponent_is_offline(self):
+        with patch('private_chat.handlers.ws_connections',
+                   {(self.first_user.id, self.second_user.id): self.owner_socket}):
+            to_send_msg, payload = _is_typing(self.first_user.id, self.second_user.id)
+            self.assertTrue(to_send_msg)
+            self.assertEqual(WARNING_ERR_TYPE, payload['error_type'])
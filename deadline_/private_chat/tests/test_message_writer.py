@@ -0,0 +1,45 @@
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from challenges.tests.factories import UserFactory
+from challenges.tests.helpers import run_async, run_inline
+from private_chat.models import Dialog, Message
+from private_chat.services.message_writer import MessageWriter
+
+
+@patch('private_chat.services.message_writer.run_in_db_thread', run_inline)
+class MessageWriterTests(TestCase):
+    def setUp(self):
+        self.first_user = UserFactory()
+        self.second_user = UserFactory()
+        self.dialog = Dialog.objects.get_or_create_dialog_with_users(self.first_user, self.second_user)
+
+    def write(self, writer, text):
+        return run_async(writer.write(self.dialog, self.first_user, text))
+
+    def test_persists_messages_with_their_reserved_ids(self):
+        writer = MessageWriter(batch_size=2, id_block_size=3)
+        messages = [self.write(writer, f'Message {idx}') for idx in range(5)]
+        run_async(writer.flush())
+
+        self.assertEqual(writer.pending_count, 0)
+        self.assertEqual([(msg.id, msg.text) for msg in messages],
+                         list(Message.objects.order_by('id').values_list('id', 'text')))
+
+    def test_reserves_ids_in_blocks(self):
+        writer = MessageWriter(id_block_size=10)
+        self.write(writer, 'Reserves a block')
+        with self.assertNumQueries(0):
+            self.write(writer, 'Uses the reserved block')
+
+    def test_keeps_messages_pending_if_flush_fails(self):
+        writer = MessageWriter()
+        message = self.write(writer, 'Hello')
+        with patch('private_chat.services.message_writer.persist_messages', side_effect=ConnectionError()):
+            with self.assertRaises(ConnectionError):
+                run_async(writer.flush())
+
+        self.assertEqual(writer.pending_count, 1)
+        run_async(writer.flush())
+        self.assertEqual(Message.objects.get().id, message.id)
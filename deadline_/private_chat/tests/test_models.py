@@ -3,6 +3,7 @@ from time import sleep
 from unittest.mock import patch
 import jwt
 
+from django.db import IntegrityError
 from django.test import TestCase
 from radar import random_datetime
 
@@ -119,6 +120,20 @@ class DialogModelTests(TestCase):
         self.assertEqual(dialog.owner, owner)
         self.assertEqual(dialog.opponent, opponent)
 
+    def test_stores_ordered_user_pair(self):
+        first_user, second_user = UserFactory(), UserFactory()
+
+        dialog = Dialog.objects.create(owner=second_user, opponent=first_user)
+
+        self.assertEqual((dialog.min_user_id, dialog.max_user_id), (first_user.id, second_user.id))
+
+    def test_cannot_create_second_dialog_between_same_users(self):
+        owner, opponent = UserFactory(), UserFactory()
+        Dialog.objects.create(owner=owner, opponent=opponent)
+
+        with self.assertRaises(IntegrityError):
+            Dialog.objects.create(owner=opponent, opponent=owner)
+
 
 class MessageModelTests(TestCase):
     def setUp(self):
@@ -155,6 +170,31 @@ class MessageModelTests(TestCase):
             Message.objects.create(dialog=other_dialog, sender=self.first_user, text='What huh',
                                    created=random_datetime())
         message_count = 5
-        expected_result = [msg.id for msg in Message.objects.filter(dialog=msg.dialog, created__lt=msg.created).all()[:message_count]]
-        received_result = [msg.id for msg in Message.fetch_messages_from_dialog_created_before(message=msg, message_count=message_count)]
+        # the messages right before it, oldest first
+        expected_result = list(reversed([msg.id for msg in Message.objects.filter(dialog=msg.dialog,
+                                                                                  created__lt=msg.created)
+                                         .order_by('-created')[:message_count]]))
+        with self.assertNumQueries(1):
+            received_result = [msg.id for msg in Message.fetch_messages_from_dialog_created_before(
+                message=msg, message_count=message_count)]
         self.assertEqual(expected_result, received_result)
+
+    def test_fetch_messages_created_after(self):
+        messages = [Message.objects.create(dialog=self.dialog, sender=self.first_user, text='Hi',
+                                           created=random_datetime()) for _ in range(20)]
+        messages.sort(key=lambda msg: (msg.created, msg.id))
+
+        received_result = Message.fetch_messages_from_dialog_created_after(message=messages[5], message_count=5)
+
+        self.assertEqual([msg.id for msg in messages[6:11]], [msg.id for msg in received_result])
+
+    def test_fetch_messages_does_not_skip_messages_created_at_the_same_time(self):
+        created = random_datetime()
+        messages = [Message.objects.create(dialog=self.dialog, sender=self.first_user, text='Hi', created=created)
+                    for _ in range(6)]
+
+        before = Message.fetch_messages_from_dialog_created_before(message=messages[3], message_count=10)
+        after = Message.fetch_messages_from_dialog_created_after(message=messages[3], message_count=10)
+
+        self.assertEqual([msg.id for msg in messages[:3]], [msg.id for msg in before])
+        self.assertEqual([msg.id for msg in messages[4:]], [msg.id for msg in after])
@@ -7,6 +7,7 @@ from challenges.tests.factories import UserFactory
 from private_chat.constants import PMS_PER_QUERY
 from private_chat.models import Dialog, Message
 from private_chat.serializers import MessageSerializer
+from private_chat.services.message_writer import reserve_message_ids, last_reserved_message_id
 
 
 class PreviousMessageListViewTests(APITestCase, TestHelperMixin):
@@ -32,11 +33,55 @@ class PreviousMessageListViewTests(APITestCase, TestHelperMixin):
         self.assertEqual(response.data['messages'], expected_data)
         mock_fetch.assert_called_once_with(message=before_pm, message_count=PMS_PER_QUERY)
 
+    @patch('private_chat.views.Message.fetch_messages_from_dialog_created_after')
+    def test_returns_messages_since_cursor(self, mock_fetch):
+        since_pm = self.auth_us_messages[0]
+        expected_data = MessageSerializer(instance=self.auth_us_messages[1:], many=True).data
+        mock_fetch.return_value = self.auth_us_messages[1:]
+        url = f'/chat/messages?conversation_token={self.dialog.owner_token}&since_pm={since_pm.id}'
+
+        response = self.client.get(url, HTTP_AUTHORIZATION=self.auth_token)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['messages'], expected_data)
+        mock_fetch.assert_called_once_with(message=since_pm, message_count=PMS_PER_QUERY)
+
     def test_invalid_message_id_returns_400(self):
         url = f'/chat/messages?conversation_token={self.dialog.owner_token}&before_pm=111'
         response = self.client.get(url, HTTP_AUTHORIZATION=self.auth_token)
         self.assertEqual(response.status_code, 400)
 
+    def test_unsaved_since_pm_returns_503(self):
+        """ A message gets relayed before it is saved, so catching up right after it should be retried """
+        since_pm_id = reserve_message_ids(1)[0]
+        url = f'/chat/messages?conversation_token={self.dialog.owner_token}&since_pm={since_pm_id}'
+        response = self.client.get(url, HTTP_AUTHORIZATION=self.auth_token)
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+
+    def test_never_reserved_since_pm_returns_400(self):
+        since_pm_id = last_reserved_message_id() + 1000
+        url = f'/chat/messages?conversation_token={self.dialog.owner_token}&since_pm={since_pm_id}'
+        response = self.client.get(url, HTTP_AUTHORIZATION=self.auth_token)
+        self.assertEqual(response.status_code, 400)
+
+    def test_deleted_since_pm_returns_400(self):
+        since_pm = self.auth_us_messages[-1]
+        since_pm.delete()  # soft deletes it
+        url = f'/chat/messages?conversation_token={self.dialog.owner_token}&since_pm={since_pm.id}'
+        response = self.client.get(url, HTTP_AUTHORIZATION=self.auth_token)
+        self.assertEqual(response.status_code, 400)
+
+    def test_unsaved_since_pm_with_invalid_token_returns_400(self):
+        url = f'/chat/messages?conversation_token=blablbal&since_pm=111'
+        response = self.client.get(url, HTTP_AUTHORIZATION=self.auth_token)
+        self.assertEqual(response.status_code, 400)
+
+    def test_unsaved_since_pm_from_user_not_in_dialog_returns_400(self):
+        url = f'/chat/messages?conversation_token={self.dialog.owner_token}&since_pm=111'
+        response = self.client.get(url, HTTP_AUTHORIZATION=self.first_us_token)
+        self.assertEqual(response.status_code, 400)
+
     def test_invalid_conversation_token_returns_400(self):
         before_pm = self.auth_us_messages[-1]
         url = f'/chat/messages?conversation_token=blablbal&before_pm={before_pm.id}'
@@ -1,43 +1,84 @@
+import math
+
+from django.db.models import Q
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from private_chat.constants import PMS_PER_QUERY
+from private_chat.constants import PMS_PER_QUERY, MESSAGE_FLUSH_INTERVAL_SECONDS
 from private_chat.models import Message, Dialog
 from private_chat.serializers import MessageSerializer
+from private_chat.services.message_writer import last_reserved_message_id
 
 
 class PreviousMessagesListView(APIView):
     """
-    This view is called to fetch PMS_PER_QUERY messages between two users, all sent before a given message
+    This view is called to fetch PMS_PER_QUERY messages between two users, relative to a given message (the cursor)
     Requires
-        - querystring before_pm - the id of the message we want the results to be before
+        - querystring before_pm - the id of the message we want the results to be right before
+            OR
+          querystring since_pm - the id of the message we want the results to be right after,
+            used to catch up on the messages sent since the last one received (e.g after a reconnect)
         - conversation_token - the token with which you authenticate yourself.
             Unique for every conversation and is refreshed frequently
+    The messages are always ordered from oldest to newest
+    Messages are relayed before they are persisted (see MessageWriter), so a since_pm which is not in the DB yet
+        gets a 503 with a Retry-After header instead of a 400
     """
     permission_classes = (IsAuthenticated, )
 
     def get(self, request, *args, **kwargs):
-        before_pm, is_err, err_msg = self.validate_and_fetch(request.GET.get('conversation_token'),
-                                                             request.GET.get('before_pm'))
+        conversation_token = request.GET.get('conversation_token')
+        since_pm_id = request.GET.get('since_pm')
+        cursor_id = request.GET.get('before_pm') if since_pm_id is None else since_pm_id
+        cursor_pm, is_err, err_msg = self.validate_and_fetch(conversation_token, cursor_id)
         if is_err:
+            if cursor_pm is None and since_pm_id is not None and self.may_be_unpersisted(conversation_token,
+                                                                                         since_pm_id):
+                return Response(status=503, data={'error': f'Message with ID {since_pm_id} is not saved yet!'},
+                                headers={'Retry-After': str(math.ceil(MESSAGE_FLUSH_INTERVAL_SECONDS))})
             return Response(status=400, data={'error': err_msg})
 
-        messages: [Message] = Message.fetch_messages_from_dialog_created_before(message=before_pm,
-                                                                                message_count=PMS_PER_QUERY)
+        if since_pm_id is None:
+            messages: [Message] = Message.fetch_messages_from_dialog_created_before(message=cursor_pm,
+                                                                                    message_count=PMS_PER_QUERY)
+        else:
+            messages: [Message] = Message.fetch_messages_from_dialog_created_after(message=cursor_pm,
+                                                                                   message_count=PMS_PER_QUERY)
 
         return Response(status=200, data={'messages': MessageSerializer(instance=messages, many=True).data})
 
-    def validate_and_fetch(self, conversation_token, before_pm_id) -> (Message, bool, str):
+    def validate_and_fetch(self, conversation_token, cursor_pm_id) -> (Message, bool, str):
         try:
-            before_pm: Message = Message.objects.get(id=before_pm_id)
-        except Message.DoesNotExist:
-            return None, True, f'Message with ID {before_pm_id} does not exist!'
-        dialog: Dialog = before_pm.dialog
-        if dialog.owner != self.request.user and dialog.opponent != self.request.user:
-            return None, True, f'You do not participate in that dialog!'
+            cursor_pm: Message = Message.objects.select_related('dialog').get(id=cursor_pm_id)
+        except (Message.DoesNotExist, ValueError):
+            return None, True, f'Message with ID {cursor_pm_id} does not exist!'
+        dialog: Dialog = cursor_pm.dialog
+        if self.request.user.id not in (dialog.owner_id, dialog.opponent_id):
+            return cursor_pm, True, f'You do not participate in that dialog!'
 
         if not dialog.token_is_valid(conversation_token):
-            return None, True, f'Token #{conversation_token} is not valid!'
+            return cursor_pm, True, f'Token #{conversation_token} is not valid!'
+
+        return cursor_pm, False, ''
+
+    def may_be_unpersisted(self, conversation_token, message_id) -> bool:
+        """
+        Checks whether a message which is not in the DB could still be waiting to get persisted, i.e
+            - its ID was already reserved from the message sequence (see MessageWriter)
+            - it is not a deleted message
+            - the user proves with a valid token that he participates in a dialog
+        Which dialog a reserved ID belongs to is only known to the chat server until it is persisted
+        """
+        if not message_id.isdigit():
+            return False
+        user_id = self.request.user.id
+        dialog: Dialog = (Dialog.objects.filter(Q(owner_id=user_id) | Q(opponent_id=user_id))
+                          .filter(Q(owner_token=conversation_token) | Q(opponent_token=conversation_token))
+                          .first())
+        if dialog is None or not dialog.token_is_valid(conversation_token):
+            return False
 
-        return before_pm, False, ''
+        if int(message_id) > last_reserved_message_id():
+            return False
+        return not Message._base_manager.filter(id=message_id).exists()  # a soft-deleted one will never show up
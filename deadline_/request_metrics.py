@@ -0,0 +1,205 @@
+"""
+Per-request instrumentation of the API.
+
+RequestMetricsMiddleware records, for every request
+    - how many SQL queries it ran and how long they took
+    - how long its serializers took (including the queries they triggered, which is where N+1 queries hide)
+    - how many cache lookups it made and how many of them hit
+    - how long the whole request took
+and exposes them as metrics labelled by the endpoint (the URL name), and as X-* response headers when DEBUG is on.
+
+A view can declare a query budget (see query_budget). A request which exceeds it logs a warning,
+    or raises QueryBudgetExceededError where QUERY_BUDGETS_ENFORCED is set (in tests), failing the test
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from rest_framework.serializers import Serializer, ListSerializer
+
+from errors import Error
+from metrics import REGISTRY
+
+logger = logging.getLogger('metrics')
+
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+
+REQUEST_SECONDS = REGISTRY.histogram('http_request_seconds', 'Time spent handling a request',
+                                     labels=('endpoint', 'method'))
+REQUEST_QUERIES = REGISTRY.histogram('http_request_db_queries', 'SQL queries ran by a request',
+                                     labels=('endpoint', ), buckets=QUERY_COUNT_BUCKETS)
+REQUEST_SQL_SECONDS = REGISTRY.histogram('http_request_sql_seconds', 'Time a request spent in SQL queries',
+                                         labels=('endpoint', ))
+REQUEST_SERIALIZER_SECONDS = REGISTRY.histogram('http_request_serializer_seconds',
+                                                'Time a request spent serializing its response data',
+                                                labels=('endpoint', ))
+REQUEST_CACHE_LOOKUPS = REGISTRY.counter('http_request_cache_lookups_total', 'Cache lookups made by requests',
+                                         labels=('endpoint', 'result'))
+QUERY_BUDGET_EXCEEDED = REGISTRY.counter('http_request_query_budget_exceeded_total',
+                                         'Requests which ran more SQL queries than their view allows',
+                                         labels=('endpoint', ))
+
+
+class QueryBudgetExceededError(Error):
+    pass
+
+
+class RequestStats:
+    """ What a single request has done so far """
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.query_count = 0
+        self.sql_seconds = 0.0
+        self.serializer_seconds = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.is_serializing = False
+
+    @property
+    def elapsed_seconds(self) -> float:
+        return time.perf_counter() - self.started_at
+
+
+_local = threading.local()
+
+
+def current_stats() -> RequestStats:
+    """ The stats of the request this thread is handling, None outside of a request """
+    return getattr(_local, 'stats', None)
+
+
+def record_cache_lookup(is_hit: bool):
+    stats = current_stats()
+    if stats is None:
+        return
+    if is_hit:
+        stats.cache_hits += 1
+    else:
+        stats.cache_misses += 1
+
+
+def query_budget(max_queries: int):
+    """
+    Declares the most SQL queries a view may run per request.
+    Decorates a view class, or a function view (above @api_view)
+    """
+    def decorator(view):
+        view.query_budget = max_queries
+        return view
+    return decorator
+
+
+def get_query_budget(view_func) -> int:
+    budget = getattr(view_func, 'query_budget', None)
+    if budget is None:
+        budget = getattr(getattr(view_func, 'view_class', None), 'query_budget', None)
+    return budget
+
+
+def _timed_data(data_property: property) -> property:
+    def data(serializer):
+        stats = current_stats()
+        if stats is None or stats.is_serializing:  # a serializer used within another one is timed by it
+            return data_property.fget(serializer)
+        stats.is_serializing = True
+        start = time.perf_counter()
+        try:
+            return data_property.fget(serializer)
+        finally:
+            stats.serializer_seconds += time.perf_counter() - start
+            stats.is_serializing = False
+    return property(data)
+
+
+_serializers_instrumented = False
+_instrument_lock = threading.Lock()
+
+
+def instrument_serializers():
+    """ Times the .data of every DRF serializer, as that is where the whole serialization happens """
+    global _serializers_instrumented
+    with _instrument_lock:
+        if _serializers_instrumented:
+            return
+        for serializer_class in (Serializer, ListSerializer):
+            serializer_class.data = _timed_data(serializer_class.data)
+        _serializers_instrumented = True
+
+
+class RequestMetricsMiddleware:
+    """
+    Should be the first middleware, so that it measures the others as well.
+    Queries are counted through Django's debug cursor, which logs every query of the connection
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+        instrument_serializers()
+
+    def __call__(self, request):
+        stats = RequestStats()
+        _local.stats = stats
+        previous_debug_cursors = {}
+        query_log_starts = {}
+        for connection in connections.all():
+            previous_debug_cursors[connection.alias] = connection.force_debug_cursor
+            connection.force_debug_cursor = True
+            query_log_starts[connection.alias] = len(connection.queries_log)
+
+        try:
+            response = self.get_response(request)
+        finally:
+            _local.stats = None
+            for connection in connections.all():
+                queries = list(connection.queries_log)[query_log_starts.get(connection.alias, 0):]
+                stats.query_count += len(queries)
+                stats.sql_seconds += sum(float(query['time']) for query in queries)
+                connection.force_debug_cursor = previous_debug_cursors.get(connection.alias, False)
+
+        endpoint = self.get_endpoint(request)
+        self.observe(endpoint, request.method, stats)
+        if settings.DEBUG:
+            self.add_headers(response, stats)
+        self.check_query_budget(request, endpoint, stats)
+        return response
+
+    @staticmethod
+    def get_endpoint(request) -> str:
+        resolver_match = getattr(request, 'resolver_match', None)
+        if resolver_match is None:
+            return 'unresolved'
+        return resolver_match.view_name
+
+    @staticmethod
+    def observe(endpoint: str, method: str, stats: RequestStats):
+        REQUEST_SECONDS.labels(endpoint=endpoint, method=method).observe(stats.elapsed_seconds)
+        REQUEST_QUERIES.labels(endpoint=endpoint).observe(stats.query_count)
+        REQUEST_SQL_SECONDS.labels(endpoint=endpoint).observe(stats.sql_seconds)
+        REQUEST_SERIALIZER_SECONDS.labels(endpoint=endpoint).observe(stats.serializer_seconds)
+        if stats.cache_hits:
+            REQUEST_CACHE_LOOKUPS.labels(endpoint=endpoint, result='hit').inc(stats.cache_hits)
+        if stats.cache_misses:
+            REQUEST_CACHE_LOOKUPS.labels(endpoint=endpoint, result='miss').inc(stats.cache_misses)
+
+    @staticmethod
+    def add_headers(response, stats: RequestStats):
+        response['X-Response-Time-Ms'] = f'{stats.elapsed_seconds * 1000:.1f}'
+        response['X-DB-Queries'] = str(stats.query_count)
+        response['X-DB-Time-Ms'] = f'{stats.sql_seconds * 1000:.1f}'
+        response['X-Serializer-Time-Ms'] = f'{stats.serializer_seconds * 1000:.1f}'
+        response['X-Cache-Hits'] = str(stats.cache_hits)
+        response['X-Cache-Misses'] = str(stats.cache_misses)
+
+    @staticmethod
+    def check_query_budget(request, endpoint: str, stats: RequestStats):
+        resolver_match = getattr(request, 'resolver_match', None)
+        budget = get_query_budget(resolver_match.func) if resolver_match is not None else None
+        if budget is None or stats.query_count <= budget:
+            return
+
+        QUERY_BUDGET_EXCEEDED.labels(endpoint=endpoint).inc()
+        message = f'{request.method} {request.path} ({endpoint}) ran {stats.query_count} queries, its budget is {budget}'
+        if settings.QUERY_BUDGETS_ENFORCED:
+            raise QueryBudgetExceededError(message)
+        logger.warning(message)
@@ -0,0 +1,183 @@
+"""
+A view-level cache of GET responses.
+
+A response is cached under its view, the requesting user (or `shared` for views which are the same for everybody),
+    its URL arguments and query string, and the current versions of the namespaces its data comes from
+    (e.g `challenge:5` or `user:3`).
+Bumping a namespace's version (see bump_versions) makes every key built with the old version unreachable,
+    so a change invalidates the affected responses of every worker at once, as long as the cache backend is shared.
+The unreachable responses are left to expire.
+
+Models registered in CACHE_VERSIONS bump their versions whenever they are saved or deleted:
+    the model's own (e.g `challenges.challenge`), the changed object's (e.g `challenges.challenge:5`)
+    and the ones of the data derived from it.
+Responses built only from such models can be cached for long, as they get invalidated the moment anything changes.
+That only holds when every process shares the cache (RESPONSE_CACHE_IS_SHARED), a per-process cache never sees
+    the bumps of other processes, so its responses are kept for UNSHARED_RESPONSE_CACHE_MAX_SECONDS at most.
+
+Usage, on a DRF view's handler method, where the request is already authenticated and permitted:
+    @cache_response(timeout=60, versions=(model_version(Challenge, '{challenge_pk}'), 'user:{user_id}'))
+    def list(self, request, *args, **kwargs):
+"""
+import functools
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from rest_framework.response import Response
+
+from metrics import REGISTRY
+from request_metrics import record_cache_lookup
+
+RESPONSE_CACHE_LOOKUPS = REGISTRY.counter('response_cache_lookups_total', 'Cacheable GET requests, by cache result',
+                                          labels=('view', 'result'))
+
+
+def get_cache():
+    return caches[settings.RESPONSE_CACHE_ALIAS]
+
+
+def _version_key(namespace: str) -> str:
+    return f'version:{namespace}'
+
+
+def get_versions(namespaces: [str]) -> [str]:
+    """
+    The current versions of the namespaces.
+    A namespace without a version (new or evicted) gets a random one, so it never matches keys from before the eviction
+    """
+    cache = get_cache()
+    keys = [_version_key(namespace) for namespace in namespaces]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            new_version = uuid.uuid4().hex
+            cache.add(key, new_version, timeout=None)
+            versions[key] = cache.get(key, new_version)  # another request may have added it first
+    return [versions[key] for key in keys]
+
+
+def bump_versions(*namespaces: str):
+    """ Invalidates every cached response built from the given namespaces """
+    get_cache().set_many({_version_key(namespace): uuid.uuid4().hex for namespace in namespaces}, timeout=None)
+
+
+def bump_versions_on_commit(*namespaces: str):
+    """
+    Bumps the versions right away, so that the changing request does not get served its stale responses,
+        and once more after the transaction commits, as other requests may have cached the pre-commit data meanwhile
+    """
+    bump_versions(*namespaces)
+    transaction.on_commit(lambda: bump_versions(*namespaces))
+
+
+def model_version(model, pk=None) -> str:
+    """ The version namespace of a model or, given a primary key (or a URL argument placeholder), of one object """
+    if pk is None:
+        return model._meta.label_lower
+    return f'{model._meta.label_lower}:{pk}'
+
+
+class CacheVersionRegistry:
+    """
+    Bumps the versions of the registered models on post_save and post_delete,
+        and on m2m_changed of their many-to-many fields
+    """
+    def __init__(self):
+        self._dependents = {}
+        self._owners_by_through = {}  # the intermediary model of a many-to-many field -> the model it is defined on
+
+    def register(self, model, dependents=None):
+        """
+        :param dependents: a function which returns the namespaces derived from a changed object,
+            besides the object's and the model's, e.g lambda comment: [model_version(Challenge, comment.challenge_id)]
+        """
+        self._dependents[model] = dependents
+        uid = f'cache_versions:{model._meta.label_lower}'
+        post_save.connect(self._object_changed, sender=model, weak=False, dispatch_uid=uid)
+        post_delete.connect(self._object_changed, sender=model, weak=False, dispatch_uid=uid)
+        for field in model._meta.many_to_many:
+            through = field.remote_field.through
+            self._owners_by_through[through] = model
+            m2m_changed.connect(self._relation_changed, sender=through, weak=False, dispatch_uid=f'{uid}.{field.name}')
+
+    def get_namespaces(self, instance) -> [str]:
+        model = type(instance)
+        namespaces = [model_version(model), model_version(model, instance.pk)]
+        dependents = self._dependents[model]
+        if dependents is not None:
+            namespaces.extend(dependents(instance))
+        return namespaces
+
+    def _object_changed(self, sender, instance, *args, **kwargs):
+        bump_versions_on_commit(*self.get_namespaces(instance))
+
+    def _relation_changed(self, sender, instance, action, *args, **kwargs):
+        if not action.startswith('post_'):
+            return
+        owner = self._owners_by_through[sender]
+        if isinstance(instance, owner):
+            bump_versions_on_commit(*self.get_namespaces(instance))
+        else:
+            # changed from the other side (e.g language.challenge_set.add()), so bump every owner
+            bump_versions_on_commit(model_version(owner))
+
+
+CACHE_VERSIONS = CacheVersionRegistry()
+
+
+def get_timeout(timeout: int) -> int:
+    if settings.RESPONSE_CACHE_IS_SHARED:
+        return timeout
+    return min(timeout, settings.UNSHARED_RESPONSE_CACHE_MAX_SECONDS)
+
+
+def build_response_key(view_name: str, user_part: str, kwargs: dict, query_string: str, versions: [str]) -> str:
+    """ Hashes the variable parts, as URL arguments may hold characters (e.g spaces) which memcached keys cannot """
+    variable_parts = '|'.join([repr(sorted(kwargs.items())), query_string] + versions)
+    return f'response:{view_name}:{user_part}:{hashlib.md5(variable_parts.encode()).hexdigest()}'
+
+
+def cache_response(timeout: int, versions: tuple=(), per_user: bool=True):
+    """
+    Caches the successful responses of a DRF view's handler method
+    :param timeout: for how many seconds a response is served at most, even if nothing bumps its versions.
+        Capped to UNSHARED_RESPONSE_CACHE_MAX_SECONDS when the cache is not shared, see get_timeout
+    :param versions: the namespaces the response's data comes from, formatted with the URL arguments and user_id
+    :param per_user: whether the response depends on the requesting user
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(view, request, *args, **kwargs):
+            if request.method != 'GET':
+                return handler(view, request, *args, **kwargs)
+
+            view_name = f'{view.__class__.__name__}.{handler.__name__}'
+            user_id = request.user.id if request.user.is_authenticated else None
+            if per_user:
+                user_part = 'anonymous' if user_id is None else str(user_id)
+            else:
+                user_part = 'shared'
+            namespaces = [namespace.format(user_id=user_id, **kwargs) for namespace in versions]
+            key = build_response_key(view_name, user_part, kwargs, request.META.get('QUERY_STRING', ''),
+                                     get_versions(namespaces))
+
+            cache = get_cache()
+            cached = cache.get(key)
+            if cached is not None:
+                RESPONSE_CACHE_LOOKUPS.labels(view=view_name, result='hit').inc()
+                record_cache_lookup(is_hit=True)
+                status, data = cached
+                return Response(data=data, status=status)
+
+            RESPONSE_CACHE_LOOKUPS.labels(view=view_name, result='miss').inc()
+            record_cache_lookup(is_hit=False)
+            response = handler(view, request, *args, **kwargs)
+            if response.status_code == 200:
+                cache.set(key, (response.status_code, response.data), timeout=get_timeout(timeout))
+            return response
+        return wrapper
+    return decorator
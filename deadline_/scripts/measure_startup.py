@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Measures how long a fresh process takes to load the project, which every web worker, management command
+    and test run pays before doing anything.
+Each measurement runs in a new interpreter, so nothing is cached between them. It reports
+    - import: importing the constants and setting Django up
+    - clients: creating the Docker and RabbitMQ clients afterwards, which used to happen during the import
+
+Usage (from the deadline_ folder): python scripts/measure_startup.py [--runs 10] [--skip-clients]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MEASURE_SOURCE = '''
+import os, sys, time
+sys.path.insert(0, {project_root!r})
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'deadline.settings')
+start = time.perf_counter()
+import django
+django.setup()
+import constants
+import_seconds = time.perf_counter() - start
+client_seconds = 0.0
+if {create_clients!r}:
+    from deadline.settings import RABBITMQ_CLIENT
+    start = time.perf_counter()
+    constants.DOCKER_CLIENT.client
+    RABBITMQ_CLIENT.connect()
+    client_seconds = time.perf_counter() - start
+print(import_seconds, client_seconds)
+'''
+
+
+def measure_once(create_clients: bool) -> (float, float):
+    output = subprocess.check_output([sys.executable, '-c', MEASURE_SOURCE.format(project_root=PROJECT_ROOT,
+                                                                                  create_clients=create_clients)],
+                                     cwd=PROJECT_ROOT)
+    import_seconds, client_seconds = output.decode().split()[-2:]
+    return float(import_seconds), float(client_seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the startup time of the project')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--skip-clients', action='store_true',
+                        help='Do not connect to Docker and RabbitMQ, e.g when they are not running')
+    args = parser.parse_args()
+
+    measurements = [measure_once(not args.skip_clients) for _ in range(args.runs)]
+    import_times, client_times = zip(*measurements)
+    print(f'import:  median {statistics.median(import_times) * 1000:.0f}ms, '
+          f'max {max(import_times) * 1000:.0f}ms over {args.runs} runs')
+    if not args.skip_clients:
+        print(f'clients: median {statistics.median(client_times) * 1000:.0f}ms, '
+              f'max {max(client_times) * 1000:.0f}ms - now paid on first use instead of on import')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# The content fields which identify a squashable notification, by their non-squashed type
+# Mirrors get_last_notification_content_filter() of each SquashableNotificationManagerBase child at the time of writing
+SQUASH_KEY_CONTENT_FIELDS = {
+    'RECEIVE_FOLLOW_NOTIFICATION': [],
+    'RECEIVE_SUBMISSION_LIKE_NOTIFICATION': ['submission_id'],
+    'RECEIVE_NW_LIKE_NOTIFICATION': ['nw_item_id'],
+    'RECEIVE_NW_COMMENT_NOTIFICATION': ['nw_item_id'],
+    'RECEIVE_NW_COMMENT_REPLY_NOTIFICATION': ['nw_comment_id'],
+    'RECEIVE_SUBMISSION_COMMENT_NOTIFICATION': ['submission_id'],
+    'RECEIVE_SUBMISSION_COMMENT_REPLY_NOTIFICATION': ['comment_id'],
+    'RECEIVE_CHALLENGE_COMMENT_REPLY_NOTIFICATION': ['challenge_id', 'comment_id'],
+}
+SQUASHED_SUFFIX = '_SQUASHED'
+
+
+def populate_squash_keys(apps, schema_editor):
+    """
+    Fills in the squash_key of every unread squashable notification.
+    Only the latest unread notification per key gets one, as that is the one the old logic would squash into
+    """
+    Notification = apps.get_model('social', 'Notification')
+    seen_keys = set()
+    unread_notifications = Notification.objects.filter(is_read=False, recipient__isnull=False).order_by('-updated_at')
+    for notification in unread_notifications.iterator():
+        base_type = notification.type
+        if base_type.endswith(SQUASHED_SUFFIX):
+            base_type = base_type[:-len(SQUASHED_SUFFIX)]
+        if base_type not in SQUASH_KEY_CONTENT_FIELDS:
+            continue
+
+        key_parts = [str(notification.recipient_id), base_type] + [
+            f'{field}={notification.content[field]}' for field in sorted(SQUASH_KEY_CONTENT_FIELDS[base_type])]
+        squash_key = ':'.join(key_parts)
+        if squash_key in seen_keys:
+            continue
+        seen_keys.add(squash_key)
+
+        Notification.objects.filter(id=notification.id).update(squash_key=squash_key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('social', '0008_auto_20171221_2130'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='squash_key',
+            field=models.CharField(max_length=200, null=True),
+        ),
+        migrations.RunPython(populate_squash_keys, migrations.RunPython.noop),
+        # Django cannot express partial indexes yet, so we create it by hand.
+        # Only unread notifications are squashed, so only they need to be unique and indexed
+        migrations.RunSQL(
+            'CREATE UNIQUE INDEX social_notification_unread_squash_key_uniq '
+            'ON social_notification (squash_key) '
+            'WHERE is_read = FALSE AND squash_key IS NOT NULL;',
+            'DROP INDEX social_notification_unread_squash_key_uniq;'
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('social', '0009_notification_squash_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationOutboxEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recipient_id', models.IntegerField(null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('notification', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='social.Notification')),
+            ],
+            options={
+                'ordering': ('id',),
+            },
+        ),
+    ]
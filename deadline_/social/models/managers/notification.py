@@ -4,11 +4,13 @@ and all the helper managers, which manage specific Notification creation and squ
 """
 from abc import ABC, abstractmethod
 
+from django.db import transaction, IntegrityError, connection
 from django.db.models import Manager
 
 from accounts.models import User
 from challenges.models import SubmissionComment, ChallengeComment, Submission, Challenge
 from errors import ForbiddenMethodError
+from notifications.constants import NOTIFICATION_OUTBOX_CHANNEL
 from social.constants import (
     RECEIVE_FOLLOW_NOTIFICATION, RECEIVE_SUBMISSION_UPVOTE_NOTIFICATION, RECEIVE_NW_ITEM_LIKE_NOTIFICATION,
     NEW_CHALLENGE_NOTIFICATION, RECEIVE_NW_ITEM_COMMENT_NOTIFICATION, RECEIVE_NW_ITEM_COMMENT_REPLY_NOTIFICATION,
@@ -38,8 +40,10 @@ class NotificationManager(Manager):
         """
         The create() method, intentionally marked as private as it is not intended for usage at all,
             except for testing purposes
+        Runs in a transaction, so that the notification and its outbox entry are committed together
         """
-        return super().create(*args, **kwargs)
+        with transaction.atomic():
+            return super().create(*args, **kwargs)
 
     def create_receive_follow_notification(self, recipient: User, follower: User):
         """
@@ -83,6 +87,20 @@ class NotificationManager(Manager):
         return ReceiveChallengeCommentReplyNotificationManager(self, reply=reply).create()
 
 
+class NotificationOutboxEntryManager(Manager):
+    def create_for_notification(self, notification: 'Notification') -> 'NotificationOutboxEntry':
+        """
+        Creates the outbox entry for a newly-created notification and wakes up the outbox relay.
+        Must be called in the transaction which creates the notification -
+            Postgres only delivers the NOTIFY once said transaction commits
+        """
+        entry = self.create(notification=notification, recipient_id=notification.recipient_id)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [NOTIFICATION_OUTBOX_CHANNEL, ''])
+
+        return entry
+
+
 class SquashableNotificationManagerBase(ABC):
     """
     This is a wrapper to a NotificationManager for creating a notification of a specific type.
@@ -101,11 +119,21 @@ class SquashableNotificationManagerBase(ABC):
         if self.should_skip_creation():
             return
 
-        if self.should_squash():
-            return self.squash()
-        else:
-            return self.notification_manager._create(recipient=self.recipient, type=self.TYPE,
-                                                     content=self.get_normal_content())
+        with transaction.atomic():
+            if self.should_squash():
+                return self.squash()
+
+            try:
+                # use a savepoint, as a concurrent creation might have inserted the unread notification for our key
+                with transaction.atomic():
+                    return self.notification_manager._create(recipient=self.recipient, type=self.TYPE,
+                                                             content=self.get_normal_content(),
+                                                             squash_key=self.get_squash_key())
+            except IntegrityError:
+                # The unique unread squash_key index rejected us, meaning we lost the race. Squash into the winner
+                if not self.should_squash():
+                    raise
+                return self.squash()
 
     def should_squash(self) -> bool:
         """
@@ -145,17 +173,24 @@ class SquashableNotificationManagerBase(ABC):
     def find_last_squashable_notification(self) -> 'Notification':
         """
         This method should get the last Notification that is not read and is the same as our type
+        There can be at most one such notification per squash_key (enforced by a partial unique index on unread rows),
+            so this is a single index lookup. The row is locked until the squash is saved
         """
-        content_filter = self.get_last_notification_content_filter()
-        last_notification_query = self.notification_manager.filter(
-            type__in=[self.TYPE, self.SQUASHED_TYPE],
-            is_read=False,
-            recipient=self.recipient)
+        try:
+            return self.notification_manager.select_for_update().get(squash_key=self.get_squash_key(), is_read=False)
+        except self.notification_manager.model.DoesNotExist:
+            return None
 
-        if content_filter:
-            last_notification_query = last_notification_query.filter(content__contains=content_filter)
-
-        return last_notification_query.last()
+    def get_squash_key(self) -> str:
+        """
+        Returns the key which identifies the unread notification this one can be squashed into.
+        It is built from the recipient, the (non-squashed) type and the content filter of the notification
+            ex: 12:RECEIVE_SUBMISSION_LIKE_NOTIFICATION:submission_id=3
+        """
+        content_filter = self.get_last_notification_content_filter()
+        key_parts = [str(self.recipient.id), self.TYPE] + [f'{field}={content_filter[field]}'
+                                                           for field in sorted(content_filter.keys())]
+        return ':'.join(key_parts)
 
     def should_skip_creation(self) -> bool:
         """
@@ -184,7 +219,10 @@ class SquashableNotificationManagerBase(ABC):
         pass
 
     def get_last_notification_content_filter(self) -> dict:
-        """ Returns the `content` we want our last squashable notification to have. """
+        """
+        Returns the `content` we want our last squashable notification to have.
+        These fields are part of the squash key, so they must be present in both the normal and the squashed content
+        """
         return {}
 
     def create_check(self) -> bool:
@@ -11,7 +11,7 @@ from challenges.models import SubmissionVote
 from social.constants import VALID_NOTIFICATION_TYPES, NOTIFICATION_TYPE_CONTENT_FIELDS
 from social.errors import InvalidNotificationType, MissingNotificationContentField, \
     InvalidNotificationContentField
-from social.models.managers.notification import NotificationManager
+from social.models.managers.notification import NotificationManager, NotificationOutboxEntryManager
 
 
 class Notification(models.Model):
@@ -26,6 +26,8 @@ class Notification(models.Model):
     is_read = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # identifies the notifications which can be squashed together, see SquashableNotificationManagerBase.get_squash_key
+    squash_key = models.CharField(max_length=200, null=True)
 
     objects = NotificationManager()
 
@@ -44,7 +46,20 @@ class Notification(models.Model):
         return self.recipient_id == user.id
 
 
-from deadline.celery import send_notification
+class NotificationOutboxEntry(models.Model):
+    """
+    A created Notification which is yet to be published to RabbitMQ.
+    It is written in the same transaction as the Notification and deleted by the outbox relay
+        (see notifications.outbox) once RabbitMQ has confirmed the message
+    """
+    notification = models.ForeignKey(Notification, on_delete=models.CASCADE)
+    recipient_id = models.IntegerField(null=True)  # denormalized, so the relay never needs to join
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = NotificationOutboxEntryManager()
+
+    class Meta:
+        ordering = ('id', )  # the order in which entries get published
 
 
 @receiver(pre_save, sender=Notification)
@@ -72,4 +87,4 @@ def notification_type_validation(sender, instance, *args, **kwargs):
 @receiver(post_save, sender=Notification)
 def notif_post_save_send(sender, instance, created, *args, **kwargs):
     if created:
-        send_notification(instance.id)
+        NotificationOutboxEntry.objects.create_for_notification(instance)
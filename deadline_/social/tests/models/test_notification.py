@@ -18,7 +18,7 @@ from social.constants import RECEIVE_FOLLOW_NOTIFICATION, RECEIVE_SUBMISSION_UPV
     RECEIVE_SUBMISSION_COMMENT_NOTIFICATION_SQUASHED, RECEIVE_SUBMISSION_COMMENT_REPLY_NOTIFICATION_SQUASHED
 from social.errors import InvalidNotificationType, MissingNotificationContentField, InvalidNotificationContentField, \
     InvalidFollowError
-from social.models.notification import Notification
+from social.models.notification import Notification, NotificationOutboxEntry
 from social.models.newsfeed_item import NewsfeedItem, NewsfeedItemComment
 from social.serializers import NotificationSerializer
 
@@ -55,16 +55,18 @@ class NotificationTests(TestCase, TestHelperMixin):
             Notification.objects._create(recipient=self.auth_user, type='test_type',
                                          content={'1': 'Hello I like turtles', '2': 'pf', 'tank': 'yo'})
 
-    @patch('social.models.notification.send_notification')
-    def test_post_save_notif_sends_create_message_to_rabbit_mq(self, mock_send_notif):
+    def test_post_save_notif_creates_outbox_entry(self):
         sec_user = UserFactory()
         notif = Notification.objects.create_receive_follow_notification(recipient=self.auth_user, follower=sec_user)
 
-        # Assert it is called only on creation
+        # Assert it is created only on creation
         notif.follower = self.auth_user
         notif.save()
 
-        mock_send_notif.assert_called_once_with(notif.id)
+        self.assertEqual(NotificationOutboxEntry.objects.count(), 1)
+        entry = NotificationOutboxEntry.objects.first()
+        self.assertEqual(entry.notification_id, notif.id)
+        self.assertEqual(entry.recipient_id, self.auth_user.id)
 
     def test_create_new_challenge_notification(self):
         chal = ChallengeFactory()
@@ -137,6 +139,23 @@ class ReceiveFollowNotificationTests(TestCase, TestHelperMixin):
             self.assertEqual(notif.recipient, self.auth_user)
         self.assertEqual(Notification.objects.count(), 3)
 
+    def test_create_sets_squash_key(self):
+        notif = Notification.objects.create_receive_follow_notification(recipient=self.auth_user, follower=UserFactory())
+        self.assertEqual(notif.squash_key, f'{self.auth_user.id}:{RECEIVE_FOLLOW_NOTIFICATION}')
+
+    def test_create_squashes_into_concurrently_created_notification(self):
+        """ If another notification with our squash key gets inserted between our lookup and insert, squash into it """
+        sec_user, third_user = UserFactory(), UserFactory()
+        first_notif = Notification.objects.create_receive_follow_notification(recipient=self.auth_user, follower=sec_user)
+
+        with patch('social.models.managers.notification.ReceiveFollowNotificationManager.find_last_squashable_notification',
+                   side_effect=[None, first_notif]):
+            notif = Notification.objects.create_receive_follow_notification(recipient=self.auth_user, follower=third_user)
+
+        self.assertEqual(notif.id, first_notif.id)
+        self.assertEqual(notif.type, RECEIVE_FOLLOW_NOTIFICATION_SQUASHED)
+        self.assertEqual(Notification.objects.count(), 1)
+
 
 class ReceiveSubmissionUpvoteNotificationTests(TestCase, TestHelperMixin):
     def setUp(self):
@@ -365,6 +365,7 @@ class NewsfeedItemCommentCreateView(APIView):
 class NewsfeedItemCommentReplyCreateView(CreateAPIView):
     permission_classes = (IsAuthenticated, )
     model_classes = (NewsfeedItem, NewsfeedItemComment)
+    model_select_related = {NewsfeedItemComment: ('author', )}
 
     @fetch_models
     def post(self, request, nw_item: NewsfeedItem, nw_item_comment: NewsfeedItemComment, *args, **kwargs):
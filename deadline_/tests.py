@@ -1,17 +1,33 @@
+import asyncio
+import time
 from random import randint
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
-from django.test import TestCase
+import jwt
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from unittest import TestCase as unittest_TestCase
 from unittest.mock import MagicMock
 from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory, APITestCase, force_authenticate
+from rest_framework.views import APIView
 
-from challenges.models import MainCategory, SubCategory
+from challenges.models import MainCategory, SubCategory, Challenge, ChallengeComment, Submission, SubmissionComment
 from errors import FetchError
 from helpers import fetch_models_by_pks
 from decorators import fetch_models
-from challenges.tests.factories import MainCategoryFactory, SubCategoryFactory
+from challenges.tests.factories import (MainCategoryFactory, SubCategoryFactory, UserFactory, ChallengeFactory,
+                                        LanguageFactory, SubmissionFactory, SubmissionCommentFactory)
 from views import BaseManageView
+from websocket_sender import WebSocketSender, SLOW_CLIENT_CLOSE_CODE
+from async_helpers import ShardedQueue, QUEUE_DEPTH
+from token_cache import JWTExpiryCache, tokens_match
+from ws_load_test import LatencyStats, histogram_delta_summary
+from external_services import LazyServiceHandle, RabbitMQClient
+from challenges.tests.helpers import run_async, coroutine_mock
+from request_metrics import QueryBudgetExceededError, REQUEST_QUERIES
+from response_cache import cache_response, bump_versions, get_versions, get_cache, model_version, get_timeout
 
 class FetchModelsTest(TestCase):
     def setUp(self):
@@ -50,6 +66,50 @@ class FetchModelsTest(TestCase):
             self.assertEqual(expected_results, received_results)
 
 
+class FetchModelChainTest(TestCase):
+    def setUp(self):
+        self.challenge = ChallengeFactory()
+        self.submission = SubmissionFactory(challenge=self.challenge, author=UserFactory())
+        self.comment = SubmissionCommentFactory(submission=self.submission, author=UserFactory())
+
+    def test_fetches_a_chain_of_models_with_a_single_query(self):
+        with self.assertNumQueries(1):
+            received_results = fetch_models_by_pks({
+                Challenge: self.challenge.id,
+                Submission: self.submission.id,
+                SubmissionComment: self.comment.id
+            })
+            # the parents are the ones joined to the comment
+            self.assertEqual(received_results[2].submission.challenge, received_results[0])
+
+        self.assertEqual([self.challenge, self.submission, self.comment], received_results)
+
+    def test_applies_select_related_and_only_hints(self):
+        with self.assertNumQueries(1):
+            challenge, submission, comment = fetch_models_by_pks(
+                {Challenge: self.challenge.id, Submission: self.submission.id, SubmissionComment: self.comment.id},
+                select_related={SubmissionComment: ('author', ), Submission: ('author', )},
+                only={Challenge: ('id', 'name')})
+            self.assertEqual(comment.author, self.comment.author)
+            self.assertEqual(submission.author, self.submission.author)
+            self.assertEqual(challenge.name, self.challenge.name)
+        self.assertIn('score', challenge.get_deferred_fields())
+
+    def test_returns_models_which_do_not_belong_to_their_parent(self):
+        """ Views check that themselves, returning a 400 which says which one does not belong where """
+        other_challenge = ChallengeFactory()
+
+        received_results = fetch_models_by_pks({Challenge: other_challenge.id, Submission: self.submission.id})
+
+        self.assertEqual([other_challenge, self.submission], received_results)
+
+    def test_raises_FetchError_for_a_missing_model_in_the_chain(self):
+        with self.assertRaises(FetchError) as error:
+            fetch_models_by_pks({Challenge: self.challenge.id, Submission: 200, SubmissionComment: self.comment.id})
+
+        self.assertEqual(str(error.exception), 'Submission with ID 200 does not exist.')
+
+
 class FetchModelsDecoratorTest(TestCase):
     def setUp(self):
         class Tank:
@@ -141,3 +201,455 @@ class BaseManageViewTests(unittest_TestCase):
         self.assertTrue(isinstance(response, Response))
         self.assertEqual(response.status_code, 404)
 
+
+class WebSocketSenderTests(unittest_TestCase):
+    def setUp(self):
+        self.web_socket = MagicMock(send=coroutine_mock(), close=coroutine_mock())
+        self.sender = WebSocketSender(self.web_socket, max_pending_frames=2, max_dropped_frames=1)
+
+    def sent_frames(self):
+        return [sent_call[0][0] for sent_call in self.web_socket.send.mock.call_args_list]
+
+    def run_sender(self, send_frames):
+        async def _test():
+            send_frames()
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+        run_async(_test())
+
+    def test_sends_frames_in_order_through_one_writer(self):
+        def send_frames():
+            self.sender.send({'id': 1})
+            self.sender.send({'id': 2})
+            self.assertEqual(self.sender.pending_count, 2)
+
+        self.run_sender(send_frames)
+
+        self.assertEqual(self.sent_frames(), ['{"id": 1}', '{"id": 2}'])
+        self.assertEqual(self.sender.pending_count, 0)
+
+    def test_coalesced_frame_replaces_pending_one(self):
+        def send_frames():
+            self.sender.send({'typing': 1}, coalesce_key='typing')
+            self.sender.send({'id': 1})
+            self.sender.send({'typing': 2}, coalesce_key='typing')
+
+        self.run_sender(send_frames)
+
+        self.assertEqual(self.sent_frames(), ['{"typing": 2}', '{"id": 1}'])
+        self.assertFalse(self.sender.is_closed)
+
+    def test_droppable_frame_is_dropped_to_make_room(self):
+        def send_frames():
+            self.sender.send({'id': 1}, droppable=True)
+            self.sender.send({'id': 2})
+            self.assertTrue(self.sender.send({'id': 3}))
+
+        self.run_sender(send_frames)
+
+        self.assertEqual(self.sent_frames(), ['{"id": 2}', '{"id": 3}'])
+        self.assertFalse(self.sender.is_closed)
+
+    def test_client_over_limit_is_disconnected(self):
+        def send_frames():
+            self.sender.send({'id': 1})
+            self.sender.send({'id': 2})
+            self.assertFalse(self.sender.send({'id': 3}))
+
+        self.run_sender(send_frames)
+
+        self.assertTrue(self.sender.is_closed)
+        self.assertEqual(self.sent_frames(), [])
+        self.web_socket.close.mock.assert_called_once_with(code=SLOW_CLIENT_CLOSE_CODE,
+                                                           reason='Too many pending messages')
+
+    def test_client_which_keeps_having_frames_dropped_is_disconnected(self):
+        def send_frames():
+            for notif_id in range(4):
+                self.sender.send({'id': notif_id}, droppable=True)
+
+        self.run_sender(send_frames)
+
+        self.assertTrue(self.sender.is_closed)
+        self.assertFalse(self.sender.send({'id': 5}))
+
+
+class ShardedQueueTests(unittest_TestCase):
+    def test_same_shard_key_lands_in_same_shard(self):
+        async def _test():
+            queue = ShardedQueue('tests.same_shard', shard_count=4)
+            self.assertIs(queue.get_shard((1, 2)), queue.get_shard((1, 2)))
+            self.assertEqual(len({queue.get_shard(key) for key in range(4)}), 4)
+        run_async(_test())
+
+    def test_workers_handle_a_shard_in_order_and_survive_errors(self):
+        handled = []
+
+        async def handle_packet(packet):
+            if packet == 'bad':
+                raise Exception()
+            await asyncio.sleep(0.01 if packet == 'slow' else 0)
+            handled.append(packet)
+
+        async def _test():
+            queue = ShardedQueue('tests.workers', shard_count=2)
+            for packet, shard_key in [('slow', 0), ('bad', 0), ('first', 0), ('other', 1)]:
+                await queue.put(packet, shard_key=shard_key)
+            self.assertEqual(QUEUE_DEPTH.labels(queue='tests.workers').value, 4)
+
+            queue.start_workers(handle_packet)
+            await asyncio.sleep(0.05)
+            self.assertEqual(QUEUE_DEPTH.labels(queue='tests.workers').value, 0)
+        run_async(_test())
+
+        # the other shard does not wait for the slow packet
+        self.assertEqual(handled, ['other', 'slow', 'first'])
+
+
+class JWTExpiryCacheTests(unittest_TestCase):
+    def setUp(self):
+        self.cache = JWTExpiryCache(max_size=2)
+        self.token = jwt.encode({'exp': int(time.time()) + 60}, 'secret').decode('utf-8')
+
+    @patch('token_cache.jwt.decode', wraps=jwt.decode)
+    def test_decodes_token_only_once(self, mock_decode):
+        self.assertFalse(self.cache.is_expired(self.token, 'secret'))
+        self.assertFalse(self.cache.is_expired(self.token, 'secret'))
+
+        mock_decode.assert_called_once_with(self.token, 'secret')
+
+    def test_token_is_not_trusted_for_another_secret(self):
+        self.assertFalse(self.cache.is_expired(self.token, 'secret'))
+
+        with self.assertRaises(jwt.DecodeError):
+            self.cache.is_expired(self.token, 'other_secret')
+
+    def test_cached_token_expires(self):
+        self.assertFalse(self.cache.is_expired(self.token, 'secret'))
+
+        with patch('token_cache.time.time', return_value=time.time() + 120):
+            self.assertTrue(self.cache.is_expired(self.token, 'secret'))
+
+    def test_expired_token_is_expired(self):
+        expired_token = jwt.encode({'exp': int(time.time()) - 60}, 'secret').decode('utf-8')
+        self.assertTrue(self.cache.is_expired(expired_token, 'secret'))
+
+    @patch('token_cache.jwt.decode', wraps=jwt.decode)
+    def test_invalidated_token_is_decoded_again(self, mock_decode):
+        self.cache.is_expired(self.token, 'secret')
+        self.cache.invalidate(self.token, 'secret')
+        self.cache.is_expired(self.token, 'secret')
+
+        self.assertEqual(mock_decode.call_count, 2)
+
+    @patch('token_cache.jwt.decode', wraps=jwt.decode)
+    def test_oldest_token_is_dropped_over_max_size(self, mock_decode):
+        tokens = [jwt.encode({'exp': int(time.time()) + 60, 'id': token_id}, 'secret').decode('utf-8')
+                  for token_id in range(3)]
+        for token in tokens:
+            self.cache.is_expired(token, 'secret')
+        self.cache.is_expired(tokens[2], 'secret')
+        self.cache.is_expired(tokens[0], 'secret')
+
+        self.assertEqual(mock_decode.call_count, 4)
+
+    def test_tokens_match(self):
+        self.assertTrue(tokens_match('token', 'token'))
+        self.assertFalse(tokens_match('token', 'tokem'))
+        self.assertFalse(tokens_match(None, 'token'))
+        self.assertFalse(tokens_match(b'token', 'token'))
+
+
+class LoadTestStatsTests(unittest_TestCase):
+    def test_latency_percentiles(self):
+        stats = LatencyStats()
+        for millis in range(1, 101):
+            stats.record('message', millis / 1000)
+
+        self.assertEqual(stats.count('message'), 100)
+        self.assertEqual(stats.percentile('message', 50), 0.05)
+        self.assertEqual(stats.percentile('message', 99), 0.099)
+        self.assertIsNone(stats.percentile('typing', 50))
+
+    def test_histogram_delta_summary_only_counts_new_observations(self):
+        before = 'lag_bucket{le="0.01"} 10\nlag_bucket{le="0.1"} 10\nlag_bucket{le="+Inf"} 10\n' \
+                 'lag_sum 0.05\nlag_count 10\n'
+        after = 'lag_bucket{le="0.01"} 10\nlag_bucket{le="0.1"} 110\nlag_bucket{le="+Inf"} 110\n' \
+                'lag_sum 5.05\nlag_count 110\n'
+
+        mean, p99_bound = histogram_delta_summary(before, after, 'lag')
+
+        self.assertAlmostEqual(mean, 0.05)
+        self.assertEqual(p99_bound, 0.1)
+        self.assertEqual(histogram_delta_summary(after, after, 'lag'), (None, None))
+
+
+class LazyServiceHandleTests(unittest_TestCase):
+    def test_creates_client_once_on_first_use(self):
+        create_client = MagicMock()
+        handle = LazyServiceHandle('Test', create_client)
+        create_client.assert_not_called()
+
+        handle.images.build(path='/')
+        handle.images.list()
+
+        create_client.assert_called_once_with()
+        create_client.return_value.images.build.assert_called_once_with(path='/')
+
+    def test_reset_creates_new_client(self):
+        create_client = MagicMock(side_effect=['first', 'second'])
+        handle = LazyServiceHandle('Test', create_client)
+
+        self.assertEqual(handle.client, 'first')
+        handle.reset()
+        self.assertFalse(handle.is_created)
+        self.assertEqual(handle.client, 'second')
+
+    @patch('constants.DOCKER_CLIENT')
+    def test_worker_processes_reset_service_clients(self, docker_client_mock):
+        from deadline.celery import reset_service_clients
+        rabbitmq_client_mock = MagicMock()
+
+        with override_settings(RABBITMQ_CLIENT=rabbitmq_client_mock):
+            reset_service_clients()
+
+        docker_client_mock.reset.assert_called_once_with()
+        rabbitmq_client_mock.reset.assert_called_once_with()
+
+    @patch('external_services.pika.BlockingConnection')
+    def test_rabbitmq_client_reconnects_after_reset(self, connection_mock):
+        connection_mock.return_value.is_closed = False
+        client = RabbitMQClient(MagicMock())
+        client.send_notification_messages([(1, 1)])
+
+        client.reset()
+        client.send_notification_messages([(2, 1)])
+
+        self.assertEqual(connection_mock.call_count, 2)
+
+    @patch('external_services.pika.BlockingConnection')
+    def test_rabbitmq_client_connects_on_first_publish(self, connection_mock):
+        connection_mock.return_value.is_closed = False
+        client = RabbitMQClient(MagicMock())
+        connection_mock.assert_not_called()
+
+        client.send_notification_messages([(1, 1)])
+        client.send_notification_messages([(2, 1)])
+
+        connection_mock.assert_called_once()
+
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                             'LOCATION': 'response-cache-tests'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        get_cache().clear()
+        self.factory = APIRequestFactory()
+        self.first_user = UserFactory()
+        self.second_user = UserFactory()
+        self.handled = MagicMock(return_value=Response(data={'ok': True}))
+        handled = self.handled
+
+        class UserView(APIView):
+            @cache_response(timeout=60, versions=('challenge:{challenge_pk}', 'user:{user_id}'))
+            def get(self, request, *args, **kwargs):
+                return handled()
+
+        class SharedView(APIView):
+            @cache_response(timeout=60, versions=('challenge:{challenge_pk}', ), per_user=False)
+            def get(self, request, *args, **kwargs):
+                return handled()
+
+        self.user_view = UserView.as_view()
+        self.shared_view = SharedView.as_view()
+
+    def tearDown(self):
+        get_cache().clear()
+
+    def get(self, view, user, challenge_pk=1, path='/challenges/1'):
+        request = self.factory.get(path)
+        force_authenticate(request, user=user)
+        return view(request, challenge_pk=challenge_pk)
+
+    def test_caches_per_user(self):
+        self.get(self.user_view, self.first_user)
+        response = self.get(self.user_view, self.first_user)
+        self.get(self.user_view, self.second_user)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'ok': True})
+        self.assertEqual(self.handled.call_count, 2)
+
+    def test_caps_timeout_when_cache_is_not_shared(self):
+        """ A per-process cache never sees the version bumps of other processes """
+        with override_settings(RESPONSE_CACHE_IS_SHARED=False, UNSHARED_RESPONSE_CACHE_MAX_SECONDS=5):
+            self.assertEqual(get_timeout(24 * 60 * 60), 5)
+            self.assertEqual(get_timeout(3), 3)
+        with override_settings(RESPONSE_CACHE_IS_SHARED=True):
+            self.assertEqual(get_timeout(24 * 60 * 60), 24 * 60 * 60)
+
+    def test_caches_shared_view_once(self):
+        self.get(self.shared_view, self.first_user)
+        self.get(self.shared_view, self.second_user)
+
+        self.assertEqual(self.handled.call_count, 1)
+
+    def test_keys_by_url_arguments_and_query_string(self):
+        self.get(self.shared_view, self.first_user)
+        self.get(self.shared_view, self.first_user, challenge_pk=2)
+        self.get(self.shared_view, self.first_user, path='/challenges/1?page=2')
+
+        self.assertEqual(self.handled.call_count, 3)
+
+    def test_bumping_a_version_invalidates_its_responses(self):
+        self.get(self.user_view, self.first_user)
+        self.get(self.user_view, self.second_user)
+
+        bump_versions(f'user:{self.first_user.id}')
+        self.get(self.user_view, self.first_user)
+        self.get(self.user_view, self.second_user)
+        self.assertEqual(self.handled.call_count, 3)
+
+        bump_versions('challenge:1')
+        self.get(self.user_view, self.first_user)
+        self.get(self.user_view, self.second_user)
+        self.assertEqual(self.handled.call_count, 5)
+
+    def test_does_not_cache_errors(self):
+        self.handled.return_value = Response(status=400)
+
+        self.get(self.shared_view, self.first_user)
+        self.get(self.shared_view, self.first_user)
+
+        self.assertEqual(self.handled.call_count, 2)
+
+    def test_evicted_version_is_recreated(self):
+        version = get_versions(['challenges.language'])
+        get_cache().delete('version:challenges.language')
+
+        new_version = get_versions(['challenges.language'])
+        self.assertNotEqual(new_version, version)
+        self.assertEqual(get_versions(['challenges.language']), new_version)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CacheVersionRegistryTests(TestCase):
+    def setUp(self):
+        get_cache().clear()
+
+    def tearDown(self):
+        get_cache().clear()
+
+    def test_model_version(self):
+        self.assertEqual(model_version(MainCategory), 'challenges.maincategory')
+        self.assertEqual(model_version(MainCategory, 5), 'challenges.maincategory:5')
+        self.assertEqual(model_version(MainCategory, '{pk}').format(pk=3), 'challenges.maincategory:3')
+
+    def test_save_and_delete_bump_model_and_object_versions(self):
+        category = MainCategoryFactory()
+        other_category = MainCategoryFactory()
+        namespaces = [model_version(MainCategory), model_version(MainCategory, category.id),
+                      model_version(MainCategory, other_category.id)]
+        model_before, object_before, other_before = get_versions(namespaces)
+
+        category.name = 'Renamed'
+        category.save()
+        model_after, object_after, other_after = get_versions(namespaces)
+        self.assertNotEqual(model_after, model_before)
+        self.assertNotEqual(object_after, object_before)
+        self.assertEqual(other_after, other_before)
+
+        category.delete()
+        self.assertNotEqual(get_versions([model_version(MainCategory)]), [model_after])
+
+    def test_bumps_dependent_versions(self):
+        challenge = ChallengeFactory()
+        challenge_version = get_versions([model_version(Challenge, challenge.id)])
+
+        ChallengeComment.objects.create(challenge=challenge, author=UserFactory(), content='Hello there')
+
+        self.assertNotEqual(get_versions([model_version(Challenge, challenge.id)]), challenge_version)
+
+    def test_many_to_many_change_bumps_versions(self):
+        challenge = ChallengeFactory()
+        language = LanguageFactory()
+        versions = get_versions([model_version(Challenge), model_version(Challenge, challenge.id)])
+
+        challenge.supported_languages.add(language)
+        new_versions = get_versions([model_version(Challenge), model_version(Challenge, challenge.id)])
+        self.assertNotEqual(new_versions[0], versions[0])
+        self.assertNotEqual(new_versions[1], versions[1])
+
+        language.challenge_set.remove(challenge)
+        self.assertNotEqual(get_versions([model_version(Challenge)]), new_versions[:1])
+
+
+class RequestMetricsMiddlewareTests(APITestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.auth_token = f'Token {self.user.auth_token.key}'
+        LanguageFactory()
+        LanguageFactory()
+
+    def get_languages(self):
+        return self.client.get('/challenges/languages', HTTP_AUTHORIZATION=self.auth_token)
+
+    @override_settings(DEBUG=True)
+    def test_debug_headers(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get_languages()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-DB-Queries'], str(len(queries.captured_queries)))
+        for header in ('X-Response-Time-Ms', 'X-DB-Time-Ms', 'X-Serializer-Time-Ms', 'X-Cache-Hits', 'X-Cache-Misses'):
+            self.assertIn(header, response)
+
+    @override_settings(DEBUG=True, CACHES=LOCMEM_CACHES)
+    def test_counts_cache_hits(self):
+        get_cache().clear()
+        try:
+            self.get_languages()
+            response = self.get_languages()
+        finally:
+            get_cache().clear()
+
+        self.assertEqual(response['X-Cache-Hits'], '1')
+
+    def test_no_debug_headers_outside_of_debug(self):
+        self.assertNotIn('X-DB-Queries', self.get_languages())
+
+    def test_records_metrics_by_endpoint(self):
+        histogram = REQUEST_QUERIES.labels(endpoint='language_list')
+        count = histogram.count
+
+        self.get_languages()
+
+        self.assertEqual(histogram.count, count + 1)
+        self.assertGreater(histogram.sum, 0)
+
+    @patch('challenges.views.LanguageListView.query_budget', 0)
+    def test_exceeding_query_budget_fails(self):
+        with self.assertRaises(QueryBudgetExceededError):
+            self.get_languages()
+
+    @override_settings(QUERY_BUDGETS_ENFORCED=False)
+    @patch('challenges.views.LanguageListView.query_budget', 0)
+    def test_exceeding_query_budget_warns_when_not_enforced(self):
+        with self.assertLogs('metrics', 'WARNING'):
+            response = self.get_languages()
+        self.assertEqual(response.status_code, 200)
+
+    def test_metrics_endpoint(self):
+        self.get_languages()
+
+        response = self.client.get('/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('http_request_db_queries_bucket{endpoint="language_list"', response.content.decode())
+
+    def test_metrics_endpoint_is_restricted(self):
+        response = self.client.get('/metrics', REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 403)
@@ -0,0 +1,70 @@
+"""
+A per-process cache of the expiry times of validated JWT tokens.
+A token gets decoded (and its signature verified) only the first time it is checked,
+    after which checking it is a dictionary lookup and a timestamp comparison
+"""
+import hmac
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+
+MAX_CACHED_TOKENS = 10000
+
+
+class JWTExpiryCache:
+    """
+    Maps (secret key, token) to the token's `exp` claim.
+    Keyed by the secret key as well, so a token is never trusted for a secret it was not verified with
+    """
+    def __init__(self, max_size=MAX_CACHED_TOKENS):
+        self.max_size = max_size
+        self._expiries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def is_expired(self, token, secret_key) -> bool:
+        """
+        Raises the same errors as jwt.decode() for an invalid token, except for an expired one
+        """
+        cache_key = (secret_key, token)
+        expiry = self._expiries.get(cache_key)
+        if expiry is None:
+            try:
+                payload = jwt.decode(token, secret_key)
+            except jwt.ExpiredSignatureError:
+                return True
+            expiry = payload.get('exp', float('inf'))
+            self._store(cache_key, expiry)
+
+        # the same check jwt.decode does
+        if expiry < int(time.time()):
+            self.invalidate(token, secret_key)
+            return True
+        return False
+
+    def invalidate(self, token, secret_key):
+        with self._lock:
+            self._expiries.pop((secret_key, token), None)
+
+    def clear(self):
+        with self._lock:
+            self._expiries.clear()
+
+    def _store(self, cache_key, expiry):
+        with self._lock:
+            self._expiries[cache_key] = expiry
+            while len(self._expiries) > self.max_size:
+                self._expiries.popitem(last=False)  # drop the oldest token
+
+
+TOKEN_EXPIRY_CACHE = JWTExpiryCache()
+
+
+def tokens_match(token, expected_token) -> bool:
+    """ Compares two tokens in constant time """
+    if isinstance(token, str) and isinstance(expected_token, str):
+        return hmac.compare_digest(token.encode(), expected_token.encode())
+    if isinstance(token, bytes) and isinstance(expected_token, bytes):
+        return hmac.compare_digest(token, expected_token)
+    return False
@@ -1,6 +1,10 @@
+from django.conf import settings
+from django.http import HttpResponse
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
+from metrics import REGISTRY
+
 
 class BaseManageView(APIView):
     """
@@ -19,3 +23,13 @@ class BaseManageView(APIView):
         # TODO: Change to 405
         # TODO: Test if this Response is returnable at all, as it was not with the class PostCreateView
         return Response(status=404)
+
+
+def metrics(request):
+    """
+    Renders this process' metrics (e.g the ones of request_metrics) in the Prometheus text format.
+    Every worker process keeps its own metrics, so each has to be scraped on its own
+    """
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponse(status=403)
+    return HttpResponse(REGISTRY.render(), content_type='text/plain; version=0.0.4')
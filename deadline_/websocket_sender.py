@@ -0,0 +1,112 @@
+"""
+Bounded, backpressured sending of websocket frames, used by both websocket servers
+"""
+import asyncio
+import json
+import logging
+from collections import deque
+
+from metrics import REGISTRY
+
+logger = logging.getLogger('websockets')
+
+MAX_PENDING_FRAMES = 100  # the most frames a single connection can have queued up
+MAX_DROPPED_FRAMES = 50  # a client which had this many frames dropped since it last caught up gets disconnected
+SLOW_CLIENT_CLOSE_CODE = 1008
+
+DROPPED_FRAMES = REGISTRY.counter('ws_dropped_frames_total', 'Frames dropped or coalesced as their client was slow')
+SLOW_CLIENT_DISCONNECTS = REGISTRY.counter('ws_slow_client_disconnects_total',
+                                           'Clients disconnected for staying over their pending frames limit')
+
+
+class WebSocketSender:
+    """
+    Sends the frames of a single websocket in order, through a bounded queue drained by a single writer task.
+    The writer task only lives while there are frames to send, so an idle connection costs just the empty queue.
+
+    A frame can be sent with
+        - a coalesce_key, in which case it replaces the pending frame with the same key (e.g a typing event)
+        - droppable=True, in which case it gets dropped to make room if the queue is full (e.g a stale notification)
+    If the queue is full and no frame can be dropped, or the client keeps falling behind, it gets disconnected
+    """
+    def __init__(self, web_socket, max_pending_frames=MAX_PENDING_FRAMES, max_dropped_frames=MAX_DROPPED_FRAMES):
+        self.web_socket = web_socket
+        self.max_pending_frames = max_pending_frames
+        self.max_dropped_frames = max_dropped_frames
+        self.is_closed = False
+        self._frames = deque()  # [coalesce_key, droppable, serialized payload]
+        self._dropped_count = 0
+        self._writer: asyncio.Future = None
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._frames)
+
+    def send(self, payload: dict, coalesce_key: str=None, droppable: bool=False) -> bool:
+        """
+        Queues up the payload to be sent
+        :return: a boolean indicating if the payload was queued
+        """
+        if self.is_closed:
+            return False
+
+        frame = json.dumps(payload)
+        if coalesce_key is not None:
+            for pending_frame in self._frames:
+                if pending_frame[0] == coalesce_key:
+                    pending_frame[1], pending_frame[2] = droppable, frame
+                    DROPPED_FRAMES.inc()
+                    return True
+
+        if len(self._frames) >= self.max_pending_frames:
+            if not self._make_room():
+                if droppable:
+                    self._drop_frame()
+                    return False
+                logger.warning(f'Disconnecting a client with {len(self._frames)} pending frames')
+                self.disconnect()
+                return False
+            if self.is_closed:
+                return False
+
+        self._frames.append([coalesce_key, droppable, frame])
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._write())
+        return True
+
+    def disconnect(self):
+        """ Drops every pending frame and closes the websocket, as the client can not keep up """
+        if self.is_closed:
+            return
+        self.is_closed = True
+        self._frames.clear()
+        SLOW_CLIENT_DISCONNECTS.inc()
+        asyncio.ensure_future(self.web_socket.close(code=SLOW_CLIENT_CLOSE_CODE, reason='Too many pending messages'))
+
+    def _make_room(self) -> bool:
+        """ Drops the oldest droppable pending frame, returning a boolean indicating if there was one """
+        for pending_frame in self._frames:
+            if pending_frame[1]:
+                self._frames.remove(pending_frame)
+                self._drop_frame()
+                return True
+        return False
+
+    def _drop_frame(self):
+        DROPPED_FRAMES.inc()
+        self._dropped_count += 1
+        if self._dropped_count > self.max_dropped_frames:
+            logger.warning(f'Disconnecting a client which had {self._dropped_count} frames dropped')
+            self.disconnect()
+
+    async def _write(self):
+        while self._frames and not self.is_closed:
+            _, _, frame = self._frames.popleft()
+            try:
+                await self.web_socket.send(frame)
+            except Exception as e:
+                logger.error(f'Could not send message to websocket due to {e}')
+                self.is_closed = True
+                self._frames.clear()
+                return
+        self._dropped_count = 0  # the client has caught up
@@ -0,0 +1,320 @@
+"""
+Load testing tools for the websocket servers, used by the load_test_chat_server
+    and load_test_notification_server commands.
+
+A load test starts the server under test in a subprocess (against the local DB and broker),
+    opens the simulated clients from a single event loop in this process, drives traffic at fixed rates and reports
+    - connection capacity - how many clients connected and authenticated, and how quickly
+    - the p50/p99 delivery latency of every event type
+    - the server's memory per connection, from the growth of its RSS while the clients connected
+    - the server's event loop lag while under load, scraped from its metrics endpoint
+"""
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+import websockets
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from accounts.models import User, Role
+from constants import BASE_USER_ROLE_NAME
+
+LOAD_TEST_USERNAME_PREFIX = 'loadtest_'
+SERVER_START_TIMEOUT_SECONDS = 30
+CLIENT_RESPONSE_TIMEOUT_SECONDS = 10
+
+
+class LatencyStats:
+    """ Collects latency samples (in seconds) per event type """
+    def __init__(self):
+        self.samples: {str: [float]} = {}
+
+    def record(self, event_type: str, seconds: float):
+        self.samples.setdefault(event_type, []).append(seconds)
+
+    def count(self, event_type: str) -> int:
+        return len(self.samples.get(event_type, []))
+
+    def percentile(self, event_type: str, percent: float) -> float:
+        """ The nearest-rank percentile of the event type's samples, None if there are none """
+        samples = sorted(self.samples.get(event_type, []))
+        if not samples:
+            return None
+        rank = max(int(round(percent / 100 * len(samples))) - 1, 0)
+        return samples[min(rank, len(samples) - 1)]
+
+
+def parse_histogram(metrics_text: str, name: str) -> (float, int, [(float, int)]):
+    """
+    Reads an unlabelled histogram out of the Prometheus text rendered by the metrics endpoint
+    :return: its sum, count and cumulative (upper bound, count) buckets
+    """
+    total, count, buckets = 0.0, 0, []
+    for line in metrics_text.splitlines():
+        if line.startswith(f'{name}_bucket{{le="'):
+            upper_bound = line[len(f'{name}_bucket{{le="'):line.index('"}')]
+            buckets.append((float(upper_bound), int(line.rsplit(' ', 1)[1])))
+        elif line.startswith(f'{name}_sum '):
+            total = float(line.rsplit(' ', 1)[1])
+        elif line.startswith(f'{name}_count '):
+            count = int(line.rsplit(' ', 1)[1])
+    return total, count, buckets
+
+
+def histogram_delta_summary(before: str, after: str, name: str) -> (float, float):
+    """
+    Summarizes what a histogram observed between two scrapes
+    :return: the mean and the upper bound of the bucket holding the p99, both None if nothing was observed
+    """
+    sum_before, count_before, buckets_before = parse_histogram(before, name)
+    sum_after, count_after, buckets_after = parse_histogram(after, name)
+    count = count_after - count_before
+    if count <= 0:
+        return None, None
+
+    before_counts = dict(buckets_before)
+    p99_bound = None
+    for upper_bound, cumulative_count in buckets_after:
+        if cumulative_count - before_counts.get(upper_bound, 0) >= count * 0.99:
+            p99_bound = upper_bound
+            break
+    return (sum_after - sum_before) / count, p99_bound
+
+
+class ServerProcess:
+    """
+    Runs a websocket server's management command in a subprocess,
+        so that its memory and event loop are measured on their own
+    """
+    def __init__(self, command: str, host: str, port: int, metrics_port: int, extra_args: [str]=()):
+        self.command = command
+        self.host, self.port, self.metrics_port = host, port, metrics_port
+        self.extra_args = list(extra_args)
+        self.process: subprocess.Popen = None
+
+    def start(self):
+        args = [sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), self.command,
+                '--port', str(self.port), '--metrics-port', str(self.metrics_port)] + self.extra_args
+        self.process = subprocess.Popen(args)
+        deadline = time.monotonic() + SERVER_START_TIMEOUT_SECONDS
+        while not self._accepts_connections():
+            if self.process.poll() is not None:
+                raise RuntimeError(f'{self.command} exited with code {self.process.returncode}')
+            if time.monotonic() > deadline:
+                self.stop()
+                raise RuntimeError(f'{self.command} did not start listening in {SERVER_START_TIMEOUT_SECONDS}s')
+            time.sleep(0.2)
+
+    def stop(self):
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=SERVER_START_TIMEOUT_SECONDS)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+    def rss_bytes(self) -> int:
+        """ The resident memory of the server process, None where /proc is not available """
+        if self.process is None:
+            return None
+        try:
+            with open(f'/proc/{self.process.pid}/statm') as statm:
+                return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            return None
+
+    def scrape_metrics(self) -> str:
+        with urllib.request.urlopen(f'http://{self.host}:{self.metrics_port}/metrics', timeout=5) as response:
+            return response.read().decode()
+
+    def _accepts_connections(self) -> bool:
+        for port in (self.port, self.metrics_port):
+            try:
+                socket.create_connection((self.host, port), timeout=1).close()
+            except OSError:
+                return False
+        return True
+
+
+def get_or_create_load_test_users(count: int) -> [User]:
+    """
+    Reuses the users created by previous load tests, creating only the missing ones
+    """
+    users = list(User.objects.filter(username__startswith=LOAD_TEST_USERNAME_PREFIX).order_by('id')[:count])
+    role, _ = Role.objects.get_or_create(name=BASE_USER_ROLE_NAME)
+    for idx in range(len(users), count):
+        user = User(username=f'{LOAD_TEST_USERNAME_PREFIX}{idx}', email=f'{LOAD_TEST_USERNAME_PREFIX}{idx}@load.test',
+                    password=f'{LOAD_TEST_USERNAME_PREFIX}{idx}', role=role)
+        user.save()
+        users.append(user)
+    return users
+
+
+class LoadTestClient:
+    """
+    A simulated client with a single websocket.
+    Subclasses define how it authenticates and what it does with the frames it receives
+    """
+    def __init__(self, url: str, stats: LatencyStats):
+        self.url = url
+        self.stats = stats
+        self.web_socket = None
+        self.is_authenticated = False
+        self._authenticated = asyncio.Event()
+        self.received_frames = 0
+
+    async def connect(self):
+        """ Connects and authenticates, recording how long both took """
+        start = time.perf_counter()
+        self.web_socket = await websockets.connect(self.url)
+        asyncio.ensure_future(self.listen())
+        await self.authenticate()
+        await asyncio.wait_for(self._authenticated.wait(), CLIENT_RESPONSE_TIMEOUT_SECONDS)
+        self.stats.record('connect+authenticate', time.perf_counter() - start)
+
+    async def listen(self):
+        try:
+            while True:
+                frame = json.loads(await self.web_socket.recv())
+                self.received_frames += 1
+                self.on_frame(frame)
+        except Exception:
+            pass  # the connection got closed
+
+    async def send(self, payload: dict):
+        await self.web_socket.send(json.dumps(payload))
+
+    async def close(self):
+        if self.web_socket is not None:
+            await self.web_socket.close()
+
+    def mark_authenticated(self):
+        self.is_authenticated = True
+        self._authenticated.set()
+
+    async def authenticate(self):
+        raise NotImplementedError()
+
+    def on_frame(self, frame: dict):
+        raise NotImplementedError()
+
+
+async def connect_clients(clients: [LoadTestClient], concurrency: int) -> [LoadTestClient]:
+    """
+    Connects the clients, at most `concurrency` at a time
+    :return: the clients which connected and authenticated
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def connect(client: LoadTestClient):
+        async with semaphore:
+            try:
+                await client.connect()
+            except Exception:
+                await client.close()
+
+    await asyncio.gather(*[connect(client) for client in clients])
+    return [client for client in clients if client.is_authenticated]
+
+
+async def run_at_rate(rate_per_second: float, duration_seconds: float, action):
+    """
+    Awaits action() rate_per_second times a second for duration_seconds, starting at a random offset
+        so that the clients do not fire in lockstep
+    """
+    if rate_per_second <= 0:
+        return
+    interval = 1 / rate_per_second
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + duration_seconds
+    await asyncio.sleep(random.uniform(0, interval))
+    while loop.time() < deadline:
+        try:
+            await action()
+        except websockets.exceptions.ConnectionClosed:
+            return
+        await asyncio.sleep(interval)
+
+
+class LoadTestCommand(BaseCommand):
+    """
+    The skeleton of a load test - subclasses create the clients and drive the traffic (see run_load)
+    """
+    SERVER_COMMAND = None
+    DEFAULT_HOST = None
+    DEFAULT_PORT = None
+    DEFAULT_METRICS_PORT = None
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=1000)
+        parser.add_argument('--duration', type=float, default=30, help='How long to drive traffic, in seconds')
+        parser.add_argument('--connect-concurrency', type=int, default=200,
+                            help='How many clients connect at the same time')
+        parser.add_argument('--host', default=self.DEFAULT_HOST)
+        parser.add_argument('--port', type=int, default=self.DEFAULT_PORT)
+        parser.add_argument('--metrics-port', type=int, default=self.DEFAULT_METRICS_PORT)
+        parser.add_argument('--use-running-server', action='store_true',
+                            help='Test an already running server instead of starting one (memory is not measured)')
+
+    def handle(self, *args, **options):
+        server = ServerProcess(self.SERVER_COMMAND, options['host'], options['port'], options['metrics_port'],
+                               self.get_server_args(options))
+        if not options['use_running_server']:
+            self.stdout.write(f'Starting {self.SERVER_COMMAND} on {options["host"]}:{options["port"]}')
+            server.start()
+
+        try:
+            self.report(*asyncio.get_event_loop().run_until_complete(self.measure(server, options)))
+        finally:
+            server.stop()
+
+    async def measure(self, server: ServerProcess, options) -> tuple:
+        stats = LatencyStats()
+        clients = self.create_clients(options, stats)
+        rss_before = server.rss_bytes()
+        start = time.perf_counter()
+        connected_clients = await connect_clients(clients, options['connect_concurrency'])
+        connect_seconds = time.perf_counter() - start
+        rss_after = server.rss_bytes()
+        self.stdout.write(f'{len(connected_clients)}/{len(clients)} clients connected in {connect_seconds:.1f}s, '
+                          f'driving traffic for {options["duration"]}s')
+
+        metrics_before = server.scrape_metrics()
+        await self.run_load(connected_clients, options)
+        metrics_after = server.scrape_metrics()
+        await asyncio.gather(*[client.close() for client in clients])
+
+        memory_per_connection = None
+        if rss_before is not None and rss_after is not None and connected_clients:
+            memory_per_connection = (rss_after - rss_before) / len(connected_clients)
+        loop_lag = histogram_delta_summary(metrics_before, metrics_after, 'event_loop_lag_seconds')
+        return len(clients), len(connected_clients), connect_seconds, memory_per_connection, loop_lag, stats
+
+    def report(self, client_count, connected_count, connect_seconds, memory_per_connection, loop_lag, stats):
+        self.stdout.write(f'Connected clients: {connected_count}/{client_count} in {connect_seconds:.2f}s')
+        if memory_per_connection is not None:
+            self.stdout.write(f'Server memory per connection: {memory_per_connection / 1024:.1f} KiB')
+        mean_lag, p99_lag = loop_lag
+        if mean_lag is not None:
+            self.stdout.write(f'Server event loop lag: mean {mean_lag * 1000:.1f}ms, p99 <= {p99_lag * 1000:.0f}ms')
+        for event_type in sorted(stats.samples):
+            self.stdout.write(f'{event_type}: {stats.count(event_type)} events, '
+                              f'p50 {stats.percentile(event_type, 50) * 1000:.1f}ms, '
+                              f'p99 {stats.percentile(event_type, 99) * 1000:.1f}ms')
+
+    def get_server_args(self, options) -> [str]:
+        return []
+
+    def create_clients(self, options, stats: LatencyStats) -> [LoadTestClient]:
+        raise NotImplementedError()
+
+    async def run_load(self, clients: [LoadTestClient], options):
+        raise NotImplementedError()